@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import InternalEmail, Schema, Environment, EnvironmentEmail, EnvironmentUpload, ExtractionResult, TaskLock, AuditLog
+from .models import InternalEmail, Schema, Environment, EnvironmentEmail, EnvironmentUpload, ExtractionResult, TaskLock, AuditLog, MailboxSyncState, IngestionSchedule, IngestionRun, ScanJob, AttachmentBlob, ExtractionBatch
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
+from .utils.attachment_storage import storage_for_url
+from .utils.batch_extraction import poll_extraction_batch
 
 User = get_user_model()
 
@@ -70,3 +72,65 @@ class AuditLogAdmin(admin.ModelAdmin):
 class TaskLockAdmin(admin.ModelAdmin):
     list_display = ("name", "is_locked", "locked_at")
 
+
+
+@admin.register(MailboxSyncState)
+class MailboxSyncStateAdmin(admin.ModelAdmin):
+    list_display = ("environment", "folder", "uidvalidity", "last_uid", "updated_at")
+
+
+@admin.register(IngestionSchedule)
+class IngestionScheduleAdmin(admin.ModelAdmin):
+    list_display = ("environment", "is_enabled", "interval_seconds", "priority", "jitter_seconds", "next_run_at", "empty_runs", "is_running")
+
+
+@admin.register(IngestionRun)
+class IngestionRunAdmin(admin.ModelAdmin):
+    list_display = ("environment", "status", "scheduled_for", "started_at", "lag_seconds", "messages", "saved", "processed", "failed",
+                    "fetch_seconds", "parse_seconds", "upload_seconds", "db_write_seconds", "ai_seconds", "retry_count")
+    list_filter = ("environment", "status")
+
+
+@admin.register(ScanJob)
+class ScanJobAdmin(admin.ModelAdmin):
+    list_display = ("environment", "status", "requested_by", "created_at", "started_at", "finished_at",
+                    "messages_found", "messages_fetched", "extracted", "failed", "attempts", "worker")
+    list_filter = ("environment", "status")
+
+
+@admin.register(AttachmentBlob)
+class AttachmentBlobAdmin(admin.ModelAdmin):
+    list_display = ("sha256", "file_path", "file_size", "extension", "ai_file_path", "hits", "created_at", "last_used_at")
+    search_fields = ("sha256", "file_path")
+    actions = ("delete_stored_files",)
+
+    @admin.action(description="Delete the stored files (emails still linking to them will break)")
+    def delete_stored_files(self, request, queryset):
+        deleted = removed = 0
+        for blob in queryset:
+            storage = storage_for_url(blob.file_path)
+            if storage is not None and storage.delete(blob.file_path):
+                deleted += 1
+            if blob.ai_file_path:
+                ai_storage = storage_for_url(blob.ai_file_path)
+                if ai_storage is not None:
+                    ai_storage.delete(blob.ai_file_path)
+            blob.delete()
+            removed += 1
+        self.message_user(request, f"Deleted {deleted} stored file(s), removed {removed} index entries.")
+
+
+@admin.register(ExtractionBatch)
+class ExtractionBatchAdmin(admin.ModelAdmin):
+    list_display = ("batch_id", "environment", "backend", "status", "remote_status", "created_at", "ingested_at", "succeeded", "failed")
+    list_filter = ("environment", "status", "backend")
+    search_fields = ("batch_id",)
+    actions = ("poll_batches",)
+
+    @admin.action(description="Check the selected batches now (ingest finished ones)")
+    def poll_batches(self, request, queryset):
+        finished = 0
+        for batch in queryset.filter(status="submitted"):
+            if poll_extraction_batch(batch).status != "submitted":
+                finished += 1
+        self.message_user(request, f"{finished} batch(es) finished and ingested.")
@@ -213,6 +213,7 @@ from django.core.exceptions import ValidationError
 from .models import Environment, Schema
 
 from .utils.cryptography import encrypt_value
+from .utils.mailbox_actions import KEYWORD_PATTERN
 
 
 FILE_TYPE_CHOICES = [
@@ -385,6 +386,9 @@ class EnvironmentForm(forms.ModelForm):
             "imap_password",
             "imap_host",
             "since_date",
+            "post_ingest_action",
+            "post_ingest_keyword",
+            "post_ingest_folder",
         ]
         widgets = {
             "name": forms.TextInput(attrs={"placeholder": "Environment name"}),
@@ -393,6 +397,9 @@ class EnvironmentForm(forms.ModelForm):
             "imap_password": forms.PasswordInput(attrs={"placeholder": "IMAP password"}),
             "imap_host": forms.TextInput(attrs={"placeholder": "imap.mail.server:993"}),
             "since_date": forms.DateInput(attrs={"type": "date"}),
+            "post_ingest_action": forms.Select(),
+            "post_ingest_keyword": forms.TextInput(attrs={"placeholder": "Ingested"}),
+            "post_ingest_folder": forms.TextInput(attrs={"placeholder": "Archive/Ingested"}),
         }
 
     # ------------------------
@@ -535,6 +542,29 @@ class EnvironmentForm(forms.ModelForm):
     def clean_blocked_subject_keywords_text(self):
         return parse_lines_to_list(self.cleaned_data.get("blocked_subject_keywords_text"))
 
+    def clean_post_ingest_keyword(self):
+        keyword = (self.cleaned_data.get("post_ingest_keyword") or "").strip()
+        if keyword and not KEYWORD_PATTERN.match(keyword):
+            raise ValidationError("Keywords can only contain letters, digits, '_', '-', '.' and '$'.")
+        return keyword
+
+    def clean(self):
+        cleaned_data = super().clean()
+        action = cleaned_data.get("post_ingest_action")
+
+        if action == "keyword" and not cleaned_data.get("post_ingest_keyword") and "post_ingest_keyword" not in self.errors:
+            self.add_error("post_ingest_keyword", "A keyword is required for this action.")
+
+        if action == "move":
+            folder = (cleaned_data.get("post_ingest_folder") or "").strip()
+            cleaned_data["post_ingest_folder"] = folder
+            if not folder:
+                self.add_error("post_ingest_folder", "An archive folder is required for this action.")
+            elif folder in (cleaned_data.get("email_folders_text") or []):
+                self.add_error("post_ingest_folder", "The archive folder cannot be one of the scanned folders.")
+
+        return cleaned_data
+
     # ------------------------
     # Save
     # ------------------------
@@ -0,0 +1,146 @@
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+import cloudinary.uploader
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from ...utils import email_monitor
+from ...utils.blob_index import hash_attachment
+from ...utils.attachment_storage import CloudinaryAttachmentStorage
+
+
+class CountingStorage(FileSystemStorage):
+    """Local storage in a scratch directory that counts exists() / save() calls."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = {"exists": 0, "save": 0}
+
+    def exists(self, name):
+        self.calls["exists"] += 1
+        return super().exists(name)
+
+    def save(self, name, content, max_length=None):
+        self.calls["save"] += 1
+        return super().save(name, content, max_length=max_length)
+
+
+class Command(BaseCommand):
+    help = "Compare per-attachment latency of the old save path (local write/stat/unlink) with the single-upload path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=50, help="Attachments saved per implementation")
+        parser.add_argument("--size-kb", type=int, default=2048, help="Size of each attachment")
+        parser.add_argument("--upload-latency-ms", type=float, default=0, help="Simulated Cloudinary upload latency")
+        parser.add_argument("--spooled", action="store_true", help="Pass attachments as spooled temp files (large parts) instead of bytes")
+        parser.add_argument("--same-name", action="store_true", help="Give every attachment the same filename (old path probes exists() for each clash)")
+
+    def handle(self, *args, **options):
+        count = max(1, options["count"])
+        size = max(1, options["size_kb"]) * 1024
+        latency = options["upload_latency_ms"] / 1000
+        uploads = {"calls": 0}
+
+        def fake_upload(data, **kwargs):
+            uploads["calls"] += 1
+            if hasattr(data, "read"):
+                chunk_size = kwargs.get("chunk_size", size)
+                sent = sum(len(chunk) for chunk in iter(lambda: data.read(chunk_size), b""))
+            else:
+                sent = len(data)
+            if latency:
+                time.sleep(latency)
+            name = kwargs.get("filename", "file")
+            return {"secure_url": f"https://example.invalid/{kwargs.get('folder')}/{name}", "bytes": sent}
+
+        scratch = tempfile.mkdtemp(prefix="attachment_bench_")
+        storage = CountingStorage(location=scratch)
+        try:
+            with mock.patch.object(cloudinary.uploader, "upload", fake_upload), \
+                    mock.patch.object(cloudinary.uploader, "upload_large", fake_upload):
+                results = {}
+                for name, func in (("old", lambda f, d: self.legacy_save(storage, f, d)), ("new", self.current_save)):
+                    uploads["calls"] = 0
+                    storage.calls = {"exists": 0, "save": 0}
+                    timings = []
+                    for i in range(count):
+                        filename = "invoice.pdf" if options["same_name"] else f"invoice_{i}.pdf"
+                        data = self.make_payload(i, size, options["spooled"])
+                        start = time.perf_counter()
+                        func(filename, data)
+                        timings.append(time.perf_counter() - start)
+                    results[name] = (timings, dict(storage.calls, upload=uploads["calls"]))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{count} attachments of {size // 1024} KB ({'spooled file' if options['spooled'] else 'bytes'}), "
+            f"simulated upload latency {options['upload_latency_ms']:.0f} ms"
+        ))
+        for name, (timings, calls) in results.items():
+            ordered = sorted(timings)
+            self.stdout.write(
+                f"      {name:<4} mean {statistics.mean(timings) * 1000:8.2f} ms   p50 {ordered[len(ordered) // 2] * 1000:8.2f} ms   "
+                f"p95 {ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000:8.2f} ms   "
+                f"per attachment: {calls['exists'] / count:.1f} exists, {calls['save'] / count:.1f} local writes, {calls['upload'] / count:.1f} uploads"
+            )
+
+        old, new = statistics.mean(results["old"][0]), statistics.mean(results["new"][0])
+        self.stdout.write(self.style.SUCCESS(f"Speedup: {old / new if new else 0:.1f}x per attachment"))
+
+    def make_payload(self, i, size, spooled):
+        # Distinct bytes per attachment so content-addressed names never repeat
+        data = (f"{i:08d}".encode() * (size // 8 + 1))[:size]
+        if not spooled:
+            return data
+        spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        spool.write(data)
+        return spool
+
+    def current_save(self, filename, data):
+        """save_attachment() minus the blob index lookup (which needs the database)."""
+        if email_monitor.payload_size(data) > email_monitor.MAX_ATTACHMENT_SIZE:
+            return None
+        sha256 = hash_attachment(data)
+        return email_monitor.upload_attachment(filename, data, sha256, storage=CloudinaryAttachmentStorage())
+
+    def legacy_save(self, storage, filename, data):
+        """The previous save path: exists() loop, local write, stat, unlink, then upload."""
+        base, ext = os.path.splitext(filename)
+        ext = ext[1:].lower()
+        hash_attachment(data)
+
+        counter = 1
+        unique_filename = filename
+        while storage.exists(f"local_email_attachments/{unique_filename}"):
+            unique_filename = f"{base}_{counter}.{ext}"
+            counter += 1
+
+        is_file = hasattr(data, "read")
+        if is_file:
+            data.seek(0)
+        path = storage.save(f"local_email_attachments/{unique_filename}", File(data, name=unique_filename) if is_file else ContentFile(data))
+
+        file_path = Path(storage.path(path))
+        if not file_path.exists():
+            return None
+        if file_path.stat().st_size / (1024 * 1024) > 200:
+            file_path.unlink(missing_ok=True)
+            return None
+        file_path.unlink(missing_ok=True)
+
+        if is_file:
+            data.seek(0)
+        res = cloudinary.uploader.upload(
+            data,
+            filename=unique_filename,
+            folder="email_attachments",
+            resource_type="raw",
+            use_filename=True
+        )
+        return res.get("secure_url"), res.get("bytes")
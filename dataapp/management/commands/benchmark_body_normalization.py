@@ -0,0 +1,63 @@
+import time
+from pathlib import Path
+from django.core.management.base import BaseCommand, CommandError
+from ...utils.email_monitor import html_to_text
+from ...utils.body_normalizer import normalize_body, EMAIL_BODY_MAX_CHARS
+
+FIXTURES_DIR = Path(__file__).resolve().parents[2] / "fixtures" / "email_bodies"
+
+
+class Command(BaseCommand):
+    help = "Compare html_to_text with the lxml body normalizer on HTML email fixtures"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", action="append", dest="files", help="HTML file to benchmark (repeatable, default: bundled fixtures)")
+        parser.add_argument("--repeat", type=int, default=50, help="Calls per fixture and implementation")
+        parser.add_argument("--scale", type=int, default=1, help="Repeat each fixture's <body> this many times (simulates huge newsletters)")
+        parser.add_argument("--max-chars", type=int, default=EMAIL_BODY_MAX_CHARS, help="Character budget for the normalizer (0 = no limit)")
+
+    def handle(self, *args, **options):
+        paths = [Path(f) for f in options["files"]] if options["files"] else sorted(FIXTURES_DIR.glob("*.html"))
+        if not paths:
+            raise CommandError(f"No HTML fixtures found in {FIXTURES_DIR}")
+
+        repeat = max(1, options["repeat"])
+        totals = {"html_to_text": 0.0, "normalize_body": 0.0}
+
+        for path in paths:
+            if not path.exists():
+                raise CommandError(f"File not found: {path}")
+            html = path.read_text(encoding="utf-8", errors="replace")
+            if options["scale"] > 1:
+                html = self.scale_html(html, options["scale"])
+
+            results = {
+                "html_to_text": self.measure(lambda: html_to_text(html), repeat),
+                "normalize_body": self.measure(lambda: normalize_body("", html, max_chars=options["max_chars"]), repeat),
+            }
+
+            self.stdout.write(self.style.SUCCESS(f"{path.name} ({len(html)} chars in)"))
+            for name, (seconds, text) in results.items():
+                totals[name] += seconds
+                self.stdout.write(f"      {name:<15} {seconds / repeat * 1000:8.2f} ms/call   {len(text):>8} chars out")
+
+        baseline, fast = totals["html_to_text"], totals["normalize_body"]
+        self.stdout.write(self.style.SUCCESS(
+            f"Total: html_to_text {baseline:.2f}s, normalize_body {fast:.2f}s "
+            f"({baseline / fast if fast else 0:.1f}x) over {repeat} calls per fixture"
+        ))
+
+    def measure(self, func, repeat):
+        text = func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return time.perf_counter() - start, text
+
+    def scale_html(self, html, factor):
+        lower = html.lower()
+        start, end = lower.find("<body"), lower.rfind("</body>")
+        if start == -1 or end == -1:
+            return html * factor
+        start = html.index(">", start) + 1
+        return html[:start] + html[start:end] * factor + html[end:]
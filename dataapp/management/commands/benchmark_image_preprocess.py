@@ -0,0 +1,69 @@
+import io
+import time
+from pathlib import Path
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image, ImageDraw
+from ...utils.email_monitor import format_bytes
+from ...utils.image_preprocess import preprocess_image, IMAGE_MAX_DIMENSION
+
+
+class Command(BaseCommand):
+    help = "Measure the size reduction and cost of image pre-processing (default: a synthetic 12MP phone photo)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", action="append", dest="files", help="Image to pre-process (repeatable)")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per image")
+
+    def handle(self, *args, **options):
+        if options["files"]:
+            images = []
+            for f in options["files"]:
+                path = Path(f)
+                if not path.exists():
+                    raise CommandError(f"File not found: {path}")
+                images.append((path.name, path.read_bytes()))
+        else:
+            images = [("synthetic_phone_photo.jpg", self.phone_photo())]
+
+        repeat = max(1, options["repeat"])
+        total_in = total_out = 0
+
+        for name, data in images:
+            derived = preprocess_image(data)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                preprocess_image(data)
+            seconds = (time.perf_counter() - start) / repeat
+
+            with Image.open(io.BytesIO(data)) as original:
+                original_dims = original.size
+            self.stdout.write(self.style.SUCCESS(f"{name} ({original_dims[0]}x{original_dims[1]}, {format_bytes(len(data))})"))
+            if derived is None:
+                self.stdout.write("      not reduced (unreadable, or already small)")
+                continue
+
+            with Image.open(io.BytesIO(derived)) as result:
+                self.stdout.write(
+                    f"      → {result.size[0]}x{result.size[1]} {result.mode}, {format_bytes(len(derived))} "
+                    f"({len(data) / len(derived):.0f}x smaller) in {seconds * 1000:.1f} ms"
+                )
+            total_in += len(data)
+            total_out += len(derived)
+
+        if total_out:
+            self.stdout.write(self.style.SUCCESS(
+                f"Total: {format_bytes(total_in)} → {format_bytes(total_out)} sent to the model "
+                f"(max side {IMAGE_MAX_DIMENSION}px)"
+            ))
+
+    def phone_photo(self):
+        """4032x3024 JPEG with sensor-like noise and an EXIF rotation, like a receipt shot on a phone."""
+        img = Image.effect_noise((4032, 3024), 40).convert("RGB")
+        draw = ImageDraw.Draw(img)
+        for line in range(40):
+            draw.text((200, 200 + line * 60), f"ITEM {line:02d} ........ {line * 3.5:8.2f}", fill="white")
+        exif = Image.Exif()
+        exif[0x0112] = 6 # rotated 90° clockwise
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=92, exif=exif)
+        return out.getvalue()
@@ -45,14 +45,23 @@
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from ...utils.task_lock import acquire_lock, release_lock, TaskAlreadyRunning
-from ...utils.email_monitor import fetch_and_process_emails
+from ...utils.task_lock import (
+    acquire_lock, release_lock, TaskAlreadyRunning, acquire_environment_lock, release_environment_lock, FETCH_EMAILS_LOCK,
+)
+from ...utils.email_monitor import format_bytes
+from ...utils.ingestion import run_ingestion, get_active_environments, INGESTION_MAX_WORKERS, INGESTION_MAX_PER_HOST
 
 class Command(BaseCommand):
-    help = "Fetch emails and process AI-extracted orders"
+    help = "Fetch emails and process AI-extracted orders for every active environment"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--env", type=int, action="append", dest="env_ids", help="Only ingest this environment id (repeatable)")
+        parser.add_argument("--workers", type=int, default=INGESTION_MAX_WORKERS, help="Worker threads for the whole run")
+        parser.add_argument("--per-host", type=int, default=INGESTION_MAX_PER_HOST, help="Max concurrent folders per IMAP host")
+        parser.add_argument("--shared", action="store_true", help="Fetch each shared (host, account, folder) once for all its environments")
 
     def handle(self, *args, **options):
-        lock_name = "fetch_emails_lock"
+        lock_name = FETCH_EMAILS_LOCK
 
         try:
             acquire_lock(lock_name, timeout_minutes=10)
@@ -66,20 +75,43 @@ class Command(BaseCommand):
             f"[{timezone.now()}] Starting email fetch and AI processing..."
         ))
 
+        # Environments a scan job, the scheduler or the IDLE watcher is already ingesting are left to it
+        env_ids = []
+        for environment in get_active_environments(options["env_ids"]):
+            try:
+                acquire_environment_lock(environment.id)
+                env_ids.append(environment.id)
+            except TaskAlreadyRunning:
+                self.stdout.write(self.style.WARNING(f"  [{environment.id}] {environment.name}: already being ingested, skipped."))
+
         try:
-            ENVIRONMENT_ID = 18
-            # fetched_count, skipped_count, processed_count, failed_count = fetch_and_process_emails(ENVIRONMENT_ID)
-            fetched_count = fetch_and_process_emails(ENVIRONMENT_ID)
-
-            # self.stdout.write(self.style.SUCCESS(
-            #     f"[{timezone.now()}] Emails fetched: {fetched_count + skipped_count}, "
-            #     f"[{timezone.now()}] Emails processed: {fetched_count}, "
-            #     f"[{timezone.now()}] Emails skipped (max size): {skipped_count}, "
-            #     f"Success: {processed_count}, Failed: {failed_count}"
-            # ))
-            
+            if not env_ids:
+                return
+
+            summary = run_ingestion(
+                env_ids=env_ids,
+                max_workers=options["workers"],
+                max_per_host=options["per_host"],
+                shared=options["shared"]
+            )
+
+            for env_id, env_summary in summary["per_environment"].items():
+                style = self.style.ERROR if env_summary["errors"] else self.style.SUCCESS
+                self.stdout.write(style(
+                    f"  [{env_id}] {env_summary['name']}: {env_summary['messages']} fetched, "
+                    f"{env_summary['saved']} saved, {env_summary['processed']} processed, "
+                    f"{env_summary['failed']} failed"
+                ))
+                for error in env_summary["errors"]:
+                    self.stdout.write(self.style.ERROR(f"      {error}"))
+
+            totals = summary["totals"]
             self.stdout.write(self.style.SUCCESS(
-                f"[{timezone.now()}] Emails fetched: {fetched_count}"
+                f"[{timezone.now()}] {summary['environments']} environments / {summary['folders']} folders in "
+                f"{summary['elapsed']:.1f}s — emails fetched: {totals['messages']} "
+                f"({format_bytes(totals['bytes_fetched'])}), saved: {totals['saved']}, "
+                f"processed: {totals['processed']}, failed: {totals['failed']}, "
+                f"throughput: {summary['messages_per_second']:.2f} msg/s"
             ))
 
         except Exception as e:
@@ -87,6 +119,8 @@ class Command(BaseCommand):
             raise e
 
         finally:
+            for env_id in env_ids:
+                release_environment_lock(env_id)
             release_lock(lock_name)
             self.stdout.write(self.style.SUCCESS(
                 f"[{timezone.now()}] Email fetch finished, lock released."
@@ -0,0 +1,32 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ...utils.ingestion import stage_report
+from ...utils.email_monitor import format_bytes
+from ...utils.run_metrics import INGESTION_STAGES
+
+
+class Command(BaseCommand):
+    help = "Per-environment ingestion stage timings from recent IngestionRun reports"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--env", type=int, action="append", dest="env_ids", help="Only report this environment id (repeatable)")
+        parser.add_argument("--days", type=int, default=7, help="How many days of runs to include")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options["days"])
+        rows = stage_report(env_ids=options["env_ids"], since=since)
+
+        if not rows:
+            self.stdout.write(self.style.WARNING(f"No ingestion runs in the last {options['days']} days."))
+            return
+
+        for row in rows:
+            stages = {stage: row[f"{stage}_seconds"] or 0.0 for stage in INGESTION_STAGES}
+            slowest = max(stages, key=stages.get) if any(stages.values()) else "n/a"
+            self.stdout.write(self.style.SUCCESS(
+                f"[{row['environment_id']}] {row['environment__name']}: {row['runs']} runs, "
+                f"{row['messages'] or 0} messages ({format_bytes(row['bytes_fetched'] or 0)}), "
+                f"{row['retry_count'] or 0} retries, avg lag {row['avg_lag_seconds'] or 0:.0f}s — slowest stage: {slowest}"
+            ))
+            self.stdout.write("      " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stages.items()))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from ...models import Environment
+from ...utils.batch_extraction import (
+    collect_batch_items, submit_extraction_batch, poll_open_batches, wait_for_batches,
+    AI_BATCH_BACKEND, AI_BATCH_POLL_INTERVAL,
+)
+
+
+class Command(BaseCommand):
+    help = "Submit pending/failed extractions through the Batch API and ingest finished batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--env", action="append", type=int, dest="envs", help="Environment id to submit a batch for (repeatable)")
+        parser.add_argument("--status", action="append", choices=["pending", "failed"], dest="statuses",
+                            help="Item statuses to submit (repeatable, default: pending and failed)")
+        parser.add_argument("--backend", choices=["openai", "local"], default=AI_BATCH_BACKEND, help="Batch endpoint to use")
+        parser.add_argument("--wait", action="store_true", help="Keep polling until the submitted batches have finished")
+        parser.add_argument("--poll-interval", type=float, default=AI_BATCH_POLL_INTERVAL, help="Seconds between checks with --wait")
+
+    def handle(self, *args, **options):
+        statuses = options["statuses"] or ["pending", "failed"]
+        submitted = []
+
+        for env_id in options["envs"] or []:
+            environment = Environment.objects.filter(id=env_id).first()
+            if environment is None:
+                raise CommandError(f"Environment {env_id} not found")
+            items = collect_batch_items(environment, statuses)
+            batches = submit_extraction_batch(items, environment=environment, backend=options["backend"])
+            submitted += batches
+            self.stdout.write(self.style.SUCCESS(
+                f"[{timezone.now()}] {environment.name}: {sum(len(b.items) for b in batches)} item(s) in {len(batches)} batch(es)"
+            ))
+
+        if options["wait"] and submitted:
+            pending = wait_for_batches(submitted, poll_interval=max(0, options["poll_interval"]))
+            if pending:
+                self.stdout.write(self.style.WARNING(f"{len(pending)} batch(es) still running"))
+
+        # Ingest whatever finished since the last run (this is the cron entry point)
+        finished = [batch for batch in submitted if batch.status != "submitted"] + poll_open_batches()
+        for batch in finished:
+            self.stdout.write(f"[{timezone.now()}] Batch {batch.batch_id}: {batch.status}, {batch.succeeded} extracted, {batch.failed} failed")
@@ -0,0 +1,38 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ...utils.scan_jobs import run_worker_loop, SCAN_WORKER_CONCURRENCY, SCAN_JOB_POLL_INTERVAL
+from ...utils.email_monitor import imap_pool
+
+
+class Command(BaseCommand):
+    help = "Run queued inbox scan jobs (start as many worker processes as needed)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty (for cron)")
+        parser.add_argument("--concurrency", type=int, default=SCAN_WORKER_CONCURRENCY, help="Jobs run at the same time by this process")
+        parser.add_argument("--poll", type=float, default=SCAN_JOB_POLL_INTERVAL, help="Seconds between queue checks when idle")
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options["concurrency"])
+        stop_event = threading.Event()
+
+        self.stdout.write(self.style.SUCCESS(f"[{timezone.now()}] Starting scan worker ({concurrency} threads)..."))
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [
+                    executor.submit(run_worker_loop, stop_event, once=options["once"], poll_interval=options["poll"])
+                    for _ in range(concurrency)
+                ]
+                try:
+                    jobs_run = sum(future.result() for future in futures)
+                except KeyboardInterrupt:
+                    self.stdout.write(self.style.WARNING(f"[{timezone.now()}] Stopping after the jobs in progress..."))
+                    stop_event.set()
+                    jobs_run = sum(future.result() for future in futures)
+
+        finally:
+            imap_pool.close_all()
+
+        self.stdout.write(self.style.SUCCESS(f"[{timezone.now()}] Scan worker stopped after {jobs_run} jobs."))
@@ -0,0 +1,53 @@
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ...utils.scheduler import run_scheduler_tick, SCHEDULER_MAX_ENVIRONMENTS
+from ...utils.ingestion import INGESTION_MAX_WORKERS, INGESTION_MAX_PER_HOST
+from ...utils.email_monitor import imap_pool
+
+
+class Command(BaseCommand):
+    help = "Ingest every environment on its own polling interval (priority, jitter and backoff for quiet mailboxes)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Run a single tick and exit (for cron)")
+        parser.add_argument("--tick", type=int, default=30, help="Seconds between ticks in loop mode")
+        parser.add_argument("--env", type=int, action="append", dest="env_ids", help="Only schedule this environment id (repeatable)")
+        parser.add_argument("--max-envs", type=int, default=SCHEDULER_MAX_ENVIRONMENTS, help="Environments started per tick")
+        parser.add_argument("--workers", type=int, default=INGESTION_MAX_WORKERS, help="Worker threads per tick")
+        parser.add_argument("--per-host", type=int, default=INGESTION_MAX_PER_HOST, help="Max concurrent folders per IMAP host")
+        parser.add_argument("--shared", action="store_true", help="Fetch each shared (host, account, folder) once for all its environments")
+
+    def tick(self, options):
+        summary = run_scheduler_tick(
+            env_ids=options["env_ids"],
+            max_environments=options["max_envs"],
+            max_workers=options["workers"],
+            max_per_host=options["per_host"],
+            shared=options["shared"]
+        )
+        if summary:
+            totals = summary["totals"]
+            self.stdout.write(self.style.SUCCESS(
+                f"[{timezone.now()}] Tick: {summary['environments']} environments in {summary['elapsed']:.1f}s — "
+                f"saved: {totals['saved']}, processed: {totals['processed']}, failed: {totals['failed']}"
+            ))
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            self.tick(options)
+            return
+
+        self.stdout.write(self.style.SUCCESS(f"[{timezone.now()}] Starting ingestion scheduler..."))
+        try:
+            while True:
+                self.tick(options)
+                imap_pool.keepalive()
+                time.sleep(options["tick"])
+
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING(f"[{timezone.now()}] Stopping..."))
+
+        finally:
+            imap_pool.close_all()
+            self.stdout.write(self.style.SUCCESS(f"[{timezone.now()}] Ingestion scheduler stopped."))
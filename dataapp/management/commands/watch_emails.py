@@ -0,0 +1,55 @@
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ...utils.imap_idle import MailboxWatcher, group_watch_targets, IMAP_IDLE_TIMEOUT
+from ...utils.email_monitor import imap_pool
+
+
+class Command(BaseCommand):
+    help = "Long-running IMAP IDLE listener: ingest new mail for every active environment as soon as it arrives"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--env", type=int, action="append", dest="env_ids", help="Only watch this environment id (repeatable)")
+        parser.add_argument("--idle-timeout", type=int, default=IMAP_IDLE_TIMEOUT, help="Seconds before IDLE is re-issued")
+        parser.add_argument("--refresh", type=int, default=300, help="Seconds between reloads of environment settings")
+
+    def sync_watchers(self, watchers, options):
+        """Start watchers for new folders and stop the ones no longer configured."""
+        targets = group_watch_targets(options["env_ids"])
+
+        for key in list(watchers):
+            watcher = watchers[key]
+            if key not in targets or targets[key][0] != watcher.env_ids or not watcher.is_alive():
+                watcher.stop()
+                del watchers[key]
+
+        for key, (env_ids, env_config) in targets.items():
+            if key not in watchers:
+                watcher = MailboxWatcher(key, env_ids, env_config, idle_timeout=options["idle_timeout"])
+                watcher.start()
+                watchers[key] = watcher
+                self.stdout.write(f"[{timezone.now()}] Watching {key[1]} / {key[2]} → environments {env_ids}")
+
+    def handle(self, *args, **options):
+        watchers = {}
+
+        self.stdout.write(self.style.SUCCESS(f"[{timezone.now()}] Starting IMAP IDLE listener..."))
+
+        try:
+            while True:
+                self.sync_watchers(watchers, options)
+                if not watchers:
+                    self.stdout.write(self.style.WARNING(f"[{timezone.now()}] No active mailboxes to watch."))
+                time.sleep(options["refresh"])
+                imap_pool.keepalive()
+
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING(f"[{timezone.now()}] Stopping..."))
+
+        finally:
+            for watcher in watchers.values():
+                watcher.stop()
+            for watcher in watchers.values():
+                watcher.join(timeout=5)
+            imap_pool.close_all()
+            self.stdout.write(self.style.SUCCESS(f"[{timezone.now()}] IMAP IDLE listener stopped."))
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-18 04:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0004_alter_environment_document_types'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(max_length=255)),
+                ('uidvalidity', models.BigIntegerField(blank=True, null=True)),
+                ('last_uid', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_sync_states', to='dataapp.environment')),
+            ],
+            options={
+                'unique_together': {('environment', 'folder')},
+            },
+        ),
+    ]
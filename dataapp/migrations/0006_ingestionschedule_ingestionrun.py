@@ -0,0 +1,55 @@
+# Generated by Django 5.2.9 on 2026-10-18 04:26
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0005_mailboxsyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('successful', 'Successful'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('scheduled_for', models.DateTimeField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('lag_seconds', models.FloatField(default=0, help_text='How late the run started versus its scheduled time')),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('saved', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_runs', to='dataapp.environment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['environment', '-started_at'], name='dataapp_ing_environ_f0b863_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='IngestionSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_enabled', models.BooleanField(default=True)),
+                ('interval_seconds', models.PositiveIntegerField(default=300)),
+                ('priority', models.IntegerField(default=0, help_text='Higher runs first when the scheduler is saturated')),
+                ('jitter_seconds', models.PositiveIntegerField(default=30)),
+                ('next_run_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('empty_runs', models.PositiveIntegerField(default=0, help_text='Consecutive runs that found no new mail')),
+                ('is_running', models.BooleanField(default=False)),
+                ('running_since', models.DateTimeField(blank=True, null=True)),
+                ('last_finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('environment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_schedule', to='dataapp.environment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['next_run_at'], name='dataapp_ing_next_ru_d851e4_idx')],
+            },
+        ),
+    ]
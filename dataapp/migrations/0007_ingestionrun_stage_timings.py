@@ -0,0 +1,73 @@
+# Generated by Django 5.2.9 on 2026-10-18 04:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0006_ingestionschedule_ingestionrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='ai_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='bytes_fetched',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='db_write_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='fetch_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='login_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='parse_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='retries',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='retry_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='round_trips',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='search_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='select_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ingestionrun',
+            name='upload_seconds',
+            field=models.FloatField(default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-18 04:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0007_ingestionrun_stage_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='post_ingest_action',
+            field=models.CharField(choices=[('none', 'Leave unchanged'), ('seen', 'Mark as seen'), ('keyword', 'Add keyword'), ('move', 'Move to folder')], default='none', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='post_ingest_folder',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='post_ingest_keyword',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
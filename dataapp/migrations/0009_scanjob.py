@@ -0,0 +1,39 @@
+# Generated by Django 5.2.9 on 2026-10-18 04:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0008_environment_post_ingest_action'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('successful', 'Successful'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, max_length=255)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('messages_found', models.PositiveIntegerField(default=0)),
+                ('messages_fetched', models.PositiveIntegerField(default=0)),
+                ('extracted', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('email_ids', models.JSONField(blank=True, default=list)),
+                ('error', models.TextField(blank=True, default='')),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scan_jobs', to='dataapp.environment')),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='scan_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='dataapp_sca_status_5ee75f_idx')],
+            },
+        ),
+    ]
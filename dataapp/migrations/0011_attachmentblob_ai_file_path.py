@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 04:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0010_attachmentblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachmentblob',
+            name='ai_file_path',
+            field=models.URLField(blank=True, max_length=500),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.9 on 2026-10-18 04:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0011_attachmentblob_ai_file_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractionBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(default='openai', max_length=20)),
+                ('batch_id', models.CharField(blank=True, max_length=255)),
+                ('input_file_id', models.CharField(blank=True, max_length=255)),
+                ('output_file_id', models.CharField(blank=True, max_length=255)),
+                ('error_file_id', models.CharField(blank=True, max_length=255)),
+                ('remote_status', models.CharField(blank=True, max_length=30)),
+                ('status', models.CharField(choices=[('submitted', 'Submitted'), ('ingested', 'Ingested'), ('failed', 'Failed')], default='submitted', max_length=20)),
+                ('items', models.JSONField(blank=True, default=list)),
+                ('succeeded', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('ingested_at', models.DateTimeField(blank=True, null=True)),
+                ('environment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='extraction_batches', to='dataapp.environment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='dataapp_ext_status_bd6e47_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 05:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataapp', '0012_extractionbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environmentemail',
+            name='attachments',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
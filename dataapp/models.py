@@ -5,6 +5,7 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser
 from django.forms import ValidationError
 from .utils.cryptography import decrypt_value
+from .utils.schema_cache import invalidate_compiled_schema
 from django.conf import settings
 
 # user = get_user_model()
@@ -34,6 +35,13 @@ class User(AbstractUser):
         return self.username
     
 
+POST_INGEST_ACTIONS = (
+    ('none', 'Leave unchanged'),
+    ('seen', 'Mark as seen'),
+    ('keyword', 'Add keyword'),
+    ('move', 'Move to folder'),
+)
+
 PROCESS_STATUS = (
     ('pending', 'Pending'),
     ('successful', 'Successful'),
@@ -62,6 +70,24 @@ class InternalEmail(models.Model):
         return f"{self.subject} from {self.sender}"
     
 
+class AttachmentBlob(models.Model):
+    """
+    One stored attachment file, keyed by the SHA-256 of its bytes.
+    Identical attachments (forwards, re-sent threads, re-uploads) reuse it instead of uploading again.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file_path = models.URLField(max_length=500)     # stored URL
+    file_size = models.BigIntegerField(default=0)
+    extension = models.CharField(max_length=20, blank=True)
+    ai_file_path = models.URLField(max_length=500, blank=True)  # downscaled copy sent to the model (images)
+    hits = models.PositiveIntegerField(default=0)   # uploads skipped thanks to this blob
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]}… → {self.file_path}"
+
+
 # ---------------------------------------------------------
 # SCHEMA
 # ---------------------------------------------------------
@@ -108,6 +134,17 @@ class Schema(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Compiled Pydantic models of the previous schema_json are stale now
+        invalidate_compiled_schema(self.pk)
+
+    def delete(self, *args, **kwargs):
+        schema_id = self.pk
+        result = super().delete(*args, **kwargs)
+        invalidate_compiled_schema(schema_id)
+        return result
+
 
 from django.db import models
 from django.conf import settings
@@ -137,6 +174,11 @@ class Environment(models.Model):
 
     require_attachment = models.BooleanField(default=False)
 
+    # What happens to a message on the server once it is stored (one UID STORE / MOVE per folder)
+    post_ingest_action = models.CharField(max_length=20, choices=POST_INGEST_ACTIONS, default=POST_INGEST_ACTIONS[0][0])
+    post_ingest_keyword = models.CharField(max_length=64, blank=True)   # e.g. "Ingested"
+    post_ingest_folder = models.CharField(max_length=255, blank=True)   # e.g. "Archive/Ingested"
+
     since_date = models.DateField(null=True, blank=True)
 
     has_extracted_data = models.BooleanField(default=False)  # prevents certain changes after extraction
@@ -173,6 +215,8 @@ class EnvironmentEmail(models.Model):
     )
     
     status = models.CharField(max_length=255, choices=PROCESS_STATUS, default=PROCESS_STATUS[0][0])
+    # This environment's share of internal_email.attachments (its own allowed file types) — None: all of them
+    attachments = models.JSONField(null=True, blank=True)
     # max_size = models.BooleanField(default=False)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
@@ -183,6 +227,9 @@ class EnvironmentEmail(models.Model):
     def __str__(self):
         return f"Email: {self.internal_email.subject} in {self.environment.name}"
 
+    def get_attachments(self):
+        return self.internal_email.attachments if self.attachments is None else self.attachments
+
 
 # class InternalFile(models.Model):
 #     attachments = models.JSONField(default=list, blank=True)
@@ -278,6 +325,219 @@ class AuditLog(models.Model):
         return f"{actor} {self.action} {self.target_type}:{self.target} at {self.created_at}"
 
 
+# ---------------------------------------------------------
+# MAILBOX SYNC STATE
+# ---------------------------------------------------------
+class MailboxSyncState(models.Model):
+    """
+    IMAP high-water mark for one folder of an environment's mailbox.
+    last_uid is only meaningful while the server's UIDVALIDITY matches.
+    """
+    environment = models.ForeignKey(
+        Environment,
+        on_delete=models.CASCADE,
+        related_name="mailbox_sync_states"
+    )
+    folder = models.CharField(max_length=255)
+    uidvalidity = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("environment", "folder")
+
+    def __str__(self):
+        return f"{self.environment.name} / {self.folder} @ UID {self.last_uid}"
+
+
+# ---------------------------------------------------------
+# INGESTION SCHEDULE
+# ---------------------------------------------------------
+class IngestionSchedule(models.Model):
+    """
+    Polling settings and scheduler state for one environment.
+    Kept off Environment so scheduler writes don't bump Environment.updated_at.
+    """
+    environment = models.OneToOneField(
+        Environment,
+        on_delete=models.CASCADE,
+        related_name="ingestion_schedule"
+    )
+    is_enabled = models.BooleanField(default=True)
+    interval_seconds = models.PositiveIntegerField(default=300)
+    priority = models.IntegerField(default=0, help_text="Higher runs first when the scheduler is saturated")
+    jitter_seconds = models.PositiveIntegerField(default=30)
+
+    # Scheduler state
+    next_run_at = models.DateTimeField(default=timezone.now)
+    empty_runs = models.PositiveIntegerField(default=0, help_text="Consecutive runs that found no new mail")
+    is_running = models.BooleanField(default=False)
+    running_since = models.DateTimeField(null=True, blank=True)
+    last_finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["next_run_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.environment.name} every {self.interval_seconds}s (next {self.next_run_at})"
+
+
+# ---------------------------------------------------------
+# INGESTION RUN (HISTORY)
+# ---------------------------------------------------------
+RUN_STATUS = (
+    ('running', 'Running'),
+    ('successful', 'Successful'),
+    ('failed', 'Failed'),
+)
+
+class IngestionRun(models.Model):
+    """One ingestion pass over an environment's folders."""
+    environment = models.ForeignKey(
+        Environment,
+        on_delete=models.CASCADE,
+        related_name="ingestion_runs"
+    )
+    status = models.CharField(max_length=20, choices=RUN_STATUS, default=RUN_STATUS[0][0])
+    scheduled_for = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    lag_seconds = models.FloatField(default=0, help_text="How late the run started versus its scheduled time")
+
+    messages = models.PositiveIntegerField(default=0)
+    saved = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    bytes_fetched = models.BigIntegerField(default=0)
+    round_trips = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+
+    # Wall time per stage (seconds, summed over the run's folders)
+    login_seconds = models.FloatField(default=0)
+    select_seconds = models.FloatField(default=0)
+    search_seconds = models.FloatField(default=0)
+    fetch_seconds = models.FloatField(default=0)
+    parse_seconds = models.FloatField(default=0)
+    upload_seconds = models.FloatField(default=0)
+    db_write_seconds = models.FloatField(default=0)
+    ai_seconds = models.FloatField(default=0)
+
+    # Failed attempts seen by the retry decorators ({function name: count})
+    retry_count = models.PositiveIntegerField(default=0)
+    retries = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["environment", "-started_at"]),
+        ]
+
+    @property
+    def duration_seconds(self):
+        if not self.finished_at:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    @property
+    def slowest_stage(self):
+        stages = ("login", "select", "search", "fetch", "parse", "upload", "db_write", "ai")
+        return max(stages, key=lambda stage: getattr(self, f"{stage}_seconds"))
+
+    def __str__(self):
+        return f"{self.environment.name} run at {self.started_at} ({self.status})"
+
+
+SCAN_JOB_STATUS = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('successful', 'Successful'),
+    ('failed', 'Failed'),
+)
+
+class ScanJob(models.Model):
+    """An inbox scan requested from the UI, run by a scan worker process."""
+    environment = models.ForeignKey(
+        Environment,
+        on_delete=models.CASCADE,
+        related_name="scan_jobs"
+    )
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="scan_jobs")
+    status = models.CharField(max_length=20, choices=SCAN_JOB_STATUS, default=SCAN_JOB_STATUS[0][0])
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)   # last progress update from the worker
+    worker = models.CharField(max_length=255, blank=True)        # host:pid of the worker running it
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    # Progress
+    messages_found = models.PositiveIntegerField(default=0)      # new UIDs returned by SEARCH
+    messages_fetched = models.PositiveIntegerField(default=0)    # stored for this environment
+    extracted = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    email_ids = models.JSONField(default=list, blank=True)       # EnvironmentEmail ids saved by the scan
+    error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"]),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in ("successful", "failed")
+
+    def __str__(self):
+        return f"Scan of {self.environment.name} at {self.created_at} ({self.status})"
+
+
+BATCH_STATUS = (
+    ('submitted', 'Submitted'),
+    ('ingested', 'Ingested'),
+    ('failed', 'Failed'),
+)
+
+class ExtractionBatch(models.Model):
+    """
+    Extractions sent through the OpenAI Batch API (one JSONL file of Responses
+    requests) instead of one synchronous call per document.
+    """
+    environment = models.ForeignKey(
+        Environment,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="extraction_batches"
+    )
+    backend = models.CharField(max_length=20, default="openai")    # "openai" or "local" (offline stand-in)
+    batch_id = models.CharField(max_length=255, blank=True)
+    input_file_id = models.CharField(max_length=255, blank=True)
+    output_file_id = models.CharField(max_length=255, blank=True)
+    error_file_id = models.CharField(max_length=255, blank=True)
+    remote_status = models.CharField(max_length=30, blank=True)    # status reported by the batch endpoint
+    status = models.CharField(max_length=20, choices=BATCH_STATUS, default=BATCH_STATUS[0][0])
+
+    items = models.JSONField(default=list, blank=True)             # custom_ids: "email-<id>" / "upload-<id>"
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    ingested_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"Batch {self.batch_id or self.id} ({len(self.items)} items, {self.status})"
+
+
 class TaskLock(models.Model):
     name = models.CharField(max_length=100, unique=True)
     is_locked = models.BooleanField(default=False)
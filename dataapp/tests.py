@@ -1,3 +1,281 @@
-from django.test import TestCase
+import imaplib
+import json
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from .models import Environment, EnvironmentEmail, ExtractionBatch, ExtractionResult, InternalEmail, Schema
+from .utils import batch_extraction, imap_idle
+from .utils.body_normalizer import normalize_body
 
-# Create your tests here.
+
+# ============================================================
+# FAKE IMAP SERVER
+# ============================================================
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """Just enough IMAP for idle_wait / MailboxWatcher: LOGIN, EXAMINE/SELECT, IDLE, DONE, LOGOUT."""
+
+    def send(self, data):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.handlers.append(self)
+        self.send(b"* OK [CAPABILITY IMAP4rev1 IDLE] fake server ready\r\n")
+        idle_tag = None
+
+        for line in self.rfile:
+            line = line.rstrip(b"\r\n")
+            if idle_tag is not None:
+                self.server.commands.append(line.decode())
+                if line.upper() == b"DONE":
+                    self.send(idle_tag + b" OK IDLE terminated\r\n")
+                    idle_tag = None
+                continue
+
+            tag, _, rest = line.partition(b" ")
+            command = rest.split(b" ")[0].upper()
+            self.server.commands.append(command.decode())
+
+            if command == b"CAPABILITY":
+                self.send(b"* CAPABILITY IMAP4rev1 IDLE\r\n" + tag + b" OK CAPABILITY completed\r\n")
+            elif command in (b"SELECT", b"EXAMINE"):
+                self.send(b"* 2 EXISTS\r\n* OK [UIDVALIDITY 1] UIDs valid\r\n" + tag + b" OK [READ-ONLY] " + command + b" completed\r\n")
+            elif command == b"IDLE":
+                idle_tag = tag
+                # Anything queued for this IDLE goes out in the same packet as the continuation
+                extra = self.server.idle_extra.pop(0) if self.server.idle_extra else b""
+                self.send(b"+ idling\r\n" + extra)
+            elif command == b"LOGOUT":
+                self.send(b"* BYE logging out\r\n" + tag + b" OK LOGOUT completed\r\n")
+                return
+            else:
+                self.send(tag + b" OK " + command + b" completed\r\n")
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, idle_extra=None):
+        super().__init__(("127.0.0.1", 0), FakeIMAPHandler)
+        self.idle_extra = list(idle_extra or [])  # bytes sent with "+ idling", one entry per IDLE
+        self.commands = []
+        self.handlers = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def push(self, data):
+        """Send an unsolicited response to every connected client."""
+        for handler in self.handlers:
+            handler.send(data)
+
+    def connect(self, *args):
+        imap = imaplib.IMAP4("127.0.0.1", self.port)
+        imap.login("user", "password")
+        imap.select("INBOX", readonly=True)
+        return imap
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+# ============================================================
+# IMAP IDLE
+# ============================================================
+
+class IdleWaitTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = FakeIMAPServer()
+        self.addCleanup(self.server.close)
+
+    def test_exists_in_same_packet_as_continuation_wakes_up(self):
+        self.server.idle_extra = [b"* 3 EXISTS\r\n"]
+        imap = self.server.connect()
+
+        started = time.monotonic()
+        self.assertTrue(imap_idle.idle_wait(imap, timeout=10))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(self.server.commands[-2:], ["IDLE", "DONE"])
+
+    def test_exists_pushed_during_idle_wakes_up(self):
+        imap = self.server.connect()
+        threading.Timer(0.3, self.server.push, [b"* 4 EXISTS\r\n"]).start()
+
+        started = time.monotonic()
+        self.assertTrue(imap_idle.idle_wait(imap, timeout=10))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(self.server.commands[-1], "DONE")
+
+    def test_timeout_ends_idle_and_connection_stays_usable(self):
+        imap = self.server.connect()
+
+        self.assertFalse(imap_idle.idle_wait(imap, timeout=0.3))
+        self.assertEqual(self.server.commands[-2:], ["IDLE", "DONE"])
+
+        # The tagged OK for DONE was consumed, so the next command lines up
+        self.assertEqual(imap.noop()[0], "OK")
+        self.server.idle_extra = [b"* 5 EXISTS\r\n"]
+        self.assertTrue(imap_idle.idle_wait(imap, timeout=10))
+
+    def test_stop_event_ends_idle(self):
+        imap = self.server.connect()
+        stop_event = threading.Event()
+        threading.Timer(0.2, stop_event.set).start()
+
+        self.assertFalse(imap_idle.idle_wait(imap, timeout=10, stop_event=stop_event))
+        self.assertEqual(self.server.commands[-1], "DONE")
+
+    def test_bye_during_idle_aborts(self):
+        self.server.idle_extra = [b"* BYE server shutting down\r\n"]
+        imap = self.server.connect()
+
+        with self.assertRaises(imaplib.IMAP4.abort):
+            imap_idle.idle_wait(imap, timeout=10)
+
+
+class MailboxWatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = FakeIMAPServer()
+        self.addCleanup(self.server.close)
+
+    def test_reissues_idle_on_timeout_and_ingests_new_mail(self):
+        self.server.idle_extra = [b"", b"* 3 EXISTS\r\n"]
+        ingested = []
+        watcher = imap_idle.MailboxWatcher(("127.0.0.1", "user", "INBOX"), [1], {}, idle_timeout=0.2)
+
+        with mock.patch.object(imap_idle, "imap_login", self.server.connect), \
+             mock.patch.object(imap_idle.MailboxWatcher, "ingest", lambda self: ingested.append(time.monotonic())):
+            watcher.start()
+            deadline = time.monotonic() + 5
+            while self.server.commands.count("IDLE") < 3 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            watcher.stop()
+            watcher.join(5)
+
+        self.assertFalse(watcher.is_alive())
+        # Catch-up ingest on connect, then one for the EXISTS in the second IDLE
+        self.assertEqual(len(ingested), 2)
+        self.assertGreaterEqual(self.server.commands.count("IDLE"), 3)
+        self.assertEqual(self.server.commands.count("IDLE"), self.server.commands.count("DONE"))
+        self.assertEqual(self.server.commands[-1], "LOGOUT")
+
+
+# ============================================================
+# BODY NORMALIZATION
+# ============================================================
+
+class NormalizeBodyTests(SimpleTestCase):
+
+    def test_reply_header_with_quoted_lines_is_cut(self):
+        body = "Confirmed, thanks.\n\nOn Tue, 2 Oct 2025 at 10:14, Anna <anna@example.com> wrote:\n> PO 4471\n> 12 x pallets\n"
+        self.assertEqual(normalize_body(body, ""), "Confirmed, thanks.")
+
+    def test_original_message_is_cut(self):
+        body = "See below.\n\n-----Original Message-----\nFrom: Anna\nSent: Tuesday\nOld thread\n"
+        self.assertEqual(normalize_body(body, ""), "See below.")
+
+    def test_trailing_signature_is_cut(self):
+        body = "Invoice attached.\n\n-- \nAnna Berg\nNorthwind Foods\n"
+        self.assertEqual(normalize_body(body, ""), "Invoice attached.")
+
+    def test_from_and_date_lines_in_order_are_kept(self):
+        body = (
+            "Hi, new purchase order below.\n\nPURCHASE ORDER\nFrom: Northwind Foods\nDate: 2025-10-02\n"
+            "PO number: 4471\nItem: Olive oil 5L x 12\nTotal: 540.00 EUR\n"
+        )
+        self.assertEqual(normalize_body(body, ""), body.strip())
+
+    def test_line_items_after_underscore_rule_are_kept(self):
+        body = "PURCHASE ORDER 4471\n" + "_" * 40 + "\nOlive oil 5L x 12    540.00\nFlour 25kg x 4    88.00\n"
+        self.assertIn("Flour 25kg x 4", normalize_body(body, ""))
+
+    def test_dash_rule_in_html_body_keeps_rest_of_body(self):
+        rows = "".join(f"<tr><td>Item {n}</td><td>{n}.00</td></tr>" for n in range(1, 16))
+        html = f"<html><body><p>Order 4471</p><p>-- </p><table>{rows}</table><p>Total 120.00</p></body></html>"
+        text = normalize_body("", html)
+        self.assertIn("Item 15 15.00", text)
+        self.assertIn("Total 120.00", text)
+
+
+# ============================================================
+# BATCH EXTRACTION
+# ============================================================
+
+class ExtractionBatchTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.responder = batch_extraction.placeholder_responder
+        patcher = mock.patch.object(
+            batch_extraction, "get_batch_client",
+            lambda backend=None: batch_extraction.LocalBatchClient(directory.name, lambda body: self.responder(body)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        schema = Schema.objects.create(name="Invoice", schema_json={"invoice_number": "string", "total": "float"})
+        self.environment = Environment.objects.create(name="Invoices", schema=schema)
+        self.emails = [self.create_email(n) for n in range(3)]
+
+    def create_email(self, n):
+        internal_email = InternalEmail.objects.create(
+            subject=f"Invoice {n}", sender="billing@example.com", body=f"Invoice body {n}",
+            date_recieved=timezone.now(), message_id=f"<invoice-{n}@example.com>",
+        )
+        return EnvironmentEmail.objects.create(environment=self.environment, internal_email=internal_email)
+
+    def submit(self):
+        items = batch_extraction.collect_batch_items(self.environment)
+        return batch_extraction.submit_extraction_batch(items, environment=self.environment, backend="local")
+
+    def test_poll_creates_extraction_results(self):
+        batch, = self.submit()
+        self.assertEqual(len(batch.items), 3)
+
+        batch_extraction.poll_extraction_batch(batch)
+
+        self.assertEqual((batch.status, batch.succeeded, batch.failed), ("ingested", 3, 0))
+        for env_email in self.emails:
+            env_email.refresh_from_db()
+            self.assertEqual(env_email.status, "successful")
+            raw_json = json.loads(env_email.result.raw_json)
+            self.assertEqual(raw_json["Email ID"], env_email.id)
+        self.assertEqual(ExtractionResult.objects.count(), 3)
+
+    def test_resubmit_skips_batched_and_extracted_items(self):
+        batch, = self.submit()
+        self.assertEqual(self.submit(), [])
+
+        batch_extraction.poll_extraction_batch(batch)
+        new_email = self.create_email(3)
+
+        batch, = self.submit()
+        self.assertEqual(batch.items, [batch_extraction.custom_id_for(new_email)])
+        self.assertEqual(ExtractionBatch.objects.count(), 2)
+
+    def test_error_line_marks_item_failed(self):
+        def responder(body):
+            if "Invoice body 1" in json.dumps(body["input"]):
+                raise RuntimeError("request rejected")
+            return batch_extraction.placeholder_responder(body)
+        self.responder = responder
+
+        batch, = self.submit()
+        batch_extraction.poll_extraction_batch(batch)
+
+        self.assertEqual((batch.succeeded, batch.failed), (2, 1))
+        statuses = [EnvironmentEmail.objects.get(id=env_email.id).status for env_email in self.emails]
+        self.assertEqual(statuses, ["successful", "failed", "successful"])
+        self.assertFalse(ExtractionResult.objects.filter(environment_email=self.emails[1]).exists())
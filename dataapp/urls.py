@@ -13,6 +13,8 @@ urlpatterns = [
     path("environments/<int:env_id>/edit/", views.edit_environment, name="environment_edit"),
     path("environments/<int:env_id>/delete/", views.delete_environment, name="environment_delete"),
     path("api/scan-inbox/<int:env_id>/", views.scan_inbox, name="api_scan_inbox"),
+    path("api/scan-jobs/<int:env_id>/", views.submit_scan_job, name="api_submit_scan_job"),
+    path("api/scan-jobs/status/<int:job_id>/", views.scan_job_status, name="api_scan_job_status"),
     path("api/emails/<int:env_id>/", views.list_emails, name="api_list_emails"),
     path("api/emails/<int:email_id>/reprocess/", views.reprocess_email, name="api_reprocess_email"),
     path("api/reprocess-failed/<int:env_id>/", views.reprocess_all_failed, name="api_reprocess_failed"),
@@ -21,6 +23,7 @@ urlpatterns = [
     path("api/uploads/<int:env_id>/upload/", views.upload_files, name="api_new_upload"),
     path("api/uploads/<int:upload_id>/delete/", views.delete_upload, name="api_delete_upload"),
     path("api/uploads/<int:upload_id>/rename/", views.rename_upload, name="api_rename_upload"),
+    path("attachments/<str:signature>/<path:name>", views.attachment_file, name="attachment_file"),
     path("api/uploads/<int:upload_id>/reprocess/", views.reprocess_upload, name="api_reprocess_upload"),
     path("api/uploads/reprocess-failed/<int:env_id>/", views.reprocess_all_failed_uploads, name="api_reprocess_failed_uploads"),
     path("schemas/", views.list_schemas, name="schema_list"),
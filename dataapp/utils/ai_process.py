@@ -5,10 +5,12 @@ from functools import wraps
 from pydantic import ValidationError
 from ..models import ExtractionResult
 from django.db import IntegrityError
-from .schema import pydantic_to_jsonschema, build_pydantic_model
+from .schema_cache import get_compiled_schema
 from openai import OpenAI
 from django.conf import settings
 from .email_monitor import MAX_OPENAI_FILE_SIZE, format_bytes
+from .run_metrics import record_retry
+from .attachment_storage import storage_for_url, inline_data_url
 
 logger = logging.getLogger("email_monitor")
 
@@ -20,6 +22,8 @@ client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
 SUPPORTED_EXTENSIONS = [".pdf", ".png", ".jpg", ".jpeg", ".webp", ".txt"]
 
+AI_MODEL = getattr(settings, "AI_MODEL", "gpt-5-nano")
+
 # -----------------------
 # Retry + Exceptions
 # -----------------------
@@ -51,6 +55,7 @@ def retry(max_retries=3, delay=2, backoff=2, critical=False):
                 except Exception as e:
                     last_exc = e
                     attempt += 1
+                    record_retry(func.__name__)
                     logger.warning(
                         f"[AI Retry {attempt}/{max_retries}] {func.__name__} failed: {e}"
                     )
@@ -75,14 +80,11 @@ def retry(max_retries=3, delay=2, backoff=2, critical=False):
 # AI processing
 # -----------------------
 
-@retry(max_retries=3, delay=2, backoff=2, critical=True)
-def process_order_with_ai(email_body: str, attachments: list, environment):
+def build_extraction_request(email_body: str, attachments: list, environment):
     """
-    Send email body + attachments to OpenAI and return the raw AI output text (string).
-    This is marked critical: if it fails after retries, the calling code must NOT mark email processed.
-    NOTE: file streaming and structured output usage kept exactly as requested.
+    The Responses API request body (model, input messages, structured output
+    format) for one document. Used for direct calls and for batch files.
     """
-
     logger.info("Starting AI processing for email.")
     logger.debug("Email body length: %d", len(email_body or ""))
     
@@ -105,7 +107,16 @@ If provided content isn't exactly the document type you determined, set fail rea
     ]
 
     # Attach files (preserve your existing logic and streaming approach)
+    seen_hashes = set()
     for att in attachments or []:
+        # Same bytes attached twice (e.g. inline + attachment) → send once
+        sha256 = att.get("sha256")
+        if sha256:
+            if sha256 in seen_hashes:
+                logger.info("Skipping duplicate attachment: %s", att.get("filename"))
+                continue
+            seen_hashes.add(sha256)
+
         # att expected: dict with keys "file_path" or "url" depending on your storage.
         file_path = att.get("file_path") or ""
         # In DEBUG you store local paths like "media/..."; keep same behavior:
@@ -119,6 +130,14 @@ If provided content isn't exactly the document type you determined, set fail rea
             logger.info("Skipping unsupported attachment extension: %s", ext)
             continue
 
+        # For images, the pre-processed (smaller) copy when there is one
+        if ext not in [".pdf", ".txt"] and att.get("ai_file_path"):
+            file_path = att["ai_file_path"]
+
+        # Files OpenAI cannot download (local storage without a public URL) are sent inline
+        storage = storage_for_url(file_path)
+        inline = storage is not None and not storage.fetchable
+
         # For images (non-pdf/txt), you used input_image
         if ext not in [".pdf", ".txt"]:
             messages.append({
@@ -126,11 +145,22 @@ If provided content isn't exactly the document type you determined, set fail rea
                 "content": [
                     {
                         "type": "input_image",
-                        "image_url": file_path,
+                        "image_url": inline_data_url(file_path) if inline else file_path,
                         "detail": "low"
                     }
                 ]
             })
+        elif inline:
+            messages.append({
+                "role": "user",
+                "content": [
+                    {
+                        "type": "input_file",
+                        "filename": att.get("filename") or file_path.rsplit("/", 1)[-1],
+                        "file_data": inline_data_url(file_path, att.get("filename"))
+                    }
+                ]
+            })
         else:
             messages.append({
                 "role": "user",
@@ -142,21 +172,29 @@ If provided content isn't exactly the document type you determined, set fail rea
                 ]
             })
 
-    # Convert Pydantic dynamic model to jsonschema (you said keep this behavior)
-    environment_schema = environment.schema.schema_json
-    PydanticModel = build_pydantic_model("ParseSchemaModel", environment_schema, allow_null=False, include_fail_reason=True)
-    schema = pydantic_to_jsonschema(PydanticModel, "ParseSchema", allow_null=False)
-    
-    print("OPENAI SCHEMA:", schema)
+    # Pydantic model → OpenAI jsonschema, compiled once per schema version
+    schema = get_compiled_schema(environment.schema).text_format
+    logger.debug("OpenAI schema for %s: %s", environment, schema)
+
+    return {
+        "model": AI_MODEL,
+        "input": messages,
+        "text": schema
+    }
 
-    logger.debug("Sending request to OpenAI (model=gpt-5-nano). Schema length: %d", len(schema))
+@retry(max_retries=3, delay=2, backoff=2, critical=True)
+def process_order_with_ai(email_body: str, attachments: list, environment):
+    """
+    Send email body + attachments to OpenAI and return the raw AI output text (string).
+    This is marked critical: if it fails after retries, the calling code must NOT mark email processed.
+    NOTE: file streaming and structured output usage kept exactly as requested.
+    """
+    request = build_extraction_request(email_body, attachments, environment)
+
+    logger.debug("Sending request to OpenAI (model=%s). Schema length: %d", AI_MODEL, len(request["text"]))
 
     # The call below keeps your original usage; we wrap in retry decorator so network/AI failures are retried.
-    response = client.responses.create(
-        model="gpt-5-nano",
-        input=messages,
-        text=schema
-    )
+    response = client.responses.create(**request)
 
     logger.debug("OpenAI response received: %s", getattr(response, "status", "no-status"))
 
@@ -217,7 +255,7 @@ def process_email(env_email_obj):
     logger.info("Starting AI parse for environment email id=%s subject='%s'", getattr(env_email_obj, "id", None), email_obj.subject)
 
     try:
-        ai_output_text = process_order_with_ai(email_body=email_obj.body or "", attachments=email_obj.attachments or [], environment=env_email_obj.environment)
+        ai_output_text = process_order_with_ai(email_body=email_obj.body or "", attachments=env_email_obj.get_attachments() or [], environment=env_email_obj.environment)
         logger.debug("AI raw output: %.1000s", ai_output_text[:1000] if ai_output_text else "")
 
     except CriticalRetryError as cre:
@@ -238,19 +276,17 @@ def process_email(env_email_obj):
         logger.exception("Unexpected error calling AI for environment email id=%s: %s", getattr(env_email_obj, "id", None), e)
         return False
 
-    # ai_output_text must be JSON parsable (your original flow)
-    try:
-        parsed_dict = json.loads(ai_output_text)
-    except Exception as e:
-        logger.exception("AI output JSON parse failed for environment email id=%s: %s", getattr(env_email_obj, "id", None), e)
-        # Treat as critical — do NOT mark processed
-        return False
+    return save_email_extraction(env_email_obj, ai_output_text)
+
 
-    # Validate with DynamicModel (this can raise ValidationError)
+def save_email_extraction(env_email_obj, ai_output_text):
+    """
+    Validate the AI output of one environment email and persist it (status + ExtractionResult).
+    Shared by direct processing and batch ingestion. Return: True on success, False otherwise.
+    """
+    # Parse + validate the AI text in one pass with the cached model (invalid JSON is a ValidationError too)
     try:
-        environment_schema = env_email_obj.environment.schema.schema_json
-        PydanticModel = build_pydantic_model("ParseSchemaModel", environment_schema, allow_null=False, include_fail_reason=True)
-        parsed_obj = PydanticModel(**parsed_dict)
+        parsed_obj = get_compiled_schema(env_email_obj.environment.schema).validate(ai_output_text)
     except ValidationError as ve:
         logger.error("AI output failed Pydantic validation for environment email id=%s: %s", getattr(env_email_obj, "id", None), ve, exc_info=True)
         # Strict mode -> do not mark processed
@@ -340,19 +376,17 @@ def process_upload(env_upload_obj):
         logger.exception("Unexpected error calling AI for environment upload id=%s: %s", getattr(env_upload_obj, "id", None), e)
         return False
 
-    # ai_output_text must be JSON parsable (your original flow)
-    try:
-        parsed_dict = json.loads(ai_output_text)
-    except Exception as e:
-        logger.exception("AI output JSON parse failed for environment upload id=%s: %s", getattr(env_upload_obj, "id", None), e)
-        # Treat as critical — do NOT mark processed
-        return False
+    return save_upload_extraction(env_upload_obj, ai_output_text)
+
 
-    # Validate with DynamicModel (this can raise ValidationError)
+def save_upload_extraction(env_upload_obj, ai_output_text):
+    """
+    Validate the AI output of one environment upload and persist it (status + ExtractionResult).
+    Shared by direct processing and batch ingestion. Return: True on success, False otherwise.
+    """
+    # Parse + validate the AI text in one pass with the cached model (invalid JSON is a ValidationError too)
     try:
-        environment_schema = env_upload_obj.environment.schema.schema_json
-        PydanticModel = build_pydantic_model("ParseSchemaModel", environment_schema, allow_null=False, include_fail_reason=True)
-        parsed_obj = PydanticModel(**parsed_dict)
+        parsed_obj = get_compiled_schema(env_upload_obj.environment.schema).validate(ai_output_text)
     except ValidationError as ve:
         logger.error("AI output failed Pydantic validation for environment upload id=%s: %s", getattr(env_upload_obj, "id", None), ve, exc_info=True)
         # Strict mode -> do not mark processed
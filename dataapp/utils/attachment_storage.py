@@ -0,0 +1,286 @@
+import base64
+import io
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import urllib.parse
+import urllib.request
+from functools import lru_cache
+import cloudinary.uploader
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# "cloudinary", "local", or the dotted path of an AttachmentStorage subclass
+ATTACHMENT_STORAGE_BACKEND = getattr(settings, "ATTACHMENT_STORAGE_BACKEND", "cloudinary")
+
+# Directory the local backend writes to
+ATTACHMENT_LOCAL_ROOT = getattr(settings, "ATTACHMENT_LOCAL_ROOT", os.path.join(settings.BASE_DIR, "attachment_store"))
+
+# Prefix for local attachment URLs, e.g. "https://mail.example.com". Without one the URLs are
+# relative and attachments are sent to OpenAI inline instead of by URL.
+ATTACHMENT_PUBLIC_BASE_URL = getattr(settings, "ATTACHMENT_PUBLIC_BASE_URL", "").rstrip("/")
+
+# Attachments larger than this are streamed to Cloudinary in chunks of this size (Cloudinary minimum: 5MB)
+ATTACHMENT_UPLOAD_CHUNK_SIZE = getattr(settings, "ATTACHMENT_UPLOAD_CHUNK_SIZE", 1024 ** 2 * 6) # 6MB
+
+# Seconds to wait when reading an attachment back from a remote backend
+ATTACHMENT_READ_TIMEOUT = getattr(settings, "ATTACHMENT_READ_TIMEOUT", 60)
+
+ATTACHMENT_FOLDER = "email_attachments"
+ATTACHMENT_URL_SALT = "dataapp.attachment-url"
+COPY_CHUNK_SIZE = 1024 * 1024 # 1MB
+
+
+# ============================================================
+# HELPERS
+# ============================================================
+
+def payload_size(data):
+    """Size in bytes of an attachment payload (bytes or a seekable / spooled file)."""
+    if hasattr(data, "read"):
+        data.seek(0, os.SEEK_END)
+        size = data.tell()
+        data.seek(0)
+        return size
+    return len(data)
+
+
+class NonClosingReader:
+    """
+    Read-only view of a file that ignores close(): upload_large() closes the
+    file it is given, but the caller still owns it (and may retry with it).
+    """
+
+    def __init__(self, file, name):
+        self.file = file
+        self.name = name
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+# ============================================================
+# BACKENDS
+# ============================================================
+
+class AttachmentStorage:
+    """
+    Where attachment bytes live. A backend hands out URLs from save() and
+    can read back and delete the URLs it handed out.
+    """
+
+    # Remote services (OpenAI) can download this backend's URLs themselves
+    fetchable = True
+
+    def save(self, name, data, resource_type="raw"):
+        """Store `data` (bytes or a seekable file) as `name`. Returns (url, size)."""
+        raise NotImplementedError
+
+    def open(self, url):
+        """Binary file object with the stored bytes (the caller closes it)."""
+        raise NotImplementedError
+
+    def delete(self, url):
+        """Remove the stored file. Returns True if something was deleted."""
+        raise NotImplementedError
+
+    def owns(self, url):
+        """True if `url` was handed out by this backend."""
+        raise NotImplementedError
+
+
+class CloudinaryAttachmentStorage(AttachmentStorage):
+    """Cloudinary uploads: raw resources for PDF / text, image resources otherwise."""
+
+    URL_PATTERN = re.compile(r"^https?://res\.cloudinary\.com/[^/]+/(image|raw|video)/upload/(?:v\d+/)?(.+)$")
+
+    def save(self, name, data, resource_type="raw"):
+        options = {
+            "filename": name,
+            "folder": ATTACHMENT_FOLDER,
+            "resource_type": resource_type,
+            "use_filename": True,
+            "unique_filename": False,
+            "overwrite": False,
+        }
+
+        if hasattr(data, "read"):
+            data.seek(0)
+
+        # Anything over one chunk is streamed, so memory per upload stays at one chunk
+        if payload_size(data) > ATTACHMENT_UPLOAD_CHUNK_SIZE:
+            stream = NonClosingReader(data if hasattr(data, "read") else io.BytesIO(data), name)
+            res = cloudinary.uploader.upload_large(stream, chunk_size=ATTACHMENT_UPLOAD_CHUNK_SIZE, **options)
+        else:
+            res = cloudinary.uploader.upload(data, **options)
+        return res.get("secure_url") or res.get("url"), res.get("bytes")
+
+    def open(self, url):
+        return urllib.request.urlopen(url, timeout=ATTACHMENT_READ_TIMEOUT)
+
+    def delete(self, url):
+        match = self.URL_PATTERN.match(url or "")
+        if not match:
+            return False
+        resource_type, public_id = match.groups()
+        if resource_type != "raw":
+            # Image / video public IDs do not include the format
+            public_id = os.path.splitext(public_id)[0]
+        res = cloudinary.uploader.destroy(public_id, resource_type=resource_type, invalidate=True)
+        return res.get("result") == "ok"
+
+    def owns(self, url):
+        return bool(self.URL_PATTERN.match(url or ""))
+
+
+class LocalAttachmentStorage(AttachmentStorage):
+    """
+    Files under ATTACHMENT_LOCAL_ROOT, served by the attachment_file view.
+    URLs carry a signature of the file name, so they cannot be forged to
+    read anything else. Names are content-addressed: an existing file with
+    the same name already holds the same bytes and is not written again.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.realpath(root or ATTACHMENT_LOCAL_ROOT)
+        self.signer = signing.Signer(salt=ATTACHMENT_URL_SALT)
+
+    @property
+    def fetchable(self):
+        return bool(ATTACHMENT_PUBLIC_BASE_URL)
+
+    def path(self, name):
+        path = os.path.realpath(os.path.join(self.root, name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"Attachment name escapes the storage root: {name}")
+        return path
+
+    def signature(self, name):
+        return self.signer.signature(name)
+
+    def url(self, name):
+        return ATTACHMENT_PUBLIC_BASE_URL + reverse("attachment_file", args=[self.signature(name), name])
+
+    def verified_name(self, signature, name):
+        """`name` if `signature` is valid for it, else None."""
+        if constant_time_compare(signature, self.signature(name)):
+            return name
+        return None
+
+    def name_from_url(self, url):
+        prefix = ATTACHMENT_PUBLIC_BASE_URL + reverse("attachment_file", args=["SIG", "NAME"])[:-len("SIG/NAME")]
+        if not (url or "").startswith(prefix):
+            return None
+        signature, _, name = url[len(prefix):].partition("/")
+        return self.verified_name(signature, urllib.parse.unquote(name))
+
+    def save(self, name, data, resource_type="raw"):
+        relative = f"{ATTACHMENT_FOLDER}/{name}"
+        path = self.path(relative)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file first: readers never see a half-written attachment
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    if hasattr(data, "read"):
+                        data.seek(0)
+                        shutil.copyfileobj(data, out, COPY_CHUNK_SIZE)
+                    else:
+                        out.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+
+        return self.url(relative), os.path.getsize(path)
+
+    def open(self, url):
+        name = self.name_from_url(url)
+        if name is None:
+            raise FileNotFoundError(f"Not a local attachment URL: {url}")
+        return open(self.path(name), "rb")
+
+    def delete(self, url):
+        name = self.name_from_url(url)
+        if name is None:
+            return False
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def owns(self, url):
+        return self.name_from_url(url) is not None
+
+
+ATTACHMENT_STORAGE_BACKENDS = {
+    "cloudinary": CloudinaryAttachmentStorage,
+    "local": LocalAttachmentStorage,
+}
+
+
+# ============================================================
+# LOOKUP
+# ============================================================
+
+@lru_cache(maxsize=None)
+def get_attachment_storage(backend=None):
+    """The configured backend (ATTACHMENT_STORAGE_BACKEND), or `backend` by name / dotted path."""
+    backend = backend or ATTACHMENT_STORAGE_BACKEND
+    storage_class = ATTACHMENT_STORAGE_BACKENDS.get(backend) or import_string(backend)
+    return storage_class()
+
+def storage_for_url(url):
+    """
+    Backend that handed out `url`. Attachments saved before a deployment
+    switched backends stay readable and deletable through their old one.
+    """
+    configured = get_attachment_storage()
+    if configured.owns(url):
+        return configured
+    for name in ATTACHMENT_STORAGE_BACKENDS:
+        storage = get_attachment_storage(name)
+        if storage.owns(url):
+            return storage
+    return None
+
+def inline_data_url(url, filename=None):
+    """The stored file as a base64 data: URL (for attachments remote services cannot download)."""
+    storage = storage_for_url(url)
+    if storage is None:
+        raise FileNotFoundError(f"No attachment storage serves {url}")
+    mime_type = mimetypes.guess_type(filename or url)[0] or "application/octet-stream"
+    with storage.open(url) as f:
+        encoded = base64.b64encode(f.read()).decode("ascii")
+    return f"data:{mime_type};base64,{encoded}"
@@ -0,0 +1,391 @@
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+from django.conf import settings
+from django.utils import timezone
+from ..models import EnvironmentEmail, EnvironmentUpload, ExtractionBatch
+from .email_monitor import MAX_OPENAI_FILE_SIZE
+from .ai_process import build_extraction_request, save_email_extraction, save_upload_extraction
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# "openai", or "local" for the offline stand-in (tests, development)
+AI_BATCH_BACKEND = getattr(settings, "AI_BATCH_BACKEND", "openai")
+
+# A batch file is split once it holds this many requests / bytes (OpenAI allows 50,000 / 200MB)
+AI_BATCH_MAX_REQUESTS = getattr(settings, "AI_BATCH_MAX_REQUESTS", 1000)
+AI_BATCH_MAX_BYTES = getattr(settings, "AI_BATCH_MAX_BYTES", 1024 ** 2 * 190) # 190MB
+
+# Seconds between status checks when waiting for a batch
+AI_BATCH_POLL_INTERVAL = getattr(settings, "AI_BATCH_POLL_INTERVAL", 60)
+
+# Directory the local stand-in keeps its files and batches in
+AI_BATCH_LOCAL_DIR = getattr(settings, "AI_BATCH_LOCAL_DIR", os.path.join(settings.BASE_DIR, "batch_store"))
+
+AI_BATCH_ENDPOINT = "/v1/responses"
+AI_BATCH_COMPLETION_WINDOW = "24h"
+
+# Batch endpoint statuses after which nothing changes any more
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+# ============================================================
+# LOCAL STAND-IN FOR THE BATCH ENDPOINT
+# ============================================================
+
+def placeholder_value(schema, name=""):
+    """Empty value of the right JSON type for a structured-output schema."""
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), "null")
+    if kind == "object":
+        return {key: placeholder_value(sub, key) for key, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return []
+    if kind in ("number", "integer"):
+        return 0
+    if kind == "boolean":
+        return False
+    if kind == "null":
+        return None
+    if name == "fail reason":
+        return "Answered by the local batch stand-in; no model was called."
+    return ""
+
+def placeholder_responder(body):
+    """Default local answer: a schema-valid document with every field empty."""
+    return json.dumps(placeholder_value(body["text"]["format"]["schema"]))
+
+
+class LocalBatchClient:
+    """
+    Offline stand-in for the parts of the OpenAI client batch mode uses:
+    files.create / files.content and batches.create / batches.retrieve.
+    A batch completes on its first retrieve(); every request is answered by
+    responder(body) -> output text (an exception becomes an error line).
+    """
+
+    def __init__(self, directory=None, responder=None):
+        self.directory = directory or AI_BATCH_LOCAL_DIR
+        self.responder = responder or placeholder_responder
+        os.makedirs(self.directory, exist_ok=True)
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_file(self, data):
+        file_id = f"file-local-{uuid.uuid4().hex}"
+        with open(self.path(f"{file_id}.jsonl"), "wb") as f:
+            f.write(data)
+        return file_id
+
+    def create_file(self, file, purpose="batch"):
+        _, content = file
+        data = content.read() if hasattr(content, "read") else content
+        return SimpleNamespace(id=self.write_file(data), purpose=purpose)
+
+    def file_content(self, file_id):
+        with open(self.path(f"{file_id}.jsonl"), "rb") as f:
+            data = f.read()
+        return SimpleNamespace(content=data, text=data.decode("utf-8"))
+
+    def create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch = {
+            "id": f"batch-local-{uuid.uuid4().hex}",
+            "status": "validating",
+            "input_file_id": input_file_id,
+            "endpoint": endpoint,
+            "output_file_id": None,
+            "error_file_id": None,
+        }
+        self.store_batch(batch)
+        return self.batch_object(batch)
+
+    def retrieve_batch(self, batch_id):
+        with open(self.path(f"{batch_id}.json")) as f:
+            batch = json.load(f)
+        if batch["status"] not in TERMINAL_STATUSES:
+            self.run_batch(batch)
+        return self.batch_object(batch)
+
+    def run_batch(self, batch):
+        outputs, errors = [], []
+        for line in self.file_content(batch["input_file_id"]).text.splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                text = self.responder(request["body"])
+            except Exception as e:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": None,
+                               "error": {"code": "local_error", "message": str(e)}})
+                continue
+            outputs.append({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": {
+                        "id": f"resp_local_{uuid.uuid4().hex}",
+                        "object": "response",
+                        "status": "completed",
+                        "model": request["body"].get("model"),
+                        "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}],
+                    },
+                },
+                "error": None,
+            })
+
+        def to_jsonl(lines):
+            return "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+
+        batch["status"] = "completed"
+        batch["output_file_id"] = self.write_file(to_jsonl(outputs)) if outputs else None
+        batch["error_file_id"] = self.write_file(to_jsonl(errors)) if errors else None
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        self.store_batch(batch)
+
+    def store_batch(self, batch):
+        with open(self.path(f"{batch['id']}.json"), "w") as f:
+            json.dump(batch, f)
+
+    def batch_object(self, batch):
+        return SimpleNamespace(
+            id=batch["id"],
+            status=batch["status"],
+            output_file_id=batch.get("output_file_id"),
+            error_file_id=batch.get("error_file_id"),
+            errors=None,
+        )
+
+
+def get_batch_client(backend=None):
+    if (backend or AI_BATCH_BACKEND) == "local":
+        return LocalBatchClient()
+    from .ai_process import client
+    return client
+
+
+# ============================================================
+# BUILDING AND SUBMITTING BATCHES
+# ============================================================
+
+def custom_id_for(item):
+    return f"{'email' if isinstance(item, EnvironmentEmail) else 'upload'}-{item.id}"
+
+def item_for_custom_id(custom_id):
+    """The EnvironmentEmail / EnvironmentUpload a batch line belongs to (None if it is gone)."""
+    kind, _, item_id = (custom_id or "").partition("-")
+    if kind == "email":
+        return EnvironmentEmail.objects.select_related("environment__schema", "internal_email").filter(id=item_id).first()
+    if kind == "upload":
+        return EnvironmentUpload.objects.select_related("environment__schema").filter(id=item_id).first()
+    return None
+
+def batched_custom_ids():
+    """custom_ids already waiting in a submitted batch (never sent twice)."""
+    ids = set()
+    for items in ExtractionBatch.objects.filter(status="submitted").values_list("items", flat=True):
+        ids.update(items)
+    return ids
+
+def collect_batch_items(environment, statuses=("pending", "failed")):
+    """Emails and uploads of `environment` that still need extraction."""
+    items = list(
+        environment.environment_emails.filter(status__in=statuses, result__isnull=True)
+        .select_related("environment__schema", "internal_email").order_by("id")
+    )
+    items += list(
+        environment.environment_uploads.filter(status__in=statuses, result__isnull=True)
+        .select_related("environment__schema").order_by("id")
+    )
+    return items
+
+def batch_request_line(item):
+    """One JSONL line: the same request process_order_with_ai would send for this item."""
+    if isinstance(item, EnvironmentEmail):
+        body, attachments = item.internal_email.body or "", item.get_attachments() or []
+    else:
+        body, attachments = "", item.attachments or []
+    return {
+        "custom_id": custom_id_for(item),
+        "method": "POST",
+        "url": AI_BATCH_ENDPOINT,
+        "body": build_extraction_request(email_body=body, attachments=attachments, environment=item.environment),
+    }
+
+def submit_extraction_batch(items, environment=None, backend=None):
+    """
+    Send `items` (EnvironmentEmail / EnvironmentUpload) to the batch endpoint,
+    split into files of at most AI_BATCH_MAX_REQUESTS requests / AI_BATCH_MAX_BYTES.
+    Items already extracted, already waiting in a batch, or over the OpenAI
+    file limit are skipped. Returns the ExtractionBatch rows created.
+    """
+    backend = backend or AI_BATCH_BACKEND
+    client = get_batch_client(backend)
+    in_batch = batched_custom_ids()
+    batches = []
+    chunk, chunk_ids, chunk_bytes = None, [], 0
+
+    def flush():
+        nonlocal chunk, chunk_ids, chunk_bytes
+        if chunk_ids:
+            batches.append(send_batch_file(client, backend, chunk, chunk_ids, environment))
+        chunk, chunk_ids, chunk_bytes = None, [], 0
+
+    for item in items:
+        if hasattr(item, "result") or custom_id_for(item) in in_batch:
+            continue
+        size = item.internal_email.total_file_size if isinstance(item, EnvironmentEmail) else item.total_file_size
+        if size > MAX_OPENAI_FILE_SIZE:
+            logger.info(f"[AI BATCH] Skipping {custom_id_for(item)}: attachments exceed the OpenAI limit.")
+            continue
+
+        line = (json.dumps(batch_request_line(item)) + "\n").encode("utf-8")
+        if chunk_ids and (len(chunk_ids) >= AI_BATCH_MAX_REQUESTS or chunk_bytes + len(line) > AI_BATCH_MAX_BYTES):
+            flush()
+        if chunk is None:
+            chunk = tempfile.SpooledTemporaryFile(max_size=1024 ** 2 * 8)
+        chunk.write(line)
+        chunk_ids.append(custom_id_for(item))
+        chunk_bytes += len(line)
+
+    flush()
+    return batches
+
+def send_batch_file(client, backend, chunk, custom_ids, environment=None):
+    chunk.seek(0)
+    try:
+        input_file = client.files.create(file=("extraction_batch.jsonl", chunk), purpose="batch")
+        remote = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=AI_BATCH_ENDPOINT,
+            completion_window=AI_BATCH_COMPLETION_WINDOW,
+        )
+    finally:
+        chunk.close()
+
+    batch = ExtractionBatch.objects.create(
+        environment=environment,
+        backend=backend,
+        batch_id=remote.id,
+        input_file_id=input_file.id,
+        remote_status=remote.status,
+        items=custom_ids,
+    )
+    logger.info(f"[AI BATCH] Submitted batch {remote.id} with {len(custom_ids)} requests.")
+    return batch
+
+
+# ============================================================
+# POLLING AND INGESTION
+# ============================================================
+
+def batch_output_text(body):
+    """Output text of a Responses API body from a batch output line."""
+    for output in (body or {}).get("output") or []:
+        if output.get("type") != "message":
+            continue
+        for content in output.get("content") or []:
+            if content.get("type") == "output_text" and content.get("text"):
+                return content["text"]
+    return None
+
+def read_batch_lines(client, file_id):
+    if not file_id:
+        return []
+    text = client.files.content(file_id).text
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def mark_failed(item):
+    """Same status as a critical AI failure in process_email / process_upload."""
+    item.status = "failed"
+    item.save(update_fields=["status"])
+
+def ingest_batch_results(batch, client):
+    """
+    Validate and persist every answered request through save_email_extraction /
+    save_upload_extraction. Requests the endpoint failed mark their item failed,
+    like a critical AI failure; output that fails validation leaves the status
+    as it is, like process_email does.
+    """
+    succeeded = failed = 0
+
+    for line in read_batch_lines(client, batch.output_file_id) + read_batch_lines(client, batch.error_file_id):
+        item = item_for_custom_id(line.get("custom_id"))
+        if item is None:
+            continue
+
+        response = line.get("response") or {}
+        text = batch_output_text(response.get("body")) if response.get("status_code") == 200 else None
+        if text is None:
+            logger.error(f"[AI BATCH] {line.get('custom_id')} failed in batch {batch.batch_id}: {line.get('error') or response.get('body')}")
+            mark_failed(item)
+            failed += 1
+            continue
+
+        save = save_email_extraction if isinstance(item, EnvironmentEmail) else save_upload_extraction
+        if save(item, text):
+            succeeded += 1
+        else:
+            failed += 1
+
+    batch.succeeded, batch.failed = succeeded, failed
+    batch.ingested_at = timezone.now()
+    logger.info(f"[AI BATCH] Ingested batch {batch.batch_id}: {succeeded} extracted, {failed} failed.")
+
+def poll_extraction_batch(batch):
+    """Refresh a submitted batch; once the endpoint is done, ingest its results. Returns the batch."""
+    if batch.status != "submitted":
+        return batch
+
+    client = get_batch_client(batch.backend)
+    remote = client.batches.retrieve(batch.batch_id)
+    batch.remote_status = remote.status or ""
+
+    if remote.status in TERMINAL_STATUSES:
+        batch.output_file_id = remote.output_file_id or ""
+        batch.error_file_id = remote.error_file_id or ""
+        # Expired / cancelled batches may still hold the requests that finished in time
+        ingest_batch_results(batch, client)
+        if remote.status == "completed":
+            batch.status = "ingested"
+        else:
+            batch.status = "failed"
+            batch.error = str(getattr(remote, "errors", None) or f"Batch ended as '{remote.status}'.")
+
+    batch.save()
+    return batch
+
+def poll_open_batches():
+    """Poll every submitted batch once. Returns the batches that finished."""
+    finished = []
+    for batch in ExtractionBatch.objects.filter(status="submitted").order_by("created_at"):
+        try:
+            if poll_extraction_batch(batch).status != "submitted":
+                finished.append(batch)
+        except Exception as e:
+            logger.error(f"[AI BATCH] Could not poll batch {batch.batch_id}: {e}", exc_info=True)
+    return finished
+
+def wait_for_batches(batches, poll_interval=AI_BATCH_POLL_INTERVAL, timeout=None):
+    """Poll `batches` until they have all finished (or `timeout` seconds passed)."""
+    started = time.monotonic()
+    pending = list(batches)
+    while pending:
+        pending = [batch for batch in pending if poll_extraction_batch(batch).status == "submitted"]
+        if not pending or (timeout and time.monotonic() - started >= timeout):
+            break
+        time.sleep(poll_interval)
+    return pending
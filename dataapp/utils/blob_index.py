@@ -0,0 +1,57 @@
+import hashlib
+import logging
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from ..models import AttachmentBlob
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Reuse the stored file when an attachment's bytes were seen before
+ATTACHMENT_DEDUPE = getattr(settings, "ATTACHMENT_DEDUPE", True)
+
+HASH_CHUNK_SIZE = 1024 * 1024 # 1MB
+
+
+# ============================================================
+# CONTENT-ADDRESSED BLOB INDEX
+# ============================================================
+
+def hash_attachment(data):
+    """SHA-256 hex digest of bytes or of a file (read in chunks, rewound afterwards)."""
+    digest = hashlib.sha256()
+    if hasattr(data, "read"):
+        data.seek(0)
+        for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        data.seek(0)
+    else:
+        digest.update(data)
+    return digest.hexdigest()
+
+def find_blob(sha256):
+    """The stored blob for this hash (counting the hit), or None."""
+    blob = AttachmentBlob.objects.filter(sha256=sha256).first()
+    if blob is not None:
+        AttachmentBlob.objects.filter(id=blob.id).update(hits=F("hits") + 1, last_used_at=timezone.now())
+    return blob
+
+def record_blob(sha256, file_path, file_size, extension="", ai_file_path=""):
+    """Index a freshly stored file. If another worker indexed the same bytes first, theirs is kept."""
+    try:
+        blob, _ = AttachmentBlob.objects.get_or_create(
+            sha256=sha256,
+            defaults={"file_path": file_path, "file_size": file_size or 0, "extension": extension, "ai_file_path": ai_file_path or ""},
+        )
+    except IntegrityError:
+        blob = AttachmentBlob.objects.get(sha256=sha256)
+    return blob
+
+def record_ai_image(sha256, ai_file_path):
+    """Remember the model-sized copy of an already indexed image."""
+    AttachmentBlob.objects.filter(sha256=sha256).update(ai_file_path=ai_file_path)
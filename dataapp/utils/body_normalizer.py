@@ -0,0 +1,180 @@
+import logging
+import re
+import lxml.html
+from lxml import etree
+from bs4 import BeautifulSoup
+from django.conf import settings
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Max characters of normalized body stored on InternalEmail / sent to the AI (0 = no limit)
+EMAIL_BODY_MAX_CHARS = getattr(settings, "EMAIL_BODY_MAX_CHARS", 20000)
+
+# Only this many characters of a raw text/HTML body are parsed (huge newsletters)
+EMAIL_BODY_INPUT_MAX_CHARS = getattr(settings, "EMAIL_BODY_INPUT_MAX_CHARS", 1024 ** 2 * 2)
+
+# Drop quoted replies and signatures (forwarded messages are always kept)
+EMAIL_STRIP_QUOTED_REPLIES = getattr(settings, "EMAIL_STRIP_QUOTED_REPLIES", True)
+
+TRUNCATION_MARKER = "\n[... truncated]"
+
+# Elements whose content never reaches the text
+SKIPPED_TAGS = ("script", "style", "head", "title", "noscript", "template", "svg")
+
+# Elements that start a new line
+BLOCK_TAGS = frozenset((
+    "p", "div", "br", "tr", "li", "ul", "ol", "table", "h1", "h2", "h3", "h4", "h5", "h6",
+    "blockquote", "pre", "hr", "section", "article", "header", "footer", "address", "dd", "dt",
+))
+
+# Mail client markup for quoted replies and signatures
+QUOTE_XPATH = (
+    "//blockquote[@type='cite']"
+    " | //div[contains(concat(' ', normalize-space(@class), ' '), ' gmail_quote ')]"
+    " | //div[contains(concat(' ', normalize-space(@class), ' '), ' gmail_signature ')]"
+    " | //div[contains(concat(' ', normalize-space(@class), ' '), ' yahoo_quoted ')]"
+    " | //div[contains(concat(' ', normalize-space(@class), ' '), ' moz-cite-prefix ')]"
+    " | //div[contains(concat(' ', normalize-space(@class), ' '), ' moz-signature ')]"
+)
+# Outlook puts the quoted thread after a header block, as siblings rather than children:
+# everything from the marker to the end of the document is cut
+QUOTE_CUT_XPATH = "//div[@id='appendonsend'] | //div[@id='divRplyFwdMsg']"
+FORWARD_MARKER_PATTERN = re.compile(r"-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:", re.IGNORECASE)
+
+# Plain-text reply headers: everything from here on is the quoted thread. Only unambiguous
+# markers, "On ... wrote:" directly followed by '>' lines or "Original Message", so headers
+# and rules inside an order body are kept
+REPLY_HEADER_PATTERN = re.compile(
+    r"^(?:On\b.{0,200}\bwrote:[ \t]*\n(?:[ \t]*\n)*[ \t]*>"
+    r"|-{2,}\s*Original Message\s*-{2,})",
+    re.IGNORECASE | re.MULTILINE
+)
+SIGNATURE_PATTERN = re.compile(r"^-- ?$", re.MULTILINE)
+# A '-- ' line is only a signature delimiter when at most this many lines follow it
+SIGNATURE_MAX_LINES = 10
+QUOTED_LINE_PATTERN = re.compile(r"^[ \t]*>.*(?:\n|$)", re.MULTILINE)
+
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+INLINE_SPACE_PATTERN = re.compile(r"[ \t\r\f\v\u00a0\u200b\u200c\u034f]+")
+
+
+# ============================================================
+# HTML → TEXT
+# ============================================================
+
+def html_to_text_fast(html, strip_quotes=EMAIL_STRIP_QUOTED_REPLIES):
+    """
+    lxml-backed HTML → text with one line per block element.
+    Falls back to BeautifulSoup on markup lxml cannot parse.
+    """
+    if not html or not html.strip():
+        return ""
+
+    if len(html) > EMAIL_BODY_INPUT_MAX_CHARS:
+        logger.warning(f"HTML body of {len(html)} characters cut to {EMAIL_BODY_INPUT_MAX_CHARS} before parsing.")
+        html = html[:EMAIL_BODY_INPUT_MAX_CHARS]
+
+    try:
+        root = lxml.html.document_fromstring(html)
+    except (etree.ParserError, ValueError):
+        soup = BeautifulSoup(html, "html.parser")
+        return soup.get_text("\n", strip=True)
+
+    etree.strip_elements(root, *SKIPPED_TAGS, etree.Comment, with_tail=False)
+
+    if strip_quotes and not FORWARD_MARKER_PATTERN.search(html):
+        for element in root.xpath(QUOTE_XPATH):
+            if element.getparent() is not None:
+                element.drop_tree()
+        cut = root.xpath(QUOTE_CUT_XPATH)
+        if cut:
+            drop_from(cut[0])
+
+    for element in root.iter(*BLOCK_TAGS):
+        element.tail = "\n" + (element.tail or "")
+        if element.tag in ("p", "div", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6"):
+            element.text = "\n" + (element.text or "")
+    for cell in root.iter("td", "th"):
+        cell.tail = " " + (cell.tail or "")
+
+    return tidy_text(root.text_content())
+
+def drop_from(element):
+    """Remove `element` and everything after it in document order."""
+    node = element
+    while node is not None and node.getparent() is not None:
+        parent = node.getparent()
+        for sibling in list(node.itersiblings()):
+            parent.remove(sibling)
+        node = parent
+    element.getparent().remove(element)
+
+
+# ============================================================
+# PLAIN TEXT CLEAN-UP
+# ============================================================
+
+def tidy_text(text, collapse_spaces=True):
+    """Trim every line and squeeze blank-line runs; collapse_spaces also squeezes runs of spaces (HTML)."""
+    if collapse_spaces:
+        lines = (INLINE_SPACE_PATTERN.sub(" ", line).strip() for line in text.splitlines())
+    else:
+        lines = (line.rstrip() for line in text.splitlines())
+    return BLANK_LINES_PATTERN.sub("\n\n", "\n".join(lines)).strip()
+
+def strip_quoted_reply(text):
+    """Cut the quoted thread (reply headers, '>' lines) and a trailing '-- ' signature off a plain-text body."""
+    if FORWARD_MARKER_PATTERN.search(text):
+        # The forwarded message is usually the document we want
+        return text
+
+    match = REPLY_HEADER_PATTERN.search(text)
+    if match and match.start() > 0:
+        text = text[:match.start()]
+
+    text = QUOTED_LINE_PATTERN.sub("", text)
+
+    matches = list(SIGNATURE_PATTERN.finditer(text))
+    if matches and matches[-1].start() > 0:
+        signature = text[matches[-1].end():].strip()
+        if len(signature.splitlines()) <= SIGNATURE_MAX_LINES:
+            text = text[:matches[-1].start()]
+
+    return text
+
+def apply_budget(text, max_chars=EMAIL_BODY_MAX_CHARS):
+    """Truncate to max_chars, on a line boundary when one is close."""
+    if not max_chars or len(text) <= max_chars:
+        return text
+
+    cut = text.rfind("\n", 0, max_chars)
+    if cut < max_chars * 0.8:
+        cut = max_chars
+    return text[:cut].rstrip() + TRUNCATION_MARKER
+
+
+# ============================================================
+# BODY NORMALIZATION
+# ============================================================
+
+def normalize_body(body_text, html_body, max_chars=EMAIL_BODY_MAX_CHARS, strip_quotes=EMAIL_STRIP_QUOTED_REPLIES):
+    """
+    Final text stored on InternalEmail.body: the plain-text part when there
+    is one, otherwise the HTML part as text; quoted replies and signatures
+    stripped; at most max_chars characters.
+    """
+    if body_text and body_text.strip():
+        text = tidy_text(body_text[:EMAIL_BODY_INPUT_MAX_CHARS], collapse_spaces=False)
+    elif html_body:
+        text = html_to_text_fast(html_body, strip_quotes=strip_quotes)
+    else:
+        return ""
+
+    if strip_quotes:
+        text = tidy_text(strip_quoted_reply(text), collapse_spaces=False)
+
+    return apply_budget(text, max_chars)
@@ -3,18 +3,30 @@ import email
 import os
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 from django.conf import settings
-from ..models import InternalEmail, Environment, EnvironmentEmail
+from ..models import InternalEmail, Environment, EnvironmentEmail, MailboxSyncState
 from datetime import datetime
 from bs4 import BeautifulSoup
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
-import cloudinary.uploader
-from django.db import transaction, IntegrityError
+from django.db import connections, transaction, IntegrityError
 import json
+import re
+import tracemalloc
+from .imap_pool import IMAPConnectionPool, CONNECTION_ERRORS
+from .mime_parts import list_body_parts, select_wanted_parts, PartDecoder, decode_text_payload
+from .mail_filter import MailFilter, get_mail_filter
+from .email_writer import EmailBatchWriter, fallback_message_id
+from .task_lock import renew_environment_lock
+from .run_metrics import RunMetrics, collect_metrics, current_metrics, timed, record_retry
+from .body_normalizer import normalize_body
+from .mailbox_actions import apply_post_ingest_action, post_ingest_search_criteria
+from .blob_index import ATTACHMENT_DEDUPE, hash_attachment, find_blob, record_blob, record_ai_image
+from .image_preprocess import IMAGE_PREPROCESS, IMAGE_EXTENSIONS, preprocess_image, derived_image_name
+from .attachment_storage import get_attachment_storage, payload_size
 
 logger = logging.getLogger("email_monitor")
 
@@ -32,6 +44,30 @@ logger = logging.getLogger("email_monitor")
 # SINCE_DATE = datetime(2025, 10, 1)
 MAX_OPENAI_FILE_SIZE = 1024 ** 2 * 50 # 50MB
 
+# Number of UIDs sent in a single UID FETCH command
+IMAP_FETCH_BATCH_SIZE = getattr(settings, "IMAP_FETCH_BATCH_SIZE", 50)
+
+# Messages larger than this (RFC822.SIZE) are never downloaded
+IMAP_MAX_MESSAGE_SIZE = getattr(settings, "IMAP_MAX_MESSAGE_SIZE", 1024 ** 2 * 200) # 200MB
+
+# Body parts larger than this are downloaded in ranged BODY.PEEK[n]<offset.length> chunks
+IMAP_PART_CHUNK_SIZE = getattr(settings, "IMAP_PART_CHUNK_SIZE", 1024 ** 2 * 4) # 4MB
+
+# Max encoded bytes requested by one multi-message part fetch
+IMAP_FETCH_MAX_BYTES = getattr(settings, "IMAP_FETCH_MAX_BYTES", 1024 ** 2 * 16) # 16MB
+
+# Log the peak Python heap used per message (tracemalloc — diagnostic, slows ingestion)
+IMAP_TRACE_MEMORY = getattr(settings, "IMAP_TRACE_MEMORY", False)
+
+# Attachments larger than this are rejected before anything is uploaded
+MAX_ATTACHMENT_SIZE = getattr(settings, "MAX_ATTACHMENT_SIZE", 1024 ** 2 * 200) # 200MB
+
+# Attachments of one message uploaded at the same time
+ATTACHMENT_UPLOAD_WORKERS = getattr(settings, "ATTACHMENT_UPLOAD_WORKERS", 4)
+
+# Uploads in flight across the whole process (all messages / environments) — keeps us under storage rate limits
+ATTACHMENT_UPLOAD_MAX_CONCURRENT = getattr(settings, "ATTACHMENT_UPLOAD_MAX_CONCURRENT", 8)
+
 
 # ============================================================
 # NEW CUSTOM RETRY EXCEPTIONS
@@ -66,6 +102,7 @@ def retry(max_retries=3, delay=1, backoff=2, critical=False):
 
                 except Exception as e:
                     retries += 1
+                    record_retry(func.__name__)
                     logger.warning(
                         f"[Retry {retries}/{max_retries}] {func.__name__} failed: {e}"
                     )
@@ -96,6 +133,13 @@ def safe_decode(value):
         return value.decode("utf-8", errors="ignore")
     return value or ""
 
+def decode_subject(raw_subject):
+    decoded_parts = decode_header(raw_subject or "")
+    return "".join(
+        safe_decode(text) if isinstance(text, bytes) else text
+        for text, enc in decoded_parts
+    )
+
 def html_to_text(html):
     soup = BeautifulSoup(html, "html.parser")
     return soup.get_text("\n", strip=True)
@@ -117,139 +161,792 @@ def format_bytes(size):
 # ATTACHMENT SAVER — CRITICAL OPERATION
 # ============================================================
 
-@retry(max_retries=3, critical=True)
-def save_attachment(filename, data, env_config):
+upload_slots = threading.BoundedSemaphore(max(1, ATTACHMENT_UPLOAD_MAX_CONCURRENT))
+
+def attachment_storage_name(filename, sha256):
+    """
+    Content-addressed name: "<base>_<first 12 hex of sha256>.<ext>".
+    Different bytes never share a name, so no exists() probing is needed.
+    """
     base, ext = os.path.splitext(filename)
-    ext = ext[1:].lower()
+    base = re.sub(r"[^\w\-]+", "_", base).strip("_")[:80] or "attachment"
+    return f"{base}_{sha256[:12]}{ext.lower()}"
 
-    if ext not in env_config["ALLOWED_FILE_TYPES"]:
-        logger.warning(f"Rejected attachment '{filename}' — unsupported file type.")
-        # return None
-        return None, None
+def upload_attachment(filename, data, sha256, storage=None):
+    """
+    Write the attachment to the storage backend (the only storage write).
+    Returns (url, size).
+    """
+    ext = os.path.splitext(filename)[1][1:].lower()
+    storage = storage or get_attachment_storage()
+    return storage.save(
+        attachment_storage_name(filename, sha256),
+        data,
+        resource_type="raw" if ext in ["pdf", "txt"] else "image",
+    )
 
-    # ---------------- SAVE LOCALLY ----------------
-    counter = 1
-    unique_filename = filename
+def save_ai_image(filename, data, sha256):
+    """
+    Store the pre-processed (oriented, grayscale, model-sized) copy of an
+    image attachment next to the original. Returns its URL, or None when
+    the original should be sent to the model as it is.
+    """
+    ext = os.path.splitext(filename)[1][1:].lower()
+    if not IMAGE_PREPROCESS or ext not in IMAGE_EXTENSIONS:
+        return None
 
-    while default_storage.exists(f"local_email_attachments/{unique_filename}"):
-        unique_filename = f"{base}_{counter}.{ext}"
-        counter += 1
+    derived = preprocess_image(data)
+    if derived is None:
+        return None
 
-    # If DEBUG: save locally
-    # if settings.DEBUG:
-    path = default_storage.save(f"local_email_attachments/{unique_filename}", ContentFile(data))
-    logger.info(f"Saved attachment locally '{filename}' → {path}")
-    # return path
-    
-    # Check if locally save file exceeds max size limit
-    from pathlib import Path
-    MAX_SIZE_MB = 200
-    file_path = Path(f"media/{path}")
-    print("FILE PATH: ", file_path)
-    
-    if not file_path.exists():
-        print("File ({unique_filename}) does not exist")
-        logger.warning("File ({unique_filename}) does not exist")
-        return None, None
-    
-    size_mb = file_path.stat().st_size / (1024 * 1024)
-    
-    if size_mb > MAX_SIZE_MB:
-        print(f"File ({unique_filename}) too large ({size_mb} MB). Maxsize allowed is {MAX_SIZE_MB} MB")
-        logger.warning(f"File ({unique_filename}) too large ({size_mb} MB). Maxsize allowed is {MAX_SIZE_MB} MB")
-        # Delete the file if it exceeds max size
-        try:
-            file_path.unlink(missing_ok=True) # Python 3.8+
-        except IsADirectoryError:
-            raise ValueError("Path points to a directory, not a file.")
-        
-        return None, None
-    
-    # Delete the file if it doesn't exceed max size
     try:
-        file_path.unlink(missing_ok=True) # Python 3.8+
-    except IsADirectoryError:
-        raise ValueError("Path points to a directory, not a file.")
+        with upload_slots:
+            url, _ = get_attachment_storage().save(derived_image_name(attachment_storage_name(filename, sha256)), derived, resource_type="image")
+    except Exception as e:
+        # The original is stored: extraction still works without the smaller copy
+        logger.warning(f"Could not store the pre-processed copy of '{filename}': {e}")
+        return None
 
-    # ---------------- END ----------------
-    
-
-    # Production → Cloudinary
-    directory = "email_attachments"
+    logger.info(f"Saved pre-processed image '{filename}' ({format_bytes(payload_size(data))} → {format_bytes(len(derived))}) → {url}")
+    return url
 
-    resource_type = "image"
-    if ext in ["pdf", "txt"]:
-        resource_type = "raw"
+def attachments_for_environment(attachments, env_config):
+    """
+    The stored attachments an environment accepts (its own ALLOWED_FILE_TYPES).
+    Returns None when it accepts all of them, so the link reads InternalEmail.attachments.
+    """
+    attachments = attachments or []
+    allowed = [att for att in attachments if os.path.splitext(att["filename"])[1][1:].lower() in env_config["ALLOWED_FILE_TYPES"]]
+    return None if len(allowed) == len(attachments) else allowed
 
-    res = cloudinary.uploader.upload(
-        data,
-        filename=unique_filename,
-        folder=directory,
-        resource_type=resource_type,
-        use_filename=True
-    )
+@retry(max_retries=3, critical=True)
+def save_attachment(filename, data, env_config):
+    """
+    Store one attachment and return (url, size, sha256, ai_url).
+    ai_url is the pre-processed copy of an image (None for other files).
+    Bytes that were stored before are not uploaded again: the existing URL is reused.
+    Returns (None, None, None, None) for rejected files.
+    """
+    ext = os.path.splitext(filename)[1][1:].lower()
 
-    public_url = res.get("secure_url") or res.get("url")
-    file_size = res.get("bytes")
+    if ext not in env_config["ALLOWED_FILE_TYPES"]:
+        logger.warning(f"Rejected attachment '{filename}' — unsupported file type.")
+        return None, None, None, None
+
+    # data is bytes, or a (spooled) file for large parts
+    size = payload_size(data)
+    if size > MAX_ATTACHMENT_SIZE:
+        logger.warning(f"Rejected attachment '{filename}' — too large ({format_bytes(size)}, max {format_bytes(MAX_ATTACHMENT_SIZE)}).")
+        return None, None, None, None
+
+    # ---------------- DEDUPE (SHA-256 of the bytes) ----------------
+    sha256 = hash_attachment(data)
+    if ATTACHMENT_DEDUPE:
+        with timed("db_write"):
+            blob = find_blob(sha256)
+        if blob is not None:
+            logger.info(f"Reused stored attachment '{filename}' ({sha256[:12]}) → {blob.file_path}")
+            ai_url = blob.ai_file_path or None
+            if ai_url is None:
+                # Indexed before pre-processing was enabled
+                ai_url = save_ai_image(filename, data, sha256)
+                if ai_url:
+                    with timed("db_write"):
+                        record_ai_image(sha256, ai_url)
+            return blob.file_path, blob.file_size, sha256, ai_url
+
+    # ---------------- UPLOAD ----------------
+    with upload_slots:
+        public_url, file_size = upload_attachment(filename, data, sha256)
     logger.info(f"Saved attachment '{filename}' → {public_url}")
-    return public_url, file_size
+    ai_url = save_ai_image(filename, data, sha256)
+
+    with timed("db_write"):
+        record_blob(sha256, public_url, file_size or size, ext, ai_url)
+    return public_url, file_size or size, sha256, ai_url
+
+def save_attachments(files, env_config):
+    """
+    Save a message's attachments, up to ATTACHMENT_UPLOAD_WORKERS at a time.
+    Returns [(filename, url, size, sha256, ai_url)] in the original order. Each one
+    keeps save_attachment's critical retry: the first failure (in order) is
+    raised once the uploads still queued are cancelled.
+    """
+    if len(files) <= 1 or ATTACHMENT_UPLOAD_WORKERS <= 1:
+        return [(filename, *save_attachment(filename, data, env_config)) for filename, data in files]
+
+    # Stage timings are per thread: the caller times the whole batch, retries are merged back
+    outer_metrics = current_metrics()
+    task_metrics = [RunMetrics() for _ in files]
+
+    def upload(index):
+        filename, data = files[index]
+        try:
+            with collect_metrics(task_metrics[index]):
+                return save_attachment(filename, data, env_config)
+        finally:
+            # Worker threads own their DB connections (blob index lookups)
+            connections.close_all()
+
+    executor = ThreadPoolExecutor(max_workers=min(ATTACHMENT_UPLOAD_WORKERS, len(files)), thread_name_prefix="attachment-upload")
+    try:
+        futures = [executor.submit(upload, index) for index in range(len(files))]
+        return [(files[index][0], *future.result()) for index, future in enumerate(futures)]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if outer_metrics is not None:
+            for metrics in task_metrics:
+                outer_metrics.retries.update(metrics.retries)
 
 # ============================================================
-# IMAP LOGIN / FETCH — CRITICAL
+# IMAP LOGIN — CRITICAL
 # ============================================================
 
 @retry(max_retries=3, critical=True)
 def imap_login(env_config):
-    imap = imaplib.IMAP4_SSL(env_config['IMAP_HOST'])
-    imap.login(env_config['IMAP_EMAIL'], env_config['IMAP_PASSWORD'])
+    with timed("login"):
+        imap = imaplib.IMAP4_SSL(env_config['IMAP_HOST'])
+        imap.login(env_config['IMAP_EMAIL'], env_config['IMAP_PASSWORD'])
     logger.info("Successfully connected to IMAP server.")
     return imap
 
+# Shared across environments on the same account and across runs in one process
+imap_pool = IMAPConnectionPool(connect=imap_login)
+
+# ============================================================
+# BATCHED UID FETCH
+# ============================================================
+
+FETCH_TOKEN_PATTERN = re.compile(
+    rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|(\{\d+\})\s*$|([^\s()"{\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?))'
+)
+
+def chunk_list(items, size):
+    size = max(1, int(size or 1))
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def tokenize_fetch_text(text):
+    """
+    Split one text segment of a FETCH response into (kind, value) tokens.
+    A trailing {n} literal marker is dropped — the literal itself follows
+    as a separate segment.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = FETCH_TOKEN_PATTERN.match(text, pos)
+        if not match or match.end() == pos:
+            break
+        pos = match.end()
+        opening, closing, quoted, literal, atom = match.groups()
+        if opening:
+            tokens.append(("open", None))
+        elif closing:
+            tokens.append(("close", None))
+        elif quoted is not None:
+            tokens.append(("value", re.sub(rb"\\(.)", rb"\1", quoted)))
+        elif atom is not None:
+            tokens.append(("value", None if atom.upper() == b"NIL" else atom))
+    return tokens
+
+def build_fetch_items(tokens):
+    """Turn the tokens of one `n (KEY value ...)` response into {KEY: value}."""
+    stack = [[]]
+    for kind, value in tokens:
+        if kind == "open":
+            stack.append([])
+        elif kind == "close" and len(stack) > 1:
+            closed = stack.pop()
+            stack[-1].append(closed)
+        elif kind == "value":
+            stack[-1].append(value)
+
+    top = stack[0]
+    pairs = top[1] if len(top) > 1 and isinstance(top[1], list) else []
+    return {
+        pairs[i].upper(): pairs[i + 1]
+        for i in range(0, len(pairs) - 1, 2)
+        if isinstance(pairs[i], bytes)
+    }
+
+def parse_fetch_response(data):
+    """
+    Parse the raw response of a UID FETCH over a message set.
+    imaplib returns a flat list mixing (text, literal) tuples and plain
+    text continuations; a message is complete once its parentheses close.
+    Yields (uid, items) as each message is completed, where items maps
+    the upper-cased FETCH item name (b"BODY[]", b"RFC822.SIZE", ...) to its value.
+    """
+    tokens = []
+    depth = 0
+
+    for item in data or []:
+        if item is None:
+            continue
+
+        text, literal = (item[0], item[1]) if isinstance(item, tuple) else (item, None)
+        segment_tokens = tokenize_fetch_text(text)
+        for kind, _ in segment_tokens:
+            depth += 1 if kind == "open" else -1 if kind == "close" else 0
+        tokens.extend(segment_tokens)
+
+        if literal is not None:
+            tokens.append(("value", literal))
+            continue
+
+        if depth <= 0 and tokens:
+            items = build_fetch_items(tokens)
+            tokens, depth = [], 0
+            if items.get(b"UID"):
+                yield items[b"UID"], items
+
+    if tokens:
+        items = build_fetch_items(tokens)
+        if items.get(b"UID"):
+            yield items[b"UID"], items
+
+def get_body_item(items, section=b""):
+    """Return the BODY[<section>...] literal from parsed FETCH items."""
+    prefix = b"BODY[" + section.upper()
+    for key, value in items.items():
+        if key.startswith(prefix) and (section or key == b"BODY[]"):
+            return value
+    return None
+
 @retry(max_retries=2, critical=True)
-def fetch_email(imap, email_id):
-    _, msg_data = imap.fetch(email_id, "(BODY.PEEK[])")
-    return email.message_from_bytes(msg_data[0][1])
+def fetch_uid_batch(imap, uids, fetch_items):
+    with timed("fetch"):
+        status, data = imap.uid("FETCH", b",".join(uids).decode(), fetch_items)
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH failed with status {status}")
+    return data
+
+def iter_fetch_batches(imap, uids, batch_size, fetch_items, fetch_stats):
+    """
+    Fetch `fetch_items` for `uids` in chunks of `batch_size` (one round trip
+    per chunk) and yield (uid_chunk, {uid: items}) per chunk.
+    A chunk that fails permanently is logged, counted and skipped.
+    """
+    for uid_chunk in chunk_list(uids, batch_size):
+        try:
+            data = fetch_uid_batch(imap, uid_chunk, fetch_items)
+        except CriticalRetryError as e:
+            logger.error(f"CRITICAL FAILURE — Skipping UID batch {uid_chunk[0]}..{uid_chunk[-1]}: {e}")
+            fetch_stats["failed_batches"] += 1
+            continue
+        finally:
+            fetch_stats["round_trips"] += 1
+
+        fetched = {}
+        with timed("parse"):
+            for uid, items in parse_fetch_response(data):
+                fetched[uid] = items
+                fetch_stats["bytes_fetched"] += sum(len(v) for v in items.values() if isinstance(v, bytes))
+        yield uid_chunk, fetched
+
+def iter_fetched_emails(imap, uids, batch_size, fetch_stats):
+    """
+    Download full messages in batches and yield (uid, email.message.Message)
+    one at a time.
+    """
+    for _, fetched in iter_fetch_batches(imap, uids, batch_size, "(UID BODY.PEEK[])", fetch_stats):
+        for uid, items in fetched.items():
+            raw = get_body_item(items)
+            if raw is None:
+                continue
+            fetch_stats["messages"] += 1
+            with timed("parse"):
+                msg = email.message_from_bytes(raw)
+            yield uid, msg
+
+# ============================================================
+# SELECTIVE PART DOWNLOAD (PHASE TWO)
+# ============================================================
+
+def get_section_item(items, section):
+    """Return the BODY[<section>] (or ranged BODY[<section>]<n>) literal from parsed FETCH items."""
+    exact = b"BODY[" + section.encode() + b"]"
+    for key, value in items.items():
+        if key == exact or key.startswith(exact + b"<"):
+            return value
+    return None
+
+def extract_message_content(msg, env_config):
+    """
+    Full-download fallback: pull the body text and candidate attachments
+    out of an already parsed message.
+    """
+    content = {"body_text": "", "html_body": "", "has_attachment": False, "files": []}
+
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            disp = str(part.get("Content-Disposition"))
+
+            if content_type == "text/plain" and "attachment" not in disp:
+                payload = part.get_payload(decode=True)
+                if payload:
+                    content["body_text"] += safe_decode(payload)
+
+            elif content_type == "text/html" and "attachment" not in disp:
+                payload = part.get_payload(decode=True)
+                if payload:
+                    content["html_body"] += safe_decode(payload)
+
+            if "attachment" in disp:
+                content["has_attachment"] = True
+                filename = safe_decode(part.get_filename())
+                file_data = part.get_payload(decode=True)
+
+                if filename and file_data:
+                    content["files"].append((filename, file_data))
+
+    else:
+        payload = msg.get_payload(decode=True)
+        if payload:
+            content["html_body" if msg.get_content_type() == "text/html" else "body_text"] = safe_decode(payload)
+
+    return content
+
+@retry(max_retries=2, critical=True)
+def fetch_part_range(imap, uid, section, offset, length):
+    with timed("fetch"):
+        status, data = imap.uid("FETCH", uid.decode(), f"(UID BODY.PEEK[{section}]<{offset}.{length}>)")
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH failed with status {status}")
+    for _, items in parse_fetch_response(data):
+        return get_section_item(items, section) or b""
+    return b""
+
+def download_large_part(imap, uid, part, fetch_stats):
+    """Stream one large part in IMAP_PART_CHUNK_SIZE ranges through the decoder."""
+    decoder = PartDecoder(part["encoding"])
+    offset = 0
+
+    while True:
+        chunk = fetch_part_range(imap, uid, part["section"], offset, IMAP_PART_CHUNK_SIZE)
+        fetch_stats["round_trips"] += 1
+        fetch_stats["bytes_fetched"] += len(chunk)
+        decoder.feed(chunk)
+        offset += len(chunk)
+        if len(chunk) < IMAP_PART_CHUNK_SIZE:
+            break
+
+    if decoder.spooled_to_disk:
+        logger.info(f"Spooled part {part['section']} of UID {uid} to disk ({format_bytes(decoder.size)}).")
+    return decoder.finish()
+
+def build_message_content(imap, uid, plan, sections, fetch_stats):
+    """Decode the wanted parts of one message into the extract_message_content() shape."""
+    content = {"body_text": "", "html_body": "", "has_attachment": plan["has_attachment"], "files": []}
+
+    for part in plan["wanted"]:
+        if part["section"] in sections:
+            decoder = PartDecoder(part["encoding"])
+            decoder.feed(sections[part["section"]])
+            decoded = decoder.finish()
+        else:
+            decoded = download_large_part(imap, uid, part, fetch_stats)
+
+        if part["role"] == "attachment":
+            content["files"].append((part["filename"], decoded))
+            continue
+
+        text = decode_text_payload(decoded.read(), part["charset"])
+        decoded.close()
+        if part["role"] == "html" or (part["role"] == "body" and part["content_type"] == "text/html"):
+            content["html_body"] += text
+        elif part["role"] == "body":
+            content["body_text"] = text
+        else:
+            content["body_text"] += text
+
+    return content
+
+def plan_message_parts(items, env_config):
+    """BODYSTRUCTURE → {"wanted": [...], "has_attachment": bool}, or None to fall back to a full download."""
+    structure = items.get(b"BODYSTRUCTURE")
+    parts = list_body_parts(structure)
+    if parts is None:
+        return None
+
+    wanted, has_attachment = select_wanted_parts(
+        parts, env_config["ALLOWED_FILE_TYPES"], is_multipart=isinstance(structure[0], list)
+    )
+    return {"wanted": wanted, "has_attachment": has_attachment}
+
+def iter_message_contents(imap, uids, headers, env_config, fetch_stats):
+    """
+    Phase two: yield (uid, header_msg, content) in UID order.
+
+    Only the parts ingestion uses are downloaded (inline text bodies and
+    attachments with an allowed extension). Small parts of consecutive
+    messages with the same layout share one UID FETCH; parts above
+    IMAP_PART_CHUNK_SIZE are streamed in ranges into spooled temp files.
+    """
+    plans = {uid: plan_message_parts(headers[uid], env_config) for uid in uids}
+
+    def small_sections(uid):
+        return tuple(p["section"] for p in plans[uid]["wanted"] if p["size"] <= IMAP_PART_CHUNK_SIZE)
+
+    def small_size(uid):
+        return sum(p["size"] for p in plans[uid]["wanted"] if p["size"] <= IMAP_PART_CHUNK_SIZE)
+
+    prefetched = {}
+
+    for index, uid in enumerate(uids):
+        plan = plans[uid]
+
+        if plan is None:
+            # Unusable BODYSTRUCTURE → download and walk the whole message
+            for _, msg in iter_fetched_emails(imap, [uid], 1, fetch_stats):
+                with timed("parse"):
+                    content = extract_message_content(msg, env_config)
+                yield uid, msg, content
+            continue
+
+        signature = small_sections(uid)
+        if signature and uid not in prefetched:
+            group, group_size = [uid], small_size(uid)
+            for later in uids[index + 1:]:
+                if (plans[later] and later not in prefetched and small_sections(later) == signature
+                        and group_size + small_size(later) <= IMAP_FETCH_MAX_BYTES):
+                    group.append(later)
+                    group_size += small_size(later)
+
+            fetch_items = "(UID " + " ".join(f"BODY.PEEK[{section}]" for section in signature) + ")"
+            try:
+                data = fetch_uid_batch(imap, group, fetch_items)
+            except CriticalRetryError as e:
+                logger.error(f"CRITICAL FAILURE — Skipping part fetch for UIDs {group[0]}..{group[-1]}: {e}")
+                fetch_stats["failed_batches"] += 1
+                prefetched.update({group_uid: None for group_uid in group})
+            else:
+                with timed("parse"):
+                    for fetched_uid, items in parse_fetch_response(data):
+                        if fetched_uid in group:
+                            prefetched[fetched_uid] = {section: get_section_item(items, section) or b"" for section in signature}
+                            fetch_stats["bytes_fetched"] += sum(len(v) for v in prefetched[fetched_uid].values())
+            finally:
+                fetch_stats["round_trips"] += 1
+
+        sections = prefetched.pop(uid, {}) if signature else {}
+        if sections is None:
+            continue
+
+        try:
+            with timed("parse"):
+                content = build_message_content(imap, uid, plan, sections, fetch_stats)
+        except CriticalRetryError as e:
+            logger.error(f"CRITICAL FAILURE — Skipping email {uid}, part download failed: {e}")
+            fetch_stats["failed_batches"] += 1
+            continue
+
+        fetch_stats["messages"] += 1
+        with timed("parse"):
+            header_msg = email.message_from_bytes(get_body_item(headers[uid], b"HEADER") or b"")
+        yield uid, header_msg, content
 
 # ============================================================
 # IMAP SEARCH QUERY BUILDER
 # ============================================================
 
-def build_imap_search(env_config):
+def get_env_mail_filter(env_config):
+    """Compiled filter from env_config, or compiled on the spot from its raw lists."""
+    if env_config.get("MAIL_FILTER") is None:
+        env_config["MAIL_FILTER"] = MailFilter(
+            allowed_senders=env_config.get("ALLOWED_SENDERS"),
+            allowed_subject_keywords=env_config.get("ALLOWED_SUBJECT_KEYWORDS"),
+            blocked_subject_keywords=env_config.get("BLOCKED_SUBJECT_KEYWORDS"),
+        )
+    return env_config["MAIL_FILTER"]
+
+def build_imap_search(env_config, min_uid=None):
     # search_parts = ["ALL"]
     search_parts = ["UNSEEN"]
+
+    # Incremental sync: only ask for UIDs above the folder's high-water mark
+    if min_uid:
+        search_parts.append(f"UID {min_uid}:*")
     
-    ALLOWED_SENDERS = env_config['ALLOWED_SENDERS']
-    ALLOWED_SUBJECT_KEYWORDS = env_config['ALLOWED_SUBJECT_KEYWORDS']
     SINCE_DATE = env_config['SINCE_DATE']
-    
-
-    if ALLOWED_SENDERS:
-        if len(ALLOWED_SENDERS) == 1:
-            search_parts.append(f'FROM "{ALLOWED_SENDERS[0]}"')
-        else:
-            s = f'OR FROM "{ALLOWED_SENDERS[0]}" FROM "{ALLOWED_SENDERS[1]}"'
-            for sender in ALLOWED_SENDERS[2:]:
-                s = f'OR {s} FROM "{sender}"'
-            search_parts.append(s)
 
     if SINCE_DATE:
         imap_date = SINCE_DATE.strftime("%d-%b-%Y")
         search_parts.append(f"SINCE {imap_date}")
 
-    if ALLOWED_SUBJECT_KEYWORDS:
-        s = f'SUBJECT "{ALLOWED_SUBJECT_KEYWORDS[0]}"'
-        for keyword in ALLOWED_SUBJECT_KEYWORDS[1:]:
-            s = f'OR {s} SUBJECT "{keyword}"'
-        search_parts.append(s)
+    # Sender / subject rules: FROM (incl. wildcard domains), SUBJECT and NOT SUBJECT
+    search_parts.extend(get_env_mail_filter(env_config).search_criteria())
+
+    # Messages already tagged by the post-ingest action
+    search_parts.extend(post_ingest_search_criteria(env_config))
 
     return " ".join(search_parts)
 
+# ============================================================
+# INCREMENTAL SYNC (UID HIGH-WATER MARKS)
+# ============================================================
+
+STATUS_PATTERN = re.compile(rb"(UIDVALIDITY|UIDNEXT) (\d+)")
+
+def fetch_folder_status(imap, folder):
+    """
+    Cheap STATUS call (no SELECT) returning (uidvalidity, uidnext).
+    Either value is None if the server did not report it.
+    """
+    status, data = imap.status(folder, "(UIDVALIDITY UIDNEXT)")
+    if status != "OK" or not data or not data[0]:
+        return None, None
+
+    values = dict(STATUS_PATTERN.findall(data[0]))
+    uidvalidity = int(values[b"UIDVALIDITY"]) if b"UIDVALIDITY" in values else None
+    uidnext = int(values[b"UIDNEXT"]) if b"UIDNEXT" in values else None
+    return uidvalidity, uidnext
+
+def get_sync_state(environment, folder, uidvalidity):
+    """
+    Load the folder's sync state, resetting it for a full rescan
+    when the mailbox UIDVALIDITY has changed.
+    """
+    sync_state, _ = MailboxSyncState.objects.get_or_create(environment=environment, folder=folder)
+
+    if uidvalidity and sync_state.uidvalidity != uidvalidity:
+        if sync_state.uidvalidity:
+            logger.warning(
+                f"UIDVALIDITY changed for '{folder}' ({sync_state.uidvalidity} → {uidvalidity}), running full rescan."
+            )
+        sync_state.uidvalidity = uidvalidity
+        sync_state.last_uid = 0
+        sync_state.save(update_fields=["uidvalidity", "last_uid", "updated_at"])
+
+    return sync_state
+
+def commit_sync_state(sync_state, last_uid):
+    if last_uid > sync_state.last_uid:
+        sync_state.last_uid = last_uid
+        with timed("db_write"):
+            sync_state.save(update_fields=["last_uid", "updated_at"])
+
+# ============================================================
+# HEADER-FIRST SCREENING (PHASE ONE)
+# ============================================================
+
+IMAP_HEADER_FETCH_ITEMS = "(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT FROM DATE)])"
+
+def bodystructure_has_attachment(structure):
+    """True if any part of a parsed BODYSTRUCTURE has an attachment disposition."""
+    if not isinstance(structure, list):
+        return False
+    if structure and isinstance(structure[0], bytes) and structure[0].lower() == b"attachment":
+        return True
+    return any(bodystructure_has_attachment(part) for part in structure if isinstance(part, list))
+
+def link_environment_email(environment, internal_email, status, attachments=None):
+    """
+    Create the EnvironmentEmail for an InternalEmail.
+    attachments: this environment's subset of the stored attachments (None: all)
+    Returns None if this environment already has it.
+    """
+    if EnvironmentEmail.objects.filter(environment=environment, internal_email=internal_email).exists():
+        # Already fetched for this environment — skip
+        return None
+
+    try:
+        with transaction.atomic():
+            env_email, created_env_email = EnvironmentEmail.objects.get_or_create(
+                environment=environment,
+                internal_email=internal_email,
+                defaults={
+                    "status": status,
+                    "attachments": attachments,
+                }
+            )
+    except IntegrityError:
+        # Race condition: another request created it first
+        return None
+
+    return env_email if created_env_email else None
+
+def screen_new_messages(uid_chunk, headers, environment, env_config, saved_emails, max_size_emails, stored_uids=None):
+    """
+    Phase one of the two-phase fetch: decide from headers, size and
+    BODYSTRUCTURE alone which messages still need their body downloaded.
+
+    Messages already stored globally (InternalEmail) but new to this
+    environment are linked straight away, without downloading anything.
+    stored_uids: optional list, receives the UIDs this environment now has in the database
+    Returns the UIDs that must be fetched in full.
+    """
+    candidates = {}
+    mail_filter = get_env_mail_filter(env_config)
+
+    for uid in uid_chunk:
+        items = headers.get(uid)
+        if items is None:
+            # Expunged between SEARCH and FETCH
+            continue
+
+        with timed("parse"):
+            header_msg = email.message_from_bytes(get_body_item(items, b"HEADER") or b"")
+            subject = decode_subject(header_msg.get("Subject", ""))
+
+        # Sender / subject rules the server could not fully evaluate
+        matched, reason = mail_filter.matches(subject, header_msg.get("From", ""))
+        if not matched:
+            logger.info(f"Skipped — {reason}: {subject}")
+            continue
+
+        message_size = int(items.get(b"RFC822.SIZE") or 0)
+        if message_size > IMAP_MAX_MESSAGE_SIZE:
+            logger.warning(f"Skipped — message too large ({format_bytes(message_size)}): {subject}")
+            continue
+
+        if env_config["REQUIRE_ATTACHMENT"] and not bodystructure_has_attachment(items.get(b"BODYSTRUCTURE")):
+            logger.info(f"Skipped — attachment required: {subject}")
+            continue
+
+        candidates[uid] = header_msg.get("Message-ID")
+
+    # One query per table for the whole batch
+    message_ids = {message_id for message_id in candidates.values() if message_id}
+    with timed("db_write"):
+        known_emails = {
+            obj.message_id: obj
+            for obj in InternalEmail.objects.filter(message_id__in=message_ids).only("id", "message_id", "subject", "total_file_size", "attachments")
+        }
+        linked_ids = set(
+            EnvironmentEmail.objects.filter(environment=environment, internal_email__message_id__in=message_ids)
+            .values_list("internal_email__message_id", flat=True)
+        )
+
+    download_ids = []
+    for uid, message_id in candidates.items():
+        if message_id in linked_ids:
+            if stored_uids is not None:
+                stored_uids.append(uid)
+            continue
+
+        internal_email = known_emails.get(message_id)
+        if internal_email is None:
+            download_ids.append(uid)
+            continue
+
+        max_size = internal_email.total_file_size > MAX_OPENAI_FILE_SIZE
+        with timed("db_write"):
+            env_email = link_environment_email(
+                environment, internal_email, "failed" if max_size else "pending",
+                attachments=attachments_for_environment(internal_email.attachments, env_config),
+            )
+        if stored_uids is not None:
+            stored_uids.append(uid)
+        if env_email is None:
+            continue
+
+        if max_size:
+            max_size_emails.append(env_email)
+        else:
+            saved_emails.append(env_email)
+        logger.info(f"Linked existing email — {internal_email.subject}")
+
+    logger.info(f"Phase one: {len(download_ids)}/{len(uid_chunk)} messages need a full download.")
+    return download_ids
+
 # ============================================================
 # MAIN FETCH LOGIC
 # ============================================================
 
+def build_env_config(environment, folders=None):
+    """Environment settings in the shape the fetch helpers expect."""
+    return {
+        "IMAP_EMAIL": environment.imap_email,
+        "IMAP_PASSWORD": environment.get_imap_password(),
+        "IMAP_HOST": environment.imap_host,
+        "EMAIL_FOLDERS": list(folders) if folders is not None else list(environment.email_folders),
+        "ALLOWED_FILE_TYPES": list(environment.allowed_file_types),
+        "ALLOWED_SENDERS": list(environment.allowed_senders),
+        "ALLOWED_SUBJECT_KEYWORDS": list(environment.allowed_subject_keywords),
+        "BLOCKED_SUBJECT_KEYWORDS": list(environment.blocked_subject_keywords),
+        "REQUIRE_ATTACHMENT": environment.require_attachment,
+        "POST_INGEST_ACTION": environment.post_ingest_action,
+        "POST_INGEST_KEYWORD": environment.post_ingest_keyword,
+        "POST_INGEST_FOLDER": environment.post_ingest_folder,
+        "MAIL_FILTER": get_mail_filter(environment),
+        "SINCE_DATE": datetime(environment.since_date.year, environment.since_date.month, environment.since_date.day) if environment.since_date else None,
+        "FETCH_BATCH_SIZE": IMAP_FETCH_BATCH_SIZE
+    }
+
+def prepare_internal_email(msg, content, env_config):
+    """
+    Upload the attachments of a downloaded message and build its
+    InternalEmail field values (written later by EmailBatchWriter).
+    Returns (fields, max_size).
+    Raises CriticalRetryError if an attachment cannot be saved.
+    """
+    # SUBJECT (blocked keywords were already screened in phase one)
+    subject = decode_subject(msg.get("Subject", ""))
+
+    logger.debug(f"Preparing email: {subject}")
+
+    message_id = msg.get("Message-ID")
+
+    # Metadata
+    date_received = msg.get("Date")
+    date_parsed = parsedate_to_datetime(date_received) if date_received else datetime.now()
+    sender = msg.get("From", "")
+
+    # Extract content
+    body_text = content["body_text"]
+    html_body = content["html_body"]
+    attachments = []
+
+    total_file_size = 0
+    # CRITICAL: If any upload fails → skip email
+    with timed("upload"):
+        saved_files = save_attachments(content["files"], env_config)
+
+    for filename, saved, size, sha256, ai_url in saved_files:
+        if saved and size:
+            attachments.append({
+                "filename": filename,
+                "file_path": saved,
+                "file_size": size,
+                "sha256": sha256,
+                "ai_file_path": ai_url
+            })
+            logger.debug(f"Attachment {filename}: {format_bytes(size)}")
+            total_file_size += size
+
+    if content["files"]:
+        logger.debug(f"Total attachment size for {subject}: {format_bytes(total_file_size)}")
+
+    # Plain text (or HTML as text), quoted replies stripped, size-bounded
+    with timed("parse"):
+        body_text = normalize_body(body_text, html_body)
+
+    if not message_id:
+        message_id = fallback_message_id(sender, date_received, subject, content["body_text"] or content["html_body"], attachments)
+
+    fields = {
+        "subject": subject,
+        "sender": sender,
+        "body": body_text,
+        "date_recieved": date_parsed,
+        "attachments": attachments,
+        "total_file_size": total_file_size,
+        "message_id": message_id
+    }
+    return fields, total_file_size > MAX_OPENAI_FILE_SIZE
+
 
-def fetch_new_emails(env_id):
+def fetch_new_emails(env_id, folders=None, run_stats=None, budget=None, progress=None):
+    """
+    Fetch new emails for one environment.
+    folders: optional subset of the environment's email_folders
+    run_stats: optional dict, filled with round trip / message / byte counts
+    budget: optional ScanBudget — stop early (between messages) and record where to resume
+    progress: optional callable, called with the stats dict after each SEARCH and fetch batch
+    """
     imap = None
     saved_emails = []
     max_size_emails = []
@@ -259,239 +956,285 @@ def fetch_new_emails(env_id):
     
     # Set environment config fields
     
-    env_config = {
-        "IMAP_EMAIL": environment.imap_email,
-        "IMAP_PASSWORD": environment.get_imap_password(),
-        "IMAP_HOST": environment.imap_host,
-        "EMAIL_FOLDERS": list(environment.email_folders),
-        "ALLOWED_FILE_TYPES": list(environment.allowed_file_types),
-        "ALLOWED_SENDERS": list(environment.allowed_senders),
-        "ALLOWED_SUBJECT_KEYWORDS": list(environment.allowed_subject_keywords),
-        "BLOCKED_SUBJECT_KEYWORDS": list(environment.blocked_subject_keywords),
-        "REQUIRE_ATTACHMENT": environment.require_attachment,
-        "SINCE_DATE": datetime(environment.since_date.year, environment.since_date.month, environment.since_date.day)
-    }
+    env_config = build_env_config(environment, folders=folders)
+    
+    fetch_stats = run_stats if run_stats is not None else {}
+    for key in ("round_trips", "bytes_fetched", "messages", "failed_batches", "found", "fetched"):
+        fetch_stats.setdefault(key, 0)
+    fetched_before = fetch_stats["fetched"]
     
-    print('ENV CONFIG:', env_config)
+    # Never log env_config itself: it holds the decrypted IMAP password
+    logger.debug(f"Fetching {environment.name}: {env_config['IMAP_EMAIL']} @ {env_config['IMAP_HOST']}, folders {env_config['EMAIL_FOLDERS']}")
+
+    if budget is not None:
+        budget.start_fetch(fetch_stats)
 
+    started_tracing = IMAP_TRACE_MEMORY and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    broken = False
     try:
-        imap = imap_login(env_config)
+        imap = imap_pool.acquire(env_config)
         
-        # s, f = imap.list()
-        # print('STATUS:', s)
-        # print('FOLDERS:', f)
-
         # imap.select(env_config['EMAIL_FOLDERS'])
 
-        for folder in env_config['EMAIL_FOLDERS']:
+        folders = env_config['EMAIL_FOLDERS']
+        if budget is not None:
+            # Interactive slices pick up where the previous one stopped
+            folders = budget.resume_folders(folders)
+
+        for folder in folders:
+            with timed("select"):
+                uidvalidity, uidnext = fetch_folder_status(imap, folder)
+            fetch_stats["round_trips"] += 1
+            with timed("db_write"):
+                sync_state = get_sync_state(environment, folder, uidvalidity)
+
+            last_uid = sync_state.last_uid if uidvalidity else 0
+            # The high-water mark only advances over messages that were fully
+            # handled, so a crash or failure resumes from the first unfinished UID.
+            high_water = last_uid
+            sync_blocked = False
+
+            resume_uid = budget.resume_uid(folder, uidvalidity) if budget is not None else 0
+            if resume_uid > last_uid:
+                # The previous slice got past a message that failed — scan on from
+                # its cursor, but leave the committed mark for a full run to advance
+                last_uid = resume_uid
+                sync_blocked = True
+
+            # Nothing arrived since the last committed UID
+            if uidvalidity and uidnext and last_uid and uidnext <= last_uid + 1:
+                logger.info(f"No new mail in '{folder}' (UIDNEXT {uidnext}), skipping.")
+                continue
+
             logger.info(f"Selecting folder: {folder}")
-            status, _ = imap.select(folder)
-            print(f'SELECTING FOLDER ({folder}) STATUS:', status)
+            with timed("select"):
+                status, _ = imap.select(folder)
+            logger.debug(f"Select '{folder}': {status}")
             
             if status != "OK":
                 logger.warning(f"Failed to select folder '{folder}', skipping.")
                 continue
                 
-            search_query = build_imap_search(env_config)
+            search_query = build_imap_search(env_config, min_uid=last_uid + 1 if last_uid else None)
             logger.info(f"Running IMAP search in '{folder}' with: {search_query}")
 
-            status, messages = imap.search(None, search_query)
+            with timed("search"):
+                status, messages = imap.uid("SEARCH", None, search_query)
+            fetch_stats["round_trips"] += 1
             
             if status != "OK":
                 logger.warning(f"Search failed in folder '{folder}'.")
                 continue
                 
-            email_ids = messages[0].split()
+            # "n:*" always matches the newest message, even when its UID is below n.
+            # SEARCH order is not guaranteed: checkpoints assume ascending UIDs
+            email_ids = sorted((uid for uid in messages[0].split() if int(uid) > last_uid), key=int)
 
             logger.info(f"Found {len(email_ids)} emails in '{folder}'.")
+            fetch_stats["found"] += len(email_ids)
+            if progress:
+                progress(fetch_stats)
+
+            scanned_uid = last_uid  # cursor: every UID up to here was looked at
+            if budget is not None:
+                email_ids = budget.take(email_ids)
+
+            failed_batches = fetch_stats["failed_batches"]
+            writer = EmailBatchWriter()
+            stored_uids = []  # UIDs committed to the database → post-ingest action
+
+            # Phase one: headers + BODYSTRUCTURE for the whole batch, phase two:
+            # full bodies only for messages this environment has not seen yet.
+            header_batches = iter_fetch_batches(imap, email_ids, env_config["FETCH_BATCH_SIZE"], IMAP_HEADER_FETCH_ITEMS, fetch_stats)
+            for uid_chunk, headers in (budget.limit(header_batches) if budget is not None else header_batches):
+                download_ids = screen_new_messages(uid_chunk, headers, environment, env_config, saved_emails, max_size_emails, stored_uids)
+                not_downloaded = list(download_ids)
+
+                contents = iter_message_contents(imap, download_ids, headers, env_config, fetch_stats)
+                for email_id, msg, content in (budget.limit(contents) if budget is not None else contents):
+                    not_downloaded.remove(email_id)
+                    if fetch_stats["failed_batches"] != failed_batches:
+                        sync_blocked = True
 
-            for email_id in email_ids:
-                try:
-                    msg = fetch_email(imap, email_id)
-
-                    # SUBJECT
-                    raw_subject = msg.get("Subject", "")
-                    decoded_parts = decode_header(raw_subject)
-                    subject = "".join(
-                        safe_decode(text) if isinstance(text, bytes) else text
-                        for text, enc in decoded_parts
-                    )
+                    try:
+                        if env_config["REQUIRE_ATTACHMENT"] and not content["has_attachment"]:
+                            logger.info(f"Skipped — attachment required: {decode_subject(msg.get('Subject', ''))}")
+                            continue
 
-                    # Blocked keywords
-                    if any(blk.lower() in subject.lower() for blk in env_config["BLOCKED_SUBJECT_KEYWORDS"]):
-                        logger.info(f"Skipped — blocked subject: {subject}")
-                        continue
-                        
-                    print('FETCHING EMAIL...', subject)
-                    
-                    message_id = msg.get("Message-ID")
-                    
-                    # Metadata
-                    date_received = msg.get("Date")
-                    date_parsed = parsedate_to_datetime(date_received) if date_received else datetime.now()
-                    sender = msg.get("From", "")
-
-                    # Extract content
-                    body_text = ""
-                    html_body = ""
-                    attachments = []
-                    has_attachment = False
-
-                    total_file_size = 0
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            content_type = part.get_content_type()
-                            disp = str(part.get("Content-Disposition"))
-
-                            if content_type == "text/plain" and "attachment" not in disp:
-                                payload = part.get_payload(decode=True)
-                                if payload:
-                                    body_text += safe_decode(payload)
-
-                            elif content_type == "text/html" and "attachment" not in disp:
-                                payload = part.get_payload(decode=True)
-                                if payload:
-                                    html_body += safe_decode(payload)
-
-                            if "attachment" in disp:
-                                has_attachment = True
-                                filename = safe_decode(part.get_filename())
-                                file_data = part.get_payload(decode=True)
-
-                                if filename and file_data:
-                                    # CRITICAL: If this fails → skip email
-                                    saved, size = save_attachment(filename, file_data, env_config)
-                                    if saved and size:
-                                        attachments.append({
-                                            "filename": filename,
-                                            "file_path": saved,
-                                            "file_size": size
-                                        })
-                                        print(f'SIZE OF {filename}:', format_bytes(size))
-                                        total_file_size += size
-                                        
-                        print(f'TOTAL_FILE_SIZE FOR {subject}:',format_bytes(total_file_size)) 
+                        fields, max_size = prepare_internal_email(msg, content, env_config)
 
-                    else:
-                        payload = msg.get_payload(decode=True)
-                        if payload:
-                            body_text = safe_decode(payload)
+                        # STEP 1-3 (InternalEmail + EnvironmentEmail) run in bulk once per batch
+                        writer.add(email_id, fields, [environment.id], max_size=max_size)
 
-                    if env_config["REQUIRE_ATTACHMENT"] and not has_attachment:
-                        logger.info(f"Skipped — attachment required: {subject}")
+                    except CriticalRetryError as e:
+                        logger.error(f"CRITICAL FAILURE — Skipping email {email_id}: {e}")
+                        sync_blocked = True
                         continue
 
-                    if not body_text and html_body:
-                        body_text = html_to_text(html_body)
-
-                    max_size, status = False, 'pending'
-                    if total_file_size > MAX_OPENAI_FILE_SIZE:
-                        max_size, status = True, 'failed'
-                        
-                    
-                    # ---------------------------------------------------------
-                    # STEP 1: Create or get InternalEmail (global email object)
-                    # ---------------------------------------------------------
-                    try:
-                        with transaction.atomic():
-                            internal_email, created_internal = InternalEmail.objects.get_or_create(
-                                message_id=message_id,
-                                defaults={
-                                    "subject": subject,
-                                    "sender": sender,
-                                    "body": body_text,
-                                    "date_recieved": date_parsed,
-                                    "attachments": attachments,
-                                    "total_file_size": total_file_size
-                                    # "message_id": message_id
-                                }
-                            )
-                    except IntegrityError:
-                        internal_email = InternalEmail.objects.get(message_id=message_id)
-
-                    # ---------------------------------------------------------
-                    # STEP 2: CHECK if EnvironmentEmail exists → skip immediately
-                    # ---------------------------------------------------------
-                    if EnvironmentEmail.objects.filter(environment=environment, internal_email=internal_email).exists():
-                        # Already fetched for this environment — skip
+                    except RetryError as e:
+                        logger.error(f"NON-CRITICAL FAILURE — Email saved anyway: {e}")
                         continue
 
-                    # ---------------------------------------------------------
-                    # STEP 3: Create EnvironmentEmail safely
-                    # ---------------------------------------------------------
-                    try:
-                        with transaction.atomic():
-                            env_email, created_env_email = EnvironmentEmail.objects.get_or_create(
-                                environment=environment,
-                                internal_email=internal_email,
-                                defaults={
-                                    # "environment": environment,
-                                    # "internal_email": internal_email,
-                                    "status": status,
-                                    # "max_size": max_size
-                                }
-                            )
-                    except IntegrityError:
-                        # Race condition: another request created it first
+                    except Exception as e:
+                        logger.error(f"Unexpected error processing {email_id}: {e}", exc_info=True)
+                        sync_blocked = True
                         continue
-                                    
 
-                    if max_size: #50MB
+                    finally:
+                        if not sync_blocked:
+                            high_water = int(email_id)
+
+                        # Release spooled attachment files
+                        for _, file_data in content["files"]:
+                            if hasattr(file_data, "close"):
+                                file_data.close()
+
+                        if IMAP_TRACE_MEMORY:
+                            peak = tracemalloc.get_traced_memory()[1]
+                            fetch_stats["peak_message_memory"] = max(fetch_stats.get("peak_message_memory", 0), peak)
+                            logger.info(f"Peak memory for UID {email_id}: {format_bytes(peak)}")
+                            tracemalloc.reset_peak()
+
+                # Persist the whole batch before checkpointing past it
+                linked, failed = writer.flush()
+                for record, env_email in linked:
+                    if record["max_size"]: #50MB
                         max_size_emails.append(env_email)
                     else:
                         saved_emails.append(env_email)
-                    logger.info(f"Saved email — {subject}")
-
-                    # imap.store(email_id, '+FLAGS', '\\Seen')
-
-                except CriticalRetryError as e:
-                    logger.error(f"CRITICAL FAILURE — Skipping email {email_id}: {e}")
-                    continue
-
-                except RetryError as e:
-                    logger.error(f"NON-CRITICAL FAILURE — Email saved anyway: {e}")
-                    continue
-
-                except Exception as e:
-                    logger.error(f"Unexpected error processing {email_id}: {e}", exc_info=True)
-                    continue
+                    stored_uids.append(record["uid"])
+                    logger.info(f"Saved email — {env_email.internal_email.subject}")
+                if failed:
+                    sync_blocked = True
+                    high_water = min(high_water, min(int(record["uid"]) for record in failed) - 1)
+
+                fetch_stats["fetched"] = fetched_before + len(saved_emails) + len(max_size_emails)
+                if progress:
+                    progress(fetch_stats)
+                with timed("db_write"):
+                    renew_environment_lock(environment.id)
+
+                stopped = budget is not None and budget.stopped
+                scanned_uid = int(min(not_downloaded, key=int)) - 1 if stopped and not_downloaded else int(uid_chunk[-1])
+
+                if not sync_blocked and not stopped and fetch_stats["failed_batches"] == failed_batches:
+                    # Checkpoint once per fetch batch
+                    high_water = max(high_water, int(uid_chunk[-1]))
+                    commit_sync_state(sync_state, high_water)
+
+            if fetch_stats["failed_batches"] != failed_batches:
+                sync_blocked = True
+
+            if uidvalidity and not sync_blocked and not (budget is not None and budget.done):
+                # Every UID below UIDNEXT was either ingested or excluded by the search
+                high_water = max(high_water, (uidnext or 1) - 1)
+            if uidvalidity:
+                commit_sync_state(sync_state, high_water)
+
+            # Everything above is committed — mark / tag / move it on the server in one go
+            with timed("fetch"):
+                apply_post_ingest_action(imap, folder, stored_uids, env_config, fetch_stats)
+
+            if budget is not None and budget.done:
+                budget.stop_at(folder, uidvalidity, scanned_uid)
+                logger.info(f"Scan budget used up ({budget.reason}) in '{folder}' at UID {scanned_uid}.")
+                break
 
         logger.info("Completed email fetch.")
+        logger.info(
+            f"Fetch stats — round trips: {fetch_stats['round_trips']}, "
+            f"messages: {fetch_stats['messages']}, "
+            f"bytes fetched: {format_bytes(fetch_stats['bytes_fetched'])}"
+            + (f", peak message memory: {format_bytes(fetch_stats.get('peak_message_memory', 0))}" if IMAP_TRACE_MEMORY else "")
+        )
+
+    except CONNECTION_ERRORS:
+        broken = True
+        raise
 
     finally:
         if imap:
             try:
                 imap.close()
+            except (imaplib.IMAP4.abort, OSError):
+                broken = True
             except:
                 pass
-            imap.logout()
+            # Hand the logged-in connection back for the next run instead of logging out
+            imap_pool.release(env_config, imap, broken=broken)
+        if started_tracing:
+            tracemalloc.stop()
 
     return saved_emails, max_size_emails
 
 
 from .ai_process import process_email  # the AI extraction function we wrote
+from .extraction_pool import run_extractions
 
 
-def fetch_and_process_emails(env_id):
+def process_fetched_emails(fetched_emails, max_size_emails, run_stats=None, budget=None, progress=None):
     """
-    Fetch emails and automatically extract validated orders.
-    Returns counts: (fetched, processed, failed)
+    AI-process freshly saved EnvironmentEmails.
+    Returns them as a queryset; saved/processed/failed counts are added to run_stats when given.
+    With a budget, emails left once its deadline passes stay pending and go into budget.leftover_ids.
+    progress: optional callable, called with run_stats after each email
+    Emails are extracted AI_EXTRACTION_CONCURRENCY at a time; each is saved as soon as it is done.
     """
-    fetched_emails, max_size_emails = fetch_new_emails(env_id)
-    processed_count = 0
-    failed_count = 0
+    stats = run_stats if run_stats is not None else {}
+    stats["saved"] = stats.get("saved", 0) + len(fetched_emails) + len(max_size_emails)
+    stats.setdefault("processed", 0)
+    stats.setdefault("failed", 0)
+
+    def finished(env_email_obj, processed_ok):
+        if processed_ok:
+            stats["processed"] += 1
+        else:
+            stats["failed"] += 1
+        if progress:
+            progress(stats)
 
-    for env_email_obj in fetched_emails:
-        try:
-            if process_email(env_email_obj):
-                processed_count += 1
-            else:
-                failed_count += 1
-        except Exception as e:
-            logger.error(f"AI processing failed for email {env_email_obj.id}: {e}", exc_info=True)
-            failed_count += 1
+    def out_of_time():
+        return budget is not None and budget.out_of_time()
+
+    with timed("ai"):
+        leftover = run_extractions(fetched_emails, process_email, on_result=finished, should_stop=out_of_time)
+
+    if leftover:
+        budget.leftover_ids = [obj.id for obj in leftover]
+        logger.info(f"Scan deadline reached — {len(budget.leftover_ids)} emails left for the next slice.")
 
     # return len(fetched_emails), len(max_size_emails), processed_count, failed_count
     model_instance_list_ids = [obj.id for obj in fetched_emails + max_size_emails]
     model_instance_list = EnvironmentEmail.objects.filter(id__in=model_instance_list_ids).order_by('-created_at')
-    return model_instance_list
\ No newline at end of file
+    return model_instance_list
+
+
+def fetch_and_process_emails(env_id, folders=None, run_stats=None, budget=None, progress=None):
+    """
+    Fetch emails and automatically extract validated orders.
+    Returns the fetched EnvironmentEmail queryset; processed/failed counts
+    are added to run_stats when it is given.
+
+    budget: optional ScanBudget for interactive scans — emails the previous
+    slice saved but could not AI-process go first, then new mail is fetched
+    with what is left of the budget.
+    progress: optional callable, called with run_stats as the scan advances
+    """
+    carried_over = []
+    if budget is not None and budget.pending_ids:
+        carried_over = list(
+            EnvironmentEmail.objects.filter(id__in=budget.pending_ids, environment_id=env_id, status="pending")
+            .select_related("internal_email").order_by("id")
+        )
+
+    if budget is not None and budget.exhausted():
+        # Nothing left for the mailbox this time; keep the cursor where it was
+        budget.stopped = True
+        fetched_emails, max_size_emails = [], []
+    else:
+        fetched_emails, max_size_emails = fetch_new_emails(env_id, folders=folders, run_stats=run_stats, budget=budget, progress=progress)
+
+    return process_fetched_emails(carried_over + fetched_emails, max_size_emails, run_stats=run_stats, budget=budget, progress=progress)
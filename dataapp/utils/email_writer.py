@@ -0,0 +1,163 @@
+import hashlib
+import logging
+from django.db import transaction
+from django.utils import timezone
+from ..models import InternalEmail, EnvironmentEmail
+from .run_metrics import timed
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# MESSAGE KEYS
+# ============================================================
+
+def fallback_message_id(sender, date_header, subject, body, attachments):
+    """
+    Stable stand-in for a missing Message-ID: a hash of the sender, raw Date
+    header, subject, body and attachment contents. A rescan (or a replay
+    after a failed checkpoint) then dedupes on it like on a real Message-ID.
+    """
+    digest = hashlib.sha256()
+    for part in (sender, date_header, subject, body):
+        digest.update((part or "").encode("utf-8", "replace") + b"\0")
+    for att in sorted(attachments, key=lambda a: a["filename"]):
+        digest.update(f"{att['filename']}:{att.get('sha256') or att['file_size']}\0".encode("utf-8", "replace"))
+    return f"<no-message-id.{digest.hexdigest()[:40]}@local>"
+
+
+# ============================================================
+# BULK PERSISTENCE
+# ============================================================
+
+class EmailBatchWriter:
+    """
+    Collects parsed messages and writes a whole fetch batch at once:
+    one bulk INSERT per table in one transaction, one SELECT each to read
+    the IDs back. If the batch write fails, every message is retried on
+    its own so one bad row cannot sink the others.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, uid, fields, environment_ids, max_size=False, attachments_for=None):
+        """
+        Queue one message.
+        fields: InternalEmail field values, including message_id (a fallback key when the message had none)
+        environment_ids: environments the message must be linked to
+        attachments_for: {environment_id: attachments} for environments that only get some of them
+        """
+        if not fields.get("message_id"):
+            fields = dict(fields, message_id=fallback_message_id(
+                fields.get("sender"), str(fields.get("date_recieved") or ""), fields.get("subject"), fields.get("body"), fields.get("attachments") or []
+            ))
+        self.pending.append({
+            "uid": uid,
+            "fields": fields,
+            "environment_ids": list(environment_ids),
+            "max_size": max_size,
+            "attachments_for": attachments_for or {},
+        })
+
+    def flush(self):
+        """
+        Write everything queued.
+        Returns (linked, failed): linked is [(record, env_email), ...] for
+        the EnvironmentEmails created now, failed the records that could not be written.
+        """
+        records, self.pending = self.pending, []
+        if not records:
+            return [], []
+
+        with timed("db_write"):
+            return self._flush(records)
+
+    def _flush(self, records):
+        try:
+            with transaction.atomic():
+                return self._write(records), []
+        except Exception as e:
+            logger.warning(f"Bulk write of {len(records)} emails failed ({e}) — retrying one by one.")
+
+        linked, failed = [], []
+        for record in records:
+            try:
+                with transaction.atomic():
+                    linked.extend(self._write([record]))
+            except Exception as e:
+                logger.error(f"Failed to save email UID {record['uid']}: {e}", exc_info=True)
+                failed.append(record)
+        return linked, failed
+
+    def _write(self, records):
+        # ---------------------------------------------------------
+        # STEP 1: InternalEmail (global email object)
+        # ---------------------------------------------------------
+        by_message_id = {}
+        for record in records:
+            by_message_id.setdefault(record["fields"]["message_id"], record["fields"])
+
+        InternalEmail.objects.bulk_create(
+            [InternalEmail(**fields) for fields in by_message_id.values()],
+            ignore_conflicts=True
+        )
+        internal_emails = {
+            obj.message_id: obj
+            for obj in InternalEmail.objects.filter(message_id__in=list(by_message_id))
+        }
+
+        # (record, internal_email)
+        targets = [(record, internal_emails[record["fields"]["message_id"]]) for record in records]
+
+        # ---------------------------------------------------------
+        # STEP 2 & 3: Link each email to its environments
+        # ---------------------------------------------------------
+        internal_ids = {internal_email.id for _, internal_email in targets}
+        environment_ids = {env_id for record in records for env_id in record["environment_ids"]}
+        existing = set(
+            EnvironmentEmail.objects.filter(internal_email_id__in=internal_ids, environment_id__in=environment_ids)
+            .values_list("environment_id", "internal_email_id")
+        )
+
+        new_links = {}  # (environment_id, internal_email_id) → record
+        for record, internal_email in targets:
+            for env_id in record["environment_ids"]:
+                key = (env_id, internal_email.id)
+                if key not in existing and key not in new_links:
+                    new_links[key] = record
+        if not new_links:
+            return []
+
+        # ignore_conflicts hides which rows were inserted: every row of this write
+        # carries the same created_at, so rows another run linked at the same time
+        # are not read back as ours (they are duplicates, as in the per-message path)
+        written_at = timezone.now()
+        EnvironmentEmail.objects.bulk_create(
+            [
+                EnvironmentEmail(
+                    environment_id=env_id,
+                    internal_email_id=internal_id,
+                    status="failed" if record["max_size"] else "pending",
+                    attachments=record["attachments_for"].get(env_id),
+                    created_at=written_at,
+                )
+                for (env_id, internal_id), record in new_links.items()
+            ],
+            ignore_conflicts=True
+        )
+
+        linked = []
+        for env_email in EnvironmentEmail.objects.filter(
+            internal_email_id__in={internal_id for _, internal_id in new_links},
+            environment_id__in={env_id for env_id, _ in new_links},
+            created_at=written_at,
+        ).select_related("internal_email"):
+            record = new_links.get((env_email.environment_id, env_email.internal_email_id))
+            if record is not None:
+                linked.append((record, env_email))
+
+        linked.sort(key=lambda item: int(item[0]["uid"]))
+        return linked
@@ -0,0 +1,85 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.conf import settings
+from django.db import connections
+from .run_metrics import RunMetrics, collect_metrics, current_metrics
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Documents one caller (scan, reprocess request) extracts at the same time
+AI_EXTRACTION_CONCURRENCY = getattr(settings, "AI_EXTRACTION_CONCURRENCY", 4)
+
+# OpenAI calls in flight across the whole process (all environments / requests) — keeps us under rate limits
+AI_EXTRACTION_MAX_CONCURRENT = getattr(settings, "AI_EXTRACTION_MAX_CONCURRENT", 8)
+
+
+# ============================================================
+# EXTRACTION POOL
+# ============================================================
+
+extraction_slots = threading.BoundedSemaphore(max(1, AI_EXTRACTION_MAX_CONCURRENT))
+
+def run_extractions(items, process, concurrency=AI_EXTRACTION_CONCURRENCY, on_result=None, should_stop=None):
+    """
+    Call process(item) (process_email / process_upload) for each item, up to
+    `concurrency` at a time. process() persists its own result and status,
+    so each document is saved as soon as its AI call returns.
+
+    on_result(item, ok): called on the caller's thread as each one finishes.
+    should_stop(): checked before each item is started; once it returns True
+    no new item is started and those not started are returned.
+    An exception from process() counts as a failure, like before.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    outer_metrics = current_metrics()
+
+    def run(item):
+        metrics = RunMetrics()
+        try:
+            with extraction_slots, collect_metrics(metrics):
+                return bool(process(item)), metrics
+        except Exception as e:
+            logger.error(f"AI processing failed for {item.__class__.__name__} {getattr(item, 'id', None)}: {e}", exc_info=True)
+            return False, metrics
+        finally:
+            # Worker threads own their DB connections
+            connections.close_all()
+
+    def finish(future, item):
+        ok, metrics = future.result()
+        if outer_metrics is not None:
+            outer_metrics.retries.update(metrics.retries)
+        if on_result:
+            on_result(item, ok)
+
+    remaining = iter(enumerate(items))
+    in_flight = {}
+    not_started = []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items))), thread_name_prefix="ai-extraction") as executor:
+        for index, item in remaining:
+            if should_stop and should_stop():
+                not_started = items[index:]
+                break
+            in_flight[executor.submit(run, item)] = item
+
+            # Keep at most `concurrency` running, so should_stop() is honoured between documents
+            while len(in_flight) >= concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future, in_flight.pop(future))
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future, in_flight.pop(future))
+
+    return not_started
@@ -0,0 +1,78 @@
+import io
+import logging
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Store a smaller copy of every image attachment and send that one to the model
+IMAGE_PREPROCESS = getattr(settings, "IMAGE_PREPROCESS", True)
+
+# Longest side of the derived image — the model looks at images at 512px with detail "low"
+IMAGE_MAX_DIMENSION = getattr(settings, "IMAGE_MAX_DIMENSION", 512)
+
+# Drop colour (receipts and scans read the same in grayscale, at a fraction of the bytes)
+IMAGE_GRAYSCALE = getattr(settings, "IMAGE_GRAYSCALE", True)
+
+# JPEG quality of the derived image
+IMAGE_JPEG_QUALITY = getattr(settings, "IMAGE_JPEG_QUALITY", 80)
+
+IMAGE_EXTENSIONS = ("png", "jpg", "jpeg", "webp")
+
+
+# ============================================================
+# PRE-PROCESSING
+# ============================================================
+
+def preprocess_image(data):
+    """
+    Auto-orient (EXIF), grayscale, downscale to IMAGE_MAX_DIMENSION and
+    recompress as JPEG. `data` is bytes or a seekable file.
+    Returns the derived JPEG bytes, or None when the file is not a readable
+    image or the derived copy would not be smaller.
+    """
+    source = data if hasattr(data, "read") else io.BytesIO(data)
+    source.seek(0)
+    try:
+        with Image.open(source) as img:
+            original_size = _payload_size(source)
+            mode = "L" if IMAGE_GRAYSCALE else "RGB"
+            # JPEG only: decode at a reduced scale (and straight to grayscale) instead of full size
+            img.draft(mode, (IMAGE_MAX_DIMENSION * 2, IMAGE_MAX_DIMENSION * 2))
+
+            img = ImageOps.exif_transpose(img)
+            if img.mode in ("RGBA", "LA", "P"):
+                # Flatten transparency onto white, like a viewer would show it
+                background = Image.new("RGB", img.size, "white")
+                background.paste(img.convert("RGBA"), mask=img.convert("RGBA").getchannel("A"))
+                img = background
+            img = img.convert(mode)
+            img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS)
+
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+        logger.warning(f"Image pre-processing skipped: {e}")
+        return None
+    finally:
+        source.seek(0)
+
+    derived = out.getvalue()
+    if len(derived) >= original_size:
+        return None
+    return derived
+
+def _payload_size(source):
+    position = source.tell()
+    source.seek(0, io.SEEK_END)
+    size = source.tell()
+    source.seek(position)
+    return size
+
+def derived_image_name(storage_name):
+    """"scan_ab12cd34ef56.png" → "scan_ab12cd34ef56_ai.jpg"."""
+    return storage_name.rsplit(".", 1)[0] + "_ai.jpg"
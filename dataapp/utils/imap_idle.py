@@ -0,0 +1,228 @@
+import imaplib
+import logging
+import select
+import ssl
+import threading
+import time
+from django.conf import settings
+from django.db import connections
+from .email_monitor import imap_login, fetch_and_process_emails
+from .imap_pool import CONNECTION_ERRORS
+from .ingestion import get_active_environments, mailbox_key
+from .shared_mailbox import fetch_and_process_shared
+from .task_lock import wait_for_environment_lock, release_environment_lock, ENVIRONMENT_LOCK_TIMEOUT
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+IMAP_IDLE_TIMEOUT = getattr(settings, "IMAP_IDLE_TIMEOUT", 60 * 29)
+
+# Reconnect backoff (seconds) after a dropped or failed IDLE connection
+IMAP_IDLE_BACKOFF_START = getattr(settings, "IMAP_IDLE_BACKOFF_START", 5)
+IMAP_IDLE_BACKOFF_MAX = getattr(settings, "IMAP_IDLE_BACKOFF_MAX", 60 * 5)
+
+# Untagged responses that mean the selected folder changed
+IDLE_WAKEUP_RESPONSES = (b"EXISTS", b"RECENT")
+
+
+# ============================================================
+# IDLE COMMAND
+# ============================================================
+
+def has_buffered_data(imap):
+    """
+    True if imaplib's buffered reader (or TLS) already holds unread bytes.
+    select() only sees the socket, so a response that arrived in the same
+    packet as "+ idling" would otherwise wait for the whole IDLE timeout.
+    """
+    sock = imap.socket()
+    # TLS may already hold decrypted bytes that select() cannot see
+    if hasattr(sock, "pending") and sock.pending():
+        return True
+    # peek() on a non-blocking socket returns what is buffered without waiting
+    timeout = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        return bool(imap.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+def wait_readable(imap, timeout):
+    if has_buffered_data(imap):
+        return True
+    readable, _, _ = select.select([imap.socket()], [], [], timeout)
+    return bool(readable)
+
+def is_wakeup_response(line):
+    return line.startswith(b"*") and any(resp in line.upper() for resp in IDLE_WAKEUP_RESPONSES)
+
+def idle_wait(imap, timeout=IMAP_IDLE_TIMEOUT, stop_event=None):
+    """
+    Run one IDLE cycle on the selected folder (imaplib has no IDLE support).
+    Returns True as soon as the server reports new mail, False when
+    `timeout` elapses (or stop_event is set) without any.
+    """
+    tag = imap._new_tag()
+    imap.send(tag + b" IDLE\r\n")
+
+    line = imap.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+    deadline = time.monotonic() + timeout
+    new_mail = False
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (stop_event and stop_event.is_set()):
+            break
+
+        # Wake up at least once a second to honour stop_event
+        if not wait_readable(imap, min(remaining, 1.0)):
+            continue
+
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE")
+        if line.startswith(b"* BYE"):
+            raise imaplib.IMAP4.abort(f"Server closed IDLE: {line!r}")
+        if is_wakeup_response(line):
+            new_mail = True
+            break
+
+    imap.send(b"DONE\r\n")
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed while ending IDLE")
+        # Responses still buffered when IDLE ended count too
+        if is_wakeup_response(line):
+            new_mail = True
+        if line.startswith(tag):
+            if not line[len(tag):].strip().upper().startswith(b"OK"):
+                raise imaplib.IMAP4.error(f"IDLE ended with: {line!r}")
+            break
+
+    return new_mail
+
+
+# ============================================================
+# MAILBOX WATCHER
+# ============================================================
+
+# One IDLE connection per mailbox, as in shared ingestion
+watch_key = mailbox_key
+
+
+class MailboxWatcher(threading.Thread):
+    """
+    Holds IDLE on one (host, account, folder) and ingests new mail for
+    every environment that reads that folder.
+    The IDLE connection is dedicated — ingestion borrows from the IMAP pool.
+    """
+
+    def __init__(self, key, env_ids, env_config, idle_timeout=IMAP_IDLE_TIMEOUT):
+        super().__init__(name=f"idle:{key[1]}/{key[2]}", daemon=True)
+        self.key = key
+        self.env_ids = list(env_ids)
+        self.env_config = env_config
+        self.idle_timeout = idle_timeout
+        self.stop_event = threading.Event()
+
+    @property
+    def folder(self):
+        return self.key[2]
+
+    def stop(self):
+        self.stop_event.set()
+
+    def ingest(self):
+        if self.stop_event.is_set():
+            return
+
+        # Wait for other ingestion of these environments (scheduler, scan job, fetch_emails):
+        # skipping would miss mail that arrived after their SEARCH
+        locked = []
+        try:
+            for env_id in sorted(self.env_ids):  # same order everywhere, no lock cycles
+                if not wait_for_environment_lock(env_id, ENVIRONMENT_LOCK_TIMEOUT, stop_event=self.stop_event):
+                    logger.warning(f"[IDLE] Environment {env_id} stayed busy, skipping this ingest for '{self.folder}'.")
+                    return
+                locked.append(env_id)
+
+            if len(self.env_ids) == 1:
+                fetch_and_process_emails(self.env_ids[0], folders=[self.folder])
+            else:
+                # Download each new message once for every environment on this folder
+                fetch_and_process_shared(self.env_ids, self.folder)
+        except Exception as e:
+            logger.error(f"[IDLE] Ingestion failed for environments {self.env_ids} folder '{self.folder}': {e}", exc_info=True)
+        finally:
+            for env_id in locked:
+                release_environment_lock(env_id)
+            connections.close_all()
+
+    def run(self):
+        backoff = IMAP_IDLE_BACKOFF_START
+
+        while not self.stop_event.is_set():
+            imap = None
+            try:
+                imap = imap_login(self.env_config)
+                status, _ = imap.select(self.folder, readonly=True)
+                if status != "OK":
+                    raise imaplib.IMAP4.error(f"Failed to select folder '{self.folder}'")
+
+                logger.info(f"[IDLE] Watching {self.key[1]} / {self.folder} for environments {self.env_ids}")
+                backoff = IMAP_IDLE_BACKOFF_START
+
+                # Catch up on anything that arrived while we were not listening
+                self.ingest()
+
+                while not self.stop_event.is_set():
+                    if idle_wait(imap, timeout=self.idle_timeout, stop_event=self.stop_event):
+                        logger.info(f"[IDLE] New mail in {self.key[1]} / {self.folder}")
+                        self.ingest()
+
+            except Exception as e:
+                if self.stop_event.is_set():
+                    break
+                level = logging.WARNING if isinstance(e, CONNECTION_ERRORS) else logging.ERROR
+                logger.log(level, f"[IDLE] {self.key[1]} / {self.folder} dropped: {e} — reconnecting in {backoff}s")
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, IMAP_IDLE_BACKOFF_MAX)
+
+            finally:
+                if imap:
+                    try:
+                        imap.logout()
+                    except Exception:
+                        pass
+
+        logger.info(f"[IDLE] Stopped watching {self.key[1]} / {self.folder}")
+
+
+def group_watch_targets(env_ids=None):
+    """
+    Group active environments by (host, account, folder) so each folder
+    holds a single IDLE connection however many environments read it.
+    Returns {key: (env_ids, env_config)}.
+    """
+    targets = {}
+    for environment in get_active_environments(env_ids):
+        for folder in environment.email_folders:
+            key = watch_key(environment, folder)
+            if key not in targets:
+                targets[key] = ([], {
+                    "IMAP_HOST": environment.imap_host,
+                    "IMAP_EMAIL": environment.imap_email,
+                    "IMAP_PASSWORD": environment.get_imap_password(),
+                })
+            targets[key][0].append(environment.id)
+    return targets
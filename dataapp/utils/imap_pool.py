@@ -0,0 +1,168 @@
+import imaplib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Max simultaneous connections per (host, account) — most providers cap this (Gmail: 15)
+IMAP_POOL_MAX_PER_ACCOUNT = getattr(settings, "IMAP_POOL_MAX_PER_ACCOUNT", 3)
+
+# Idle connections older than this are logged out instead of reused
+IMAP_POOL_IDLE_TIMEOUT = getattr(settings, "IMAP_POOL_IDLE_TIMEOUT", 60 * 10) # 10 minutes
+
+# Idle connections older than this are checked with NOOP before reuse
+IMAP_POOL_NOOP_INTERVAL = getattr(settings, "IMAP_POOL_NOOP_INTERVAL", 60)
+
+# How long to wait for a free slot when an account is at its limit
+IMAP_POOL_ACQUIRE_TIMEOUT = getattr(settings, "IMAP_POOL_ACQUIRE_TIMEOUT", 60 * 5)
+
+# Errors that mean the connection itself is unusable
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError)
+
+
+class IMAPPoolTimeout(Exception):
+    """No connection slot became free for an account in time."""
+    pass
+
+
+# ============================================================
+# CONNECTION POOL
+# ============================================================
+
+def _logout_quietly(imap):
+    try:
+        imap.logout()
+    except Exception:
+        pass
+
+
+class IMAPConnectionPool:
+    """
+    Logged-in IMAP connections shared across environments and runs,
+    keyed by (imap_host, imap_email).
+
+    - connect(env_config) opens and logs in a new connection
+    - idle connections are checked with NOOP before reuse and reconnected on error
+    - each account is capped at max_per_account connections checked out at once
+    """
+
+    def __init__(self, connect, max_per_account=IMAP_POOL_MAX_PER_ACCOUNT,
+                 idle_timeout=IMAP_POOL_IDLE_TIMEOUT, noop_interval=IMAP_POOL_NOOP_INTERVAL):
+        self.connect = connect
+        self.max_per_account = max_per_account
+        self.idle_timeout = idle_timeout
+        self.noop_interval = noop_interval
+        self._lock = threading.Lock()
+        self._idle = {}   # key → [(imap, last_used), ...]
+        self._slots = {}  # key → BoundedSemaphore
+
+    @staticmethod
+    def pool_key(env_config):
+        return (env_config["IMAP_HOST"].lower(), env_config["IMAP_EMAIL"].lower())
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_per_account)
+            return self._slots[key]
+
+    def _pop_idle(self, key):
+        with self._lock:
+            idle = self._idle.get(key) or []
+            return idle.pop() if idle else None
+
+    def _is_alive(self, imap, last_used):
+        age = time.monotonic() - last_used
+
+        if age > self.idle_timeout:
+            return False
+        if age < self.noop_interval:
+            return True
+
+        try:
+            status, _ = imap.noop()
+            return status == "OK"
+        except CONNECTION_ERRORS:
+            return False
+
+    def acquire(self, env_config, timeout=IMAP_POOL_ACQUIRE_TIMEOUT):
+        key = self.pool_key(env_config)
+
+        if not self._slot(key).acquire(timeout=timeout):
+            raise IMAPPoolTimeout(f"No free IMAP connection for {key[1]}@{key[0]} after {timeout}s.")
+
+        try:
+            while True:
+                pooled = self._pop_idle(key)
+                if pooled is None:
+                    break
+
+                imap, last_used = pooled
+                if self._is_alive(imap, last_used):
+                    logger.info(f"Reusing pooled IMAP connection for {key[1]}.")
+                    return imap
+
+                logger.info(f"Dropping stale IMAP connection for {key[1]}.")
+                _logout_quietly(imap)
+
+            return self.connect(env_config)
+
+        except Exception:
+            self._slot(key).release()
+            raise
+
+    def release(self, env_config, imap, broken=False):
+        key = self.pool_key(env_config)
+
+        try:
+            if broken:
+                _logout_quietly(imap)
+            else:
+                with self._lock:
+                    self._idle.setdefault(key, []).append((imap, time.monotonic()))
+        finally:
+            self._slot(key).release()
+
+    @contextmanager
+    def connection(self, env_config):
+        """
+        with pool.connection(env_config) as imap: ...
+        The connection is discarded if an IMAP or socket error escapes the block.
+        """
+        imap = self.acquire(env_config)
+        broken = False
+        try:
+            yield imap
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(env_config, imap, broken=broken)
+
+    def keepalive(self):
+        """NOOP every idle connection; drop the ones that fail. Call periodically from long-running workers."""
+        with self._lock:
+            pooled = [(key, conn) for key, conns in self._idle.items() for conn in conns]
+            self._idle = {}
+
+        for key, (imap, last_used) in pooled:
+            if self._is_alive(imap, last_used - self.noop_interval):
+                with self._lock:
+                    self._idle.setdefault(key, []).append((imap, time.monotonic()))
+            else:
+                _logout_quietly(imap)
+
+    def close_all(self):
+        with self._lock:
+            pooled = [conn for conns in self._idle.values() for conn in conns]
+            self._idle = {}
+
+        for imap, _ in pooled:
+            _logout_quietly(imap)
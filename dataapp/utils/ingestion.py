@@ -0,0 +1,276 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from collections import Counter
+from django.db import connections
+from django.db.models import Avg, Count, Sum
+from django.utils import timezone
+from ..models import Environment, IngestionRun
+from .email_monitor import fetch_and_process_emails, format_bytes
+from .run_metrics import RunMetrics, collect_metrics, INGESTION_STAGES
+from .shared_mailbox import fetch_and_process_shared
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Worker threads shared by every (environment, folder) task in a run
+INGESTION_MAX_WORKERS = getattr(settings, "INGESTION_MAX_WORKERS", 8)
+
+# Max folders processed at once against the same IMAP host.
+# The per-account cap is enforced by the IMAP connection pool (IMAP_POOL_MAX_PER_ACCOUNT).
+INGESTION_MAX_PER_HOST = getattr(settings, "INGESTION_MAX_PER_HOST", 4)
+
+
+# ============================================================
+# HELPERS
+# ============================================================
+
+def get_active_environments(env_ids=None):
+    """Environments with a configured mailbox (host, account and at least one folder)."""
+    qs = Environment.objects.exclude(imap_host="").exclude(imap_email="").order_by("id")
+    if env_ids:
+        qs = qs.filter(id__in=env_ids)
+    return [env for env in qs if env.email_folders]
+
+
+def mailbox_key(environment, folder):
+    return (environment.imap_host.lower(), environment.imap_email.lower(), folder)
+
+def group_mailbox_tasks(environments, shared=False):
+    """
+    [(environments, folder), ...] to ingest.
+    shared=True puts every environment reading the same (host, account, folder) in one task.
+    """
+    if not shared:
+        return [([env], folder) for env in environments for folder in env.email_folders]
+
+    groups = {}
+    for env in environments:
+        for folder in env.email_folders:
+            groups.setdefault(mailbox_key(env, folder), []).append(env)
+    return [(envs, key[2]) for key, envs in groups.items()]
+
+
+class HostLimiter:
+    """One semaphore per IMAP host, created on first use."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, host):
+        with self._lock:
+            host = (host or "").lower()
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+
+# ============================================================
+# CONCURRENT INGESTION
+# ============================================================
+
+def ingest_folder(environment, folder, host_limiter):
+    """Fetch + AI-process one folder of one environment. Runs on a worker thread."""
+    stats = {"env_id": environment.id, "folder": folder, "error": None}
+    metrics = RunMetrics()
+    started = time.monotonic()
+
+    try:
+        with host_limiter(environment.imap_host), collect_metrics(metrics):
+            fetch_and_process_emails(environment.id, folders=[folder], run_stats=stats)
+    except Exception as e:
+        logger.error(f"Ingestion failed for environment {environment.id} folder '{folder}': {e}", exc_info=True)
+        stats["error"] = str(e)
+    finally:
+        stats["elapsed"] = time.monotonic() - started
+        stats["metrics"] = metrics
+        # Worker threads own their DB connections
+        connections.close_all()
+
+    return stats
+
+
+def ingest_mailbox(environments, folder, host_limiter):
+    """
+    Fetch + AI-process one folder shared by several environments: each
+    message is downloaded once and fanned out. Returns one stats dict per environment.
+    """
+    if len(environments) == 1:
+        return [ingest_folder(environments[0], folder, host_limiter)]
+
+    shared_stats = {}
+    env_stats = [{"env_id": env.id, "folder": folder, "error": None} for env in environments]
+    metrics = RunMetrics()
+    started = time.monotonic()
+
+    try:
+        with host_limiter(environments[0].imap_host), collect_metrics(metrics):
+            fetch_and_process_shared([env.id for env in environments], folder, run_stats=shared_stats)
+    except Exception as e:
+        logger.error(f"Shared ingestion failed for folder '{folder}' (environments {[env.id for env in environments]}): {e}", exc_info=True)
+        for stats in env_stats:
+            stats["error"] = str(e)
+    finally:
+        elapsed = time.monotonic() - started
+        connections.close_all()
+
+    for stats in env_stats:
+        stats.update(shared_stats.get("per_environment", {}).get(stats["env_id"], {}))
+        stats["elapsed"] = elapsed
+
+    # The IMAP traffic and stage timings were shared — count them once, on the first environment
+    for key in ("round_trips", "bytes_fetched", "messages", "failed_batches"):
+        env_stats[0][key] = shared_stats.get(key, 0)
+    env_stats[0]["metrics"] = metrics
+
+    return env_stats
+
+
+# ============================================================
+# RUN REPORTS
+# ============================================================
+
+SUMMARY_COUNTERS = ("saved", "messages", "bytes_fetched", "round_trips", "processed", "failed")
+
+def start_runs(environments, scheduled_for=None):
+    """Open one IngestionRun per environment. scheduled_for: optional {env_id: datetime} (for lag)."""
+    now = timezone.now()
+    scheduled_for = scheduled_for or {}
+    runs = {}
+    for env in environments:
+        due = scheduled_for.get(env.id)
+        runs[env.id] = IngestionRun.objects.create(
+            environment=env,
+            scheduled_for=due,
+            started_at=now,
+            lag_seconds=max(0.0, (now - due).total_seconds()) if due else 0,
+        )
+    return runs
+
+def finish_run(run, env_summary, error=None):
+    errors = list(env_summary.get("errors", []))
+    if error:
+        errors.append(error)
+
+    run.finished_at = timezone.now()
+    run.status = "failed" if errors else "successful"
+    run.error = "\n".join(errors)
+    for key in SUMMARY_COUNTERS:
+        setattr(run, key, env_summary.get(key, 0))
+    for stage in INGESTION_STAGES:
+        setattr(run, f"{stage}_seconds", env_summary["stage_seconds"].get(stage, 0.0))
+    run.retries = dict(env_summary["retries"])
+    run.retry_count = sum(env_summary["retries"].values())
+    run.save()
+
+def stage_report(env_ids=None, since=None):
+    """
+    Per-environment totals from IngestionRun history: runs, messages,
+    bytes, retries and seconds per stage. since: optional datetime.
+    """
+    qs = IngestionRun.objects.exclude(status="running")
+    if env_ids:
+        qs = qs.filter(environment_id__in=env_ids)
+    if since:
+        qs = qs.filter(started_at__gte=since)
+
+    return list(
+        qs.values("environment_id", "environment__name")
+        .annotate(
+            runs=Count("id"),
+            messages=Sum("messages"),
+            bytes_fetched=Sum("bytes_fetched"),
+            retry_count=Sum("retry_count"),
+            avg_lag_seconds=Avg("lag_seconds"),
+            **{f"{stage}_seconds": Sum(f"{stage}_seconds") for stage in INGESTION_STAGES}
+        )
+        .order_by("environment_id")
+    )
+
+
+def run_ingestion(env_ids=None, max_workers=INGESTION_MAX_WORKERS, max_per_host=INGESTION_MAX_PER_HOST,
+                  shared=False, scheduled_for=None):
+    """
+    Ingest every active environment's folders on a bounded thread pool.
+    shared=True fetches each (host, account, folder) once for all the environments reading it.
+    Every environment gets an IngestionRun report (stage timings, counts, retries).
+    Returns a summary dict with totals and per-environment results.
+    """
+    started = time.monotonic()
+    environments = get_active_environments(env_ids)
+    host_limiter = HostLimiter(max_per_host)
+
+    tasks = group_mailbox_tasks(environments, shared=shared)
+    folder_count = sum(len(env.email_folders) for env in environments)
+    logger.info(
+        f"Starting ingestion: {len(environments)} environments, {folder_count} folders "
+        f"({len(tasks)} mailbox tasks), {max_workers} workers."
+    )
+
+    per_environment = {
+        env.id: {"name": env.name, "folders": 0, **dict.fromkeys(SUMMARY_COUNTERS, 0), "errors": [],
+                 "stage_seconds": dict.fromkeys(INGESTION_STAGES, 0.0), "retries": Counter()}
+        for env in environments
+    }
+    runs = start_runs(environments, scheduled_for)
+
+    tick_error = None
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(ingest_mailbox, envs, folder, host_limiter) for envs, folder in tasks]
+
+            for future in as_completed(futures):
+                for stats in future.result():
+                    env_summary = per_environment[stats["env_id"]]
+                    env_summary["folders"] += 1
+                    for key in SUMMARY_COUNTERS:
+                        env_summary[key] += stats.get(key, 0)
+                    if stats["error"]:
+                        env_summary["errors"].append(f"{stats['folder']}: {stats['error']}")
+                    if stats.get("metrics"):
+                        for stage, seconds in stats["metrics"].timings.items():
+                            env_summary["stage_seconds"][stage] += seconds
+                        env_summary["retries"].update(stats["metrics"].retries)
+    except BaseException as e:
+        tick_error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        for env_id, run in runs.items():
+            finish_run(run, per_environment[env_id], error=tick_error)
+            per_environment[env_id]["run_id"] = run.id
+
+    elapsed = time.monotonic() - started
+    totals = {
+        key: sum(env_summary[key] for env_summary in per_environment.values())
+        for key in SUMMARY_COUNTERS
+    }
+    totals["stage_seconds"] = {
+        stage: sum(env_summary["stage_seconds"][stage] for env_summary in per_environment.values())
+        for stage in INGESTION_STAGES
+    }
+    totals["errors"] = sum(len(env_summary["errors"]) for env_summary in per_environment.values())
+
+    summary = {
+        "environments": len(environments),
+        "folders": folder_count,
+        "mailbox_tasks": len(tasks),
+        "elapsed": elapsed,
+        "messages_per_second": totals["messages"] / elapsed if elapsed else 0.0,
+        "totals": totals,
+        "per_environment": per_environment,
+    }
+
+    logger.info(
+        f"Ingestion finished in {elapsed:.1f}s — {totals['messages']} messages "
+        f"({format_bytes(totals['bytes_fetched'])}), {totals['saved']} saved, "
+        f"{totals['processed']} processed, {totals['failed']} failed, {totals['errors']} folder errors. "
+        "Stages: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in totals["stage_seconds"].items())
+    )
+    return summary
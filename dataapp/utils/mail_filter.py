@@ -0,0 +1,174 @@
+import fnmatch
+import re
+import threading
+from email.header import decode_header
+from email.utils import parseaddr
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Wildcard sender patterns need at least this many literal characters
+# to be narrowed server-side with FROM "<literal>"
+MIN_SERVER_LITERAL_LENGTH = 3
+
+
+# ============================================================
+# HELPERS
+# ============================================================
+
+def imap_quote(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def is_ascii(value):
+    return all(ord(ch) < 128 for ch in value)
+
+def imap_or(terms):
+    """["A", "B", "C"] → 'OR OR A B C' (IMAP OR is binary and prefix)."""
+    query = terms[0]
+    for term in terms[1:]:
+        query = f"OR {query} {term}"
+    return query
+
+def compile_keywords(keywords):
+    """Compile substrings into one case-insensitive alternation — one pass per subject whatever the list size."""
+    keywords = sorted({k.strip().lower() for k in keywords if k and k.strip()}, key=len, reverse=True)
+    if not keywords:
+        return None
+    return re.compile("|".join(re.escape(k) for k in keywords), re.IGNORECASE)
+
+def decode_header_value(value):
+    return "".join(
+        text.decode(enc or "utf-8", errors="ignore") if isinstance(text, bytes) else text
+        for text, enc in decode_header(value or "")
+    )
+
+
+# ============================================================
+# COMPILED FILTER
+# ============================================================
+
+class MailFilter:
+    """
+    An environment's sender/subject rules compiled once.
+
+    allowed_senders entries:
+      - plain text ("bob@acme.com", "@acme.com") → substring of the From header,
+        exactly like IMAP SEARCH FROM
+      - wildcards ("*@acme.com", "*@*.acme.com", "billing-*@acme.com") → glob
+        over the sender address
+
+    search_criteria() pushes everything the server can evaluate into SEARCH;
+    matches() re-checks the rest on headers only (Subject / From).
+    """
+
+    def __init__(self, allowed_senders=None, allowed_subject_keywords=None, blocked_subject_keywords=None):
+        senders = [s.strip().lower() for s in allowed_senders or [] if s and s.strip()]
+        self.sender_substrings = [s for s in senders if "*" not in s and "?" not in s]
+        self.sender_globs = [s for s in senders if s not in self.sender_substrings]
+        self.sender_glob_pattern = (
+            re.compile("|".join(fnmatch.translate(s) for s in self.sender_globs), re.IGNORECASE)
+            if self.sender_globs else None
+        )
+        self.sender_substring_pattern = compile_keywords(self.sender_substrings)
+
+        self.allowed_subject_keywords = [k for k in allowed_subject_keywords or [] if k and k.strip()]
+        self.blocked_subject_keywords = [k for k in blocked_subject_keywords or [] if k and k.strip()]
+        self.allowed_subject_pattern = compile_keywords(self.allowed_subject_keywords)
+        self.blocked_subject_pattern = compile_keywords(self.blocked_subject_keywords)
+
+    @property
+    def has_sender_rules(self):
+        return bool(self.sender_substrings or self.sender_globs)
+
+    # ---------------- SERVER SIDE ----------------
+
+    def _server_sender_terms(self):
+        """FROM terms covering every allowed sender, or None if any pattern cannot be narrowed safely."""
+        terms = []
+        for sender in self.sender_substrings:
+            if not is_ascii(sender):
+                return None
+            terms.append(f"FROM {imap_quote(sender)}")
+
+        for pattern in self.sender_globs:
+            literal = max(re.split(r"[*?]", pattern), key=len)
+            if len(literal) < MIN_SERVER_LITERAL_LENGTH or not is_ascii(literal):
+                return None
+            terms.append(f"FROM {imap_quote(literal)}")
+
+        return terms
+
+    def search_criteria(self):
+        """IMAP SEARCH criteria (list of strings, ANDed) implied by these rules."""
+        criteria = []
+
+        if self.has_sender_rules:
+            terms = self._server_sender_terms()
+            if terms:
+                criteria.append(imap_or(terms))
+
+        if self.allowed_subject_keywords and all(is_ascii(k) for k in self.allowed_subject_keywords):
+            criteria.append(imap_or([f"SUBJECT {imap_quote(k)}" for k in self.allowed_subject_keywords]))
+
+        for keyword in self.blocked_subject_keywords:
+            if is_ascii(keyword):
+                criteria.append(f"NOT SUBJECT {imap_quote(keyword)}")
+
+        return criteria
+
+    # ---------------- CLIENT SIDE ----------------
+
+    def sender_allowed(self, from_header):
+        if not self.has_sender_rules:
+            return True
+
+        from_header = decode_header_value(from_header).lower()
+        if self.sender_substring_pattern and self.sender_substring_pattern.search(from_header):
+            return True
+
+        address = parseaddr(from_header)[1]
+        return bool(self.sender_glob_pattern and self.sender_glob_pattern.match(address))
+
+    def matches(self, subject, from_header):
+        """
+        Header-only check of a message against the rules.
+        Returns (True, None) or (False, reason).
+        """
+        subject = subject or ""
+
+        if self.blocked_subject_pattern and self.blocked_subject_pattern.search(subject):
+            return False, "blocked subject"
+
+        if self.allowed_subject_pattern and not self.allowed_subject_pattern.search(subject):
+            return False, "subject not allowed"
+
+        if not self.sender_allowed(from_header):
+            return False, "sender not allowed"
+
+        return True, None
+
+
+# ============================================================
+# PER-ENVIRONMENT CACHE
+# ============================================================
+
+_cache_lock = threading.Lock()
+_filter_cache = {}  # env id → (updated_at, MailFilter)
+
+def get_mail_filter(environment):
+    """Compiled MailFilter for an environment, rebuilt only when its updated_at changes."""
+    with _cache_lock:
+        cached = _filter_cache.get(environment.id)
+        if cached and cached[0] == environment.updated_at:
+            return cached[1]
+
+    mail_filter = MailFilter(
+        allowed_senders=environment.allowed_senders,
+        allowed_subject_keywords=environment.allowed_subject_keywords,
+        blocked_subject_keywords=environment.blocked_subject_keywords,
+    )
+
+    with _cache_lock:
+        _filter_cache[environment.id] = (environment.updated_at, mail_filter)
+    return mail_filter
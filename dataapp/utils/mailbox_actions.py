@@ -0,0 +1,116 @@
+import imaplib
+import logging
+import re
+from django.conf import settings
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# UIDs per STORE / MOVE command (the UID set is compressed into ranges first)
+IMAP_ACTION_MAX_UIDS = getattr(settings, "IMAP_ACTION_MAX_UIDS", 5000)
+
+# IMAP keywords are atoms: no spaces, parentheses, quotes, wildcards or backslashes
+KEYWORD_PATTERN = re.compile(r"^[A-Za-z0-9_.$\-]+$")
+
+
+# ============================================================
+# POST-INGEST ACTIONS
+# ============================================================
+
+def get_post_ingest_action(env_config):
+    """(action, argument) for an env_config, or None when messages are left as they are."""
+    action = env_config.get("POST_INGEST_ACTION") or "none"
+
+    if action == "seen":
+        return ("seen", None)
+    if action == "keyword" and env_config.get("POST_INGEST_KEYWORD"):
+        return ("keyword", env_config["POST_INGEST_KEYWORD"])
+    if action == "move" and env_config.get("POST_INGEST_FOLDER"):
+        return ("move", env_config["POST_INGEST_FOLDER"])
+
+    if action != "none":
+        logger.warning(f"Post-ingest action '{action}' is missing its keyword / folder, ignoring it.")
+    return None
+
+def post_ingest_search_criteria(env_config):
+    """Extra SEARCH criteria hiding messages that already carry the post-ingest keyword."""
+    action = get_post_ingest_action(env_config)
+    if action and action[0] == "keyword":
+        return [f"UNKEYWORD {action[1]}"]
+    return []
+
+def compress_uid_set(uids):
+    """[1, 2, 3, 7, 9, 10] → "1:3,7,9:10"."""
+    ranges = []
+    for uid in sorted({int(uid) for uid in uids}):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+def quote_mailbox(name):
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def apply_post_ingest_action(imap, folder, uids, env_config, fetch_stats=None):
+    """
+    Mark / tag / move messages that are safely stored in the database,
+    with one UID command per IMAP_ACTION_MAX_UIDS messages.
+    `folder` must be the selected (read-write) folder.
+    Returns the number of messages the action was applied to.
+    """
+    action = get_post_ingest_action(env_config)
+    uids = sorted({int(uid) for uid in uids})
+    if not action or not uids:
+        return 0
+
+    name, argument = action
+    capabilities = getattr(imap, "capabilities", ())
+    applied = 0
+
+    for start in range(0, len(uids), IMAP_ACTION_MAX_UIDS):
+        chunk = uids[start:start + IMAP_ACTION_MAX_UIDS]
+        uid_set = compress_uid_set(chunk)
+
+        if name == "seen":
+            commands = [("STORE", uid_set, "+FLAGS.SILENT", "(\\Seen)")]
+        elif name == "keyword":
+            commands = [("STORE", uid_set, "+FLAGS.SILENT", f"({argument})")]
+        elif "MOVE" in capabilities:
+            commands = [("MOVE", uid_set, quote_mailbox(argument))]
+        else:
+            # No MOVE extension: COPY, then flag the originals as deleted
+            commands = [
+                ("COPY", uid_set, quote_mailbox(argument)),
+                ("STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)"),
+            ]
+            if "UIDPLUS" in capabilities:
+                commands.append(("EXPUNGE", uid_set))
+            else:
+                logger.info(f"Server lacks UIDPLUS — moved messages stay flagged \\Deleted in '{folder}' until it is expunged.")
+
+        responses = []
+        try:
+            for command in commands:
+                responses.append(imap.uid(*command))
+                if fetch_stats is not None:
+                    fetch_stats["round_trips"] = fetch_stats.get("round_trips", 0) + 1
+                if responses[-1][0] != "OK":
+                    # Never flag originals as deleted when the COPY did not go through
+                    break
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as e:
+            logger.warning(f"Post-ingest '{name}' failed in '{folder}' for UIDs {uid_set}: {e}")
+            continue
+
+        if all(status == "OK" for status, _ in responses):
+            applied += len(chunk)
+        else:
+            logger.warning(f"Post-ingest '{name}' rejected in '{folder}' for UIDs {uid_set}: {responses}")
+
+    logger.info(f"Post-ingest '{name}' applied to {applied}/{len(uids)} messages in '{folder}'.")
+    return applied
@@ -0,0 +1,214 @@
+import binascii
+import os
+import quopri
+import re
+import tempfile
+from email.header import decode_header
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+from django.conf import settings
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Decoded attachments stay in memory up to this size, then spill to a temp file
+ATTACHMENT_SPOOL_SIZE = getattr(settings, "ATTACHMENT_SPOOL_SIZE", 1024 ** 2 * 5) # 5MB
+
+WHITESPACE_PATTERN = re.compile(rb"\s+")
+
+
+# ============================================================
+# BODYSTRUCTURE → FLAT PART LIST
+# ============================================================
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="ignore")
+    return value or ""
+
+def _params(value):
+    """IMAP parameter list ("KEY" "value" ...) → {key: value}."""
+    if not isinstance(value, list):
+        return {}
+    return {
+        _text(value[i]).lower(): _text(value[i + 1])
+        for i in range(0, len(value) - 1, 2)
+    }
+
+def _decode_filename(params):
+    if "filename*" in params:
+        return collapse_rfc2231_value(decode_rfc2231(params["filename*"]))
+
+    raw = params.get("filename") or params.get("name") or ""
+    return "".join(
+        text.decode(enc or "utf-8", errors="ignore") if isinstance(text, bytes) else text
+        for text, enc in decode_header(raw)
+    )
+
+def list_body_parts(structure, section=""):
+    """
+    Flatten a parsed BODYSTRUCTURE into leaf parts:
+    {"section", "content_type", "charset", "encoding", "size", "disposition", "filename"}.
+    Encapsulated messages (message/rfc822) are descended into, like Message.walk().
+    Returns None if the structure cannot be understood.
+    """
+    if not isinstance(structure, list) or not structure:
+        return None
+
+    # Multipart: child parts first, then the subtype and extension data
+    if isinstance(structure[0], list):
+        parts = []
+        for index, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            child_parts = list_body_parts(child, f"{section}.{index + 1}" if section else str(index + 1))
+            if child_parts is None:
+                return None
+            parts.extend(child_parts)
+        return parts
+
+    if len(structure) < 7 or not isinstance(structure[0], bytes):
+        return None
+
+    maintype = _text(structure[0]).lower()
+    subtype = _text(structure[1]).lower()
+    params = _params(structure[2])
+    section = section or "1"
+
+    # Extension data starts after the type-specific fields: md5, then disposition
+    if maintype == "text":
+        ext_start = 8
+    elif (maintype, subtype) == ("message", "rfc822"):
+        ext_start = 10
+    else:
+        ext_start = 7
+
+    disposition, disposition_params = "", {}
+    raw_disposition = structure[ext_start + 1] if len(structure) > ext_start + 1 else None
+    if isinstance(raw_disposition, list) and raw_disposition:
+        disposition = _text(raw_disposition[0]).lower()
+        disposition_params = _params(raw_disposition[1] if len(raw_disposition) > 1 else None)
+
+    part = {
+        "section": section,
+        "content_type": f"{maintype}/{subtype}",
+        "charset": params.get("charset"),
+        "encoding": _text(structure[5]).lower() or "7bit",
+        "size": int(structure[6]) if _text(structure[6]).isdigit() else 0,
+        "disposition": disposition,
+        "filename": _decode_filename({**params, **disposition_params}),
+    }
+
+    if (maintype, subtype) == ("message", "rfc822") and len(structure) > 8 and isinstance(structure[8], list):
+        inner = structure[8]
+        inner_section = section if isinstance(inner[0], list) else f"{section}.1"
+        inner_parts = list_body_parts(inner, inner_section)
+        if inner_parts is None:
+            return None
+        # Keep the wrapper so its disposition still counts as an attachment
+        return [dict(part, wrapper=True)] + inner_parts
+
+    return [part]
+
+def select_wanted_parts(parts, allowed_file_types, is_multipart=True):
+    """
+    Pick the parts ingestion actually uses: inline text/plain and text/html
+    bodies, and attachments whose extension is allowed.
+    Returns (wanted_parts, has_attachment).
+    """
+    wanted = []
+    has_attachment = False
+
+    for part in parts:
+        is_attachment = "attachment" in part["disposition"]
+        if is_attachment:
+            has_attachment = True
+
+        if part.get("wrapper"):
+            continue
+
+        if not is_multipart:
+            # Single-part message: the body itself is the text
+            if part["content_type"].startswith("text/"):
+                wanted.append(dict(part, role="body"))
+            continue
+
+        if is_attachment:
+            ext = os.path.splitext(part["filename"] or "")[1][1:].lower()
+            if part["filename"] and ext in allowed_file_types:
+                wanted.append(dict(part, role="attachment"))
+
+        elif part["content_type"] == "text/plain":
+            wanted.append(dict(part, role="text"))
+
+        elif part["content_type"] == "text/html":
+            wanted.append(dict(part, role="html"))
+
+    return wanted, has_attachment
+
+
+# ============================================================
+# STREAMING TRANSFER-ENCODING DECODER
+# ============================================================
+
+class PartDecoder:
+    """
+    Decode a base64 / quoted-printable / 7bit body part fed in chunks
+    into a SpooledTemporaryFile, so large parts never exist as one bytes object.
+    """
+
+    def __init__(self, encoding, spool_size=ATTACHMENT_SPOOL_SIZE):
+        self.encoding = (encoding or "7bit").lower()
+        self.output = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.carry = b""
+        self.size = 0
+
+    def _write(self, data):
+        if data:
+            self.output.write(data)
+            self.size += len(data)
+
+    def feed(self, chunk):
+        data = self.carry + (chunk or b"")
+
+        if self.encoding == "base64":
+            data = WHITESPACE_PATTERN.sub(b"", data)
+            cut = len(data) - len(data) % 4
+            self.carry = data[cut:]
+            self._write(binascii.a2b_base64(data[:cut]))
+
+        elif self.encoding == "quoted-printable":
+            # Only decode whole lines so soft line breaks are never split
+            cut = data.rfind(b"\n") + 1
+            self.carry = data[cut:]
+            self._write(quopri.decodestring(data[:cut]))
+
+        else:
+            self.carry = b""
+            self._write(data)
+
+    def finish(self):
+        """Flush the remainder and return the decoded file, rewound."""
+        if self.carry:
+            if self.encoding == "base64":
+                padded = self.carry + b"=" * (-len(self.carry) % 4)
+                try:
+                    self._write(binascii.a2b_base64(padded))
+                except binascii.Error:
+                    pass
+            elif self.encoding == "quoted-printable":
+                self._write(quopri.decodestring(self.carry))
+            self.carry = b""
+
+        self.output.seek(0)
+        return self.output
+
+    @property
+    def spooled_to_disk(self):
+        return getattr(self.output, "_rolled", False)
+
+def decode_text_payload(payload, charset=None):
+    try:
+        return payload.decode(charset or "utf-8", errors="ignore")
+    except LookupError:
+        return payload.decode("utf-8", errors="ignore")
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# ============================================================
+# PER-RUN STAGE TIMINGS
+# ============================================================
+
+# Stages reported on IngestionRun (<stage>_seconds fields)
+INGESTION_STAGES = ("login", "select", "search", "fetch", "parse", "upload", "db_write", "ai")
+
+_local = threading.local()
+
+
+class RunMetrics:
+    """
+    Wall time per ingestion stage plus retry counts, for one worker thread.
+    Stages nest: time spent in an inner stage (e.g. a ranged fetch inside
+    MIME parsing) is only counted for the inner one.
+    """
+
+    def __init__(self):
+        self.timings = dict.fromkeys(INGESTION_STAGES, 0.0)
+        self.retries = Counter()
+        self._stack = []
+        self._mark = None
+
+    def _charge(self, now):
+        if self._stack:
+            self.timings[self._stack[-1]] += now - self._mark
+        self._mark = now
+
+    def enter(self, stage):
+        self._charge(time.perf_counter())
+        self._stack.append(stage)
+
+    def exit(self):
+        self._charge(time.perf_counter())
+        self._stack.pop()
+
+    def merge(self, other):
+        for stage, seconds in other.timings.items():
+            self.timings[stage] += seconds
+        self.retries.update(other.retries)
+
+
+def current_metrics():
+    return getattr(_local, "metrics", None)
+
+@contextmanager
+def collect_metrics(metrics):
+    """Route timed() / record_retry() calls on this thread into `metrics`."""
+    previous = current_metrics()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+@contextmanager
+def timed(stage):
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+
+    metrics.enter(stage)
+    try:
+        yield
+    finally:
+        metrics.exit()
+
+def record_retry(name):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.retries[name] += 1
@@ -0,0 +1,185 @@
+import logging
+import time
+from django.conf import settings
+from django.core import signing
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Defaults for one interactive scan slice (scan_inbox view)
+SCAN_DEADLINE_SECONDS = getattr(settings, "SCAN_DEADLINE_SECONDS", 20)
+SCAN_MAX_MESSAGES = getattr(settings, "SCAN_MAX_MESSAGES", 25)
+SCAN_MAX_BYTES = getattr(settings, "SCAN_MAX_BYTES", 1024 ** 2 * 25) # 25MB
+
+# Upper bounds a client may ask for
+SCAN_DEADLINE_LIMIT = getattr(settings, "SCAN_DEADLINE_LIMIT", 60)
+SCAN_MAX_MESSAGES_LIMIT = getattr(settings, "SCAN_MAX_MESSAGES_LIMIT", 200)
+SCAN_MAX_BYTES_LIMIT = getattr(settings, "SCAN_MAX_BYTES_LIMIT", 1024 ** 2 * 200) # 200MB
+
+# Continuation tokens expire after this long
+SCAN_CURSOR_MAX_AGE = getattr(settings, "SCAN_CURSOR_MAX_AGE", 60 * 60 * 24) # 1 day
+
+SCAN_CURSOR_SALT = "dataapp.scan-cursor"
+
+
+class InvalidScanCursor(Exception):
+    pass
+
+
+# ============================================================
+# SCAN BUDGET
+# ============================================================
+
+class ScanBudget:
+    """
+    Deadline, message count and byte count for one slice of an inbox scan.
+
+    Limits are soft: they are checked between messages, so one message (or
+    one AI call) in flight always finishes. When a limit is hit the scan
+    stops cleanly and next_cursor() tells the next slice where to resume.
+    """
+
+    def __init__(self, deadline=SCAN_DEADLINE_SECONDS, max_messages=SCAN_MAX_MESSAGES, max_bytes=SCAN_MAX_BYTES, cursor=None, env_id=None):
+        self.started = time.monotonic()
+        self.deadline = deadline
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.env_id = env_id
+
+        state = decode_scan_cursor(cursor, env_id) if cursor else {}
+        self.folder = state.get("folder")
+        self.uid = state.get("uid", 0)
+        self.uidvalidity = state.get("uidvalidity")
+        self.pending_ids = state.get("pending", [])
+
+        self.messages = 0
+        self.progress = 0
+        self.fetch_stats = None
+        self.bytes_baseline = 0
+        self.truncated = False
+        self.stopped = False
+        self.reason = None
+        self.leftover_ids = []
+
+    # ---------------------------------------------------------
+    # Limits
+    # ---------------------------------------------------------
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def bytes_used(self):
+        if self.fetch_stats is None:
+            return 0
+        return self.fetch_stats["bytes_fetched"] - self.bytes_baseline
+
+    def out_of_time(self):
+        if self.deadline and self.elapsed() >= self.deadline:
+            self.reason = self.reason or "deadline"
+            return True
+        return False
+
+    def exhausted(self):
+        if self.out_of_time():
+            return True
+        if self.max_bytes and self.bytes_used() >= self.max_bytes:
+            self.reason = self.reason or "bytes"
+            return True
+        if self.max_messages and self.messages >= self.max_messages:
+            self.reason = self.reason or "messages"
+            return True
+        return False
+
+    @property
+    def done(self):
+        """True once the scan stopped short of the end of the mailbox."""
+        return self.truncated or self.stopped
+
+    # ---------------------------------------------------------
+    # Hooks for fetch_new_emails()
+    # ---------------------------------------------------------
+
+    def start_fetch(self, fetch_stats):
+        self.fetch_stats = fetch_stats
+        self.bytes_baseline = fetch_stats["bytes_fetched"]
+
+    def resume_folders(self, folders):
+        """Folders still to scan, starting with the cursor's."""
+        if self.folder in folders:
+            return folders[folders.index(self.folder):]
+        return folders
+
+    def resume_uid(self, folder, uidvalidity):
+        """Last UID the previous slice got through in `folder` (0 if none / stale)."""
+        if folder == self.folder and uidvalidity and uidvalidity == self.uidvalidity:
+            return self.uid
+        return 0
+
+    def take(self, uids):
+        """Cap a SEARCH result to the messages left in the budget."""
+        remaining = self.max_messages - self.messages if self.max_messages else len(uids)
+        if len(uids) > remaining:
+            self.truncated = True
+            self.reason = self.reason or "messages"
+            uids = uids[:max(remaining, 0)]
+        self.messages += len(uids)
+        return uids
+
+    def limit(self, iterable):
+        """
+        Yield from `iterable` until the budget runs out; the next item is only
+        pulled while it lasts. Every slice gets through at least one item, so
+        a tiny budget still moves the cursor forward.
+        """
+        iterator = iter(iterable)
+        while True:
+            if self.progress and (self.out_of_time() or (self.max_bytes and self.bytes_used() >= self.max_bytes)):
+                self.reason = self.reason or "bytes"
+                self.stopped = True
+                return
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+            self.progress += 1
+
+    def stop_at(self, folder, uidvalidity, uid):
+        self.folder, self.uidvalidity, self.uid = folder, uidvalidity, uid
+
+    # ---------------------------------------------------------
+    # Continuation
+    # ---------------------------------------------------------
+
+    def next_cursor(self):
+        """Signed token for the next slice, or None when the scan is complete."""
+        if not (self.done or self.leftover_ids):
+            return None
+        state = {"env": self.env_id, "pending": self.leftover_ids}
+        if self.done:
+            state.update(folder=self.folder, uidvalidity=self.uidvalidity, uid=self.uid)
+        return signing.dumps(state, salt=SCAN_CURSOR_SALT, compress=True)
+
+    def summary(self):
+        return {
+            "messages": self.messages,
+            "bytes": self.bytes_used(),
+            "seconds": round(self.elapsed(), 2),
+            "stopped_by": self.reason if (self.done or self.leftover_ids) else None,
+        }
+
+
+def decode_scan_cursor(cursor, env_id=None):
+    try:
+        state = signing.loads(cursor, salt=SCAN_CURSOR_SALT, max_age=SCAN_CURSOR_MAX_AGE)
+    except signing.SignatureExpired:
+        raise InvalidScanCursor("Scan cursor has expired, start a new scan.")
+    except signing.BadSignature:
+        raise InvalidScanCursor("Invalid scan cursor.")
+
+    if env_id is not None and state.get("env") != env_id:
+        raise InvalidScanCursor("Scan cursor belongs to another environment.")
+    return state
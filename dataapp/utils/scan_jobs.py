@@ -0,0 +1,221 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from ..models import ScanJob
+from .email_monitor import fetch_and_process_emails
+from .task_lock import wait_for_environment_lock, release_environment_lock, renew_lock, environment_lock_name
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Seconds an idle worker waits before looking for queued jobs again
+SCAN_JOB_POLL_INTERVAL = getattr(settings, "SCAN_JOB_POLL_INTERVAL", 2)
+
+# A running job without a progress update for this long is assumed dead
+SCAN_JOB_TIMEOUT = getattr(settings, "SCAN_JOB_TIMEOUT", 60 * 15) # 15 min
+
+# Dead jobs are restarted until they have been tried this many times
+SCAN_JOB_MAX_ATTEMPTS = getattr(settings, "SCAN_JOB_MAX_ATTEMPTS", 3)
+
+# Jobs one worker process runs at the same time
+SCAN_WORKER_CONCURRENCY = getattr(settings, "SCAN_WORKER_CONCURRENCY", 2)
+
+# Progress is written at most this often (seconds)
+SCAN_JOB_PROGRESS_INTERVAL = getattr(settings, "SCAN_JOB_PROGRESS_INTERVAL", 1)
+
+# A running job's heartbeat is renewed this often, whatever stage it is in (keep well below SCAN_JOB_TIMEOUT)
+SCAN_JOB_HEARTBEAT_INTERVAL = getattr(settings, "SCAN_JOB_HEARTBEAT_INTERVAL", 30)
+
+# How long a job waits for another ingestion of its environment (scheduler, fetch_emails, IDLE) to finish
+SCAN_JOB_LOCK_WAIT = getattr(settings, "SCAN_JOB_LOCK_WAIT", 60 * 10) # 10 min
+
+
+# ============================================================
+# SUBMISSION
+# ============================================================
+
+def submit_scan_job(environment, user=None):
+    """
+    Queue a scan of `environment`. An environment has at most one active
+    job: submitting again while one is queued or running returns that one.
+    Returns (job, created).
+    """
+    active = ScanJob.objects.filter(environment=environment, status__in=("queued", "running")).order_by("created_at").first()
+    if active:
+        return active, False
+
+    job = ScanJob.objects.create(environment=environment, requested_by=user if user and user.is_authenticated else None)
+    logger.info(f"[SCAN JOBS] Queued scan job {job.id} for {environment.name}.")
+    return job, True
+
+
+# ============================================================
+# WORKER
+# ============================================================
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+def claim_next_job(worker):
+    """
+    Mark the oldest queued job (or a running job whose worker stopped
+    reporting) as running and return it; None if there is nothing to do.
+    The claim is a conditional UPDATE, so any number of worker processes
+    can poll the same table.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=SCAN_JOB_TIMEOUT)
+
+    # Give up on jobs that keep killing their worker
+    for job in ScanJob.objects.filter(status="running", heartbeat_at__lt=stale, attempts__gte=SCAN_JOB_MAX_ATTEMPTS):
+        ScanJob.objects.filter(id=job.id, status="running", heartbeat_at=job.heartbeat_at).update(
+            status="failed", finished_at=now, error=f"Worker stopped responding ({job.attempts} attempts)."
+        )
+
+    candidates = (
+        ScanJob.objects
+        .filter(Q(status="queued") | Q(status="running", heartbeat_at__lt=stale))
+        .order_by("created_at")
+        .values_list("id", "status", "heartbeat_at", "attempts")[:10]
+    )
+
+    for job_id, status, heartbeat_at, attempts in candidates:
+        if status == "running":
+            logger.warning(f"[SCAN JOBS] Job {job_id} stopped reporting at {heartbeat_at} — restarting.")
+
+        updated = ScanJob.objects.filter(id=job_id, status=status, heartbeat_at=heartbeat_at).update(
+            status="running", started_at=now, heartbeat_at=now, worker=worker, attempts=attempts + 1
+        )
+        if updated:
+            return ScanJob.objects.select_related("environment").get(id=job_id)
+
+    return None
+
+def owned_job(job):
+    """
+    The job's row while this claim still owns it. If the job was declared
+    dead and claimed again, updates through this match nothing.
+    """
+    return ScanJob.objects.filter(id=job.id, status="running", worker=job.worker, attempts=job.attempts)
+
+
+class JobHeartbeat(threading.Thread):
+    """
+    Renews a running job's heartbeat_at (and the environment lock) every
+    SCAN_JOB_HEARTBEAT_INTERVAL, so a single slow FETCH, upload or AI call
+    never makes a live job look dead to other workers.
+    """
+
+    def __init__(self, job, interval=SCAN_JOB_HEARTBEAT_INTERVAL):
+        super().__init__(name=f"scan-job-heartbeat:{job.id}", daemon=True)
+        self.job = job
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.holds_lock = False
+
+    def run(self):
+        try:
+            while not self.stop_event.wait(self.interval):
+                if not owned_job(self.job).update(heartbeat_at=timezone.now()):
+                    logger.warning(f"[SCAN JOBS] Job {self.job.id} was claimed by another worker.")
+                    return
+                if self.holds_lock:
+                    renew_lock(environment_lock_name(self.job.environment_id))
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+def run_scan_job(job):
+    """Scan the job's environment, writing progress to the job as it goes."""
+    last_write = [0.0]
+
+    def report(stats, force=False):
+        now = time.monotonic()
+        if not force and now - last_write[0] < SCAN_JOB_PROGRESS_INTERVAL:
+            return
+        last_write[0] = now
+        owned_job(job).update(
+            heartbeat_at=timezone.now(),
+            messages_found=stats.get("found", 0),
+            messages_fetched=stats.get("fetched", 0),
+            extracted=stats.get("processed", 0),
+            failed=stats.get("failed", 0),
+        )
+
+    stats = {}
+    heartbeat = JobHeartbeat(job)
+    heartbeat.start()
+    try:
+        # Never scan the inbox while another path is ingesting it
+        if not wait_for_environment_lock(job.environment_id, SCAN_JOB_LOCK_WAIT):
+            error = "The environment is still being ingested by another run."
+            logger.warning(f"[SCAN JOBS] Scan job {job.id}: {error}")
+            owned_job(job).update(status="failed", finished_at=timezone.now(), error=error)
+            return False
+
+        heartbeat.holds_lock = True
+        logger.info(f"[SCAN JOBS] Running scan job {job.id} for {job.environment.name}.")
+        try:
+            fetched_emails = fetch_and_process_emails(job.environment_id, run_stats=stats, progress=report)
+        except Exception as e:
+            logger.error(f"[SCAN JOBS] Scan job {job.id} failed: {e}", exc_info=True)
+            report(stats, force=True)
+            owned_job(job).update(status="failed", finished_at=timezone.now(), error=str(e))
+            return False
+        finally:
+            heartbeat.holds_lock = False
+            release_environment_lock(job.environment_id)
+    finally:
+        heartbeat.stop()
+
+    report(stats, force=True)
+    updated = owned_job(job).update(
+        status="successful",
+        finished_at=timezone.now(),
+        email_ids=list(fetched_emails.values_list("id", flat=True)),
+    )
+    if not updated:
+        logger.warning(f"[SCAN JOBS] Job {job.id} finished after another worker took it over; its result was not recorded.")
+        return False
+    logger.info(
+        f"[SCAN JOBS] Scan job {job.id} done — found: {stats.get('found', 0)}, fetched: {stats.get('fetched', 0)}, "
+        f"extracted: {stats.get('processed', 0)}, failed: {stats.get('failed', 0)}"
+    )
+    return True
+
+def run_worker_loop(stop_event, once=False, poll_interval=SCAN_JOB_POLL_INTERVAL):
+    """
+    One worker thread: claim and run jobs until stop_event is set
+    (or, with once=True, until the queue is empty). Returns jobs run.
+    """
+    worker = worker_name()
+    jobs_run = 0
+    try:
+        while not stop_event.is_set():
+            job = claim_next_job(worker)
+            if job is None:
+                if once:
+                    break
+                stop_event.wait(poll_interval)
+                continue
+
+            run_scan_job(job)
+            jobs_run += 1
+    finally:
+        # Worker threads own their DB connections
+        connections.close_all()
+    return jobs_run
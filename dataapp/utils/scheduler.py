@@ -0,0 +1,189 @@
+import logging
+import random
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from ..models import IngestionSchedule, ScanJob
+from .ingestion import get_active_environments, run_ingestion, INGESTION_MAX_WORKERS, INGESTION_MAX_PER_HOST
+from .task_lock import (
+    TaskAlreadyRunning, acquire_environment_lock, release_environment_lock, lock_is_held, FETCH_EMAILS_LOCK,
+)
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Defaults for environments that don't have a schedule yet
+INGESTION_DEFAULT_INTERVAL = getattr(settings, "INGESTION_DEFAULT_INTERVAL", 60 * 5) # 5 min
+INGESTION_DEFAULT_JITTER = getattr(settings, "INGESTION_DEFAULT_JITTER", 30)
+
+# Quiet mailboxes double their interval after every empty run, up to this
+INGESTION_MAX_BACKOFF = getattr(settings, "INGESTION_MAX_BACKOFF", 60 * 60) # 1 hour
+
+# Failed runs are retried on the normal interval, never later than this
+INGESTION_ERROR_RETRY = getattr(settings, "INGESTION_ERROR_RETRY", 60 * 5) # 5 min
+
+# A run still marked as running after this long is assumed dead
+INGESTION_RUN_TIMEOUT = getattr(settings, "INGESTION_RUN_TIMEOUT", 60 * 30) # 30 min
+
+# Environments started per scheduler tick (highest priority first)
+SCHEDULER_MAX_ENVIRONMENTS = getattr(settings, "SCHEDULER_MAX_ENVIRONMENTS", INGESTION_MAX_WORKERS)
+
+
+# ============================================================
+# SCHEDULE HELPERS
+# ============================================================
+
+def ensure_schedules(environments, now):
+    """Give every active environment a schedule row, due now."""
+    existing = set(
+        IngestionSchedule.objects.filter(environment__in=environments).values_list("environment_id", flat=True)
+    )
+    IngestionSchedule.objects.bulk_create(
+        [
+            IngestionSchedule(
+                environment=environment,
+                interval_seconds=INGESTION_DEFAULT_INTERVAL,
+                jitter_seconds=INGESTION_DEFAULT_JITTER,
+                next_run_at=now,
+            )
+            for environment in environments if environment.id not in existing
+        ],
+        ignore_conflicts=True
+    )
+
+def next_interval(schedule):
+    """Base interval, doubled for each consecutive empty run (capped at INGESTION_MAX_BACKOFF)."""
+    backoff = schedule.interval_seconds * (2 ** min(schedule.empty_runs, 16))
+    return min(backoff, max(schedule.interval_seconds, INGESTION_MAX_BACKOFF))
+
+def claim_due_schedules(now, limit, env_ids=None):
+    """
+    Mark up to `limit` due schedules as running and return them.
+    Schedules whose previous run is still in progress are skipped; the claim
+    is a conditional UPDATE so overlapping ticks never start the same environment twice.
+    Environments another path is ingesting (fetch_emails, a scan job, the
+    IDLE watcher) are skipped too: each claim takes the environment's
+    ingestion lock, released by finish_schedule().
+    """
+    if lock_is_held(FETCH_EMAILS_LOCK):
+        logger.info("[SCHEDULER] fetch_emails is running, skipping this tick.")
+        return []
+
+    active_ids = [environment.id for environment in get_active_environments(env_ids)]
+    stale = now - timedelta(seconds=INGESTION_RUN_TIMEOUT)
+    scanning = set(
+        ScanJob.objects.filter(environment_id__in=active_ids, status__in=("queued", "running"))
+        .values_list("environment_id", flat=True)
+    )
+
+    candidates = (
+        IngestionSchedule.objects
+        .filter(is_enabled=True, next_run_at__lte=now, environment_id__in=active_ids)
+        .filter(Q(is_running=False) | Q(running_since__lt=stale))
+        .select_related("environment")
+        .order_by("-priority", "next_run_at")
+    )
+
+    claimed = []
+    for schedule in candidates:
+        if len(claimed) >= limit:
+            break
+        if schedule.environment_id in scanning:
+            logger.info(f"[SCHEDULER] {schedule.environment.name} has a scan job in progress, skipping.")
+            continue
+
+        if schedule.is_running:
+            logger.warning(f"[SCHEDULER] Run for {schedule.environment.name} started {schedule.running_since} never finished — restarting.")
+
+        updated = IngestionSchedule.objects.filter(
+            id=schedule.id, is_running=schedule.is_running, running_since=schedule.running_since
+        ).update(is_running=True, running_since=now)
+        if not updated:
+            continue
+
+        try:
+            acquire_environment_lock(schedule.environment_id)
+        except TaskAlreadyRunning:
+            # Another path is ingesting it — hand the claim back, still due
+            IngestionSchedule.objects.filter(id=schedule.id, running_since=now).update(is_running=False, running_since=None)
+            logger.info(f"[SCHEDULER] {schedule.environment.name} is being ingested elsewhere, skipping.")
+            continue
+        claimed.append(schedule)
+
+    return claimed
+
+def finish_schedule(schedule, env_summary, error=None):
+    """Pick the next run time (with backoff and jitter) and release the environment."""
+    release_environment_lock(schedule.environment_id)
+
+    now = timezone.now()
+    env_summary = env_summary or {}
+    errors = list(env_summary.get("errors", []))
+    if error:
+        errors.append(error)
+
+    if errors:
+        # A failure says nothing about how quiet the mailbox is: retry soon, keep the backoff as it was
+        delay = min(schedule.interval_seconds, INGESTION_ERROR_RETRY)
+    else:
+        # Back off on mailboxes that keep returning nothing
+        if env_summary.get("saved") or env_summary.get("messages"):
+            schedule.empty_runs = 0
+        else:
+            schedule.empty_runs += 1
+        delay = next_interval(schedule)
+
+    delay += random.uniform(0, schedule.jitter_seconds)
+    schedule.next_run_at = now + timedelta(seconds=delay)
+    schedule.is_running = False
+    schedule.running_since = None
+    schedule.last_finished_at = now
+    schedule.save(update_fields=["empty_runs", "next_run_at", "is_running", "running_since", "last_finished_at", "updated_at"])
+
+    logger.info(
+        f"[SCHEDULER] {schedule.environment.name}: {'failed' if errors else 'successful'}, "
+        f"{env_summary.get('saved', 0)} saved — next run in {delay:.0f}s"
+    )
+
+
+# ============================================================
+# SCHEDULER TICK
+# ============================================================
+
+def run_scheduler_tick(env_ids=None, max_environments=SCHEDULER_MAX_ENVIRONMENTS,
+                       max_workers=INGESTION_MAX_WORKERS, max_per_host=INGESTION_MAX_PER_HOST, shared=False):
+    """
+    Ingest every environment that is due, highest priority first.
+    Returns the run_ingestion() summary (None if nothing was due).
+    """
+    now = timezone.now()
+    ensure_schedules(get_active_environments(env_ids), now)
+
+    schedules = claim_due_schedules(now, max_environments, env_ids=env_ids)
+    if not schedules:
+        logger.info("[SCHEDULER] No environments due.")
+        return None
+
+    summary, error = None, None
+    try:
+        # run_ingestion records one IngestionRun per environment, with its lag
+        summary = run_ingestion(
+            env_ids=[schedule.environment_id for schedule in schedules],
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+            shared=shared,
+            scheduled_for={schedule.environment_id: schedule.next_run_at for schedule in schedules}
+        )
+    except Exception as e:
+        logger.error(f"[SCHEDULER] Ingestion tick failed: {e}", exc_info=True)
+        error = str(e)
+    finally:
+        per_environment = summary["per_environment"] if summary else {}
+        for schedule in schedules:
+            finish_schedule(schedule, per_environment.get(schedule.environment_id), error=error)
+
+    return summary
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from pydantic import TypeAdapter
+from .schema import build_pydantic_model, pydantic_to_jsonschema
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+# Compiled schemas kept per process (least recently used are dropped first)
+SCHEMA_CACHE_SIZE = getattr(settings, "SCHEMA_CACHE_SIZE", 64)
+
+
+# ============================================================
+# COMPILED SCHEMA CACHE
+# ============================================================
+
+def schema_fingerprint(schema_json):
+    """SHA-256 of the canonical JSON, so any edit to a schema yields a new cache key."""
+    return hashlib.sha256(json.dumps(schema_json, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class CompiledSchema:
+    """
+    Everything extraction needs from one version of a Schema: the dynamic
+    Pydantic model, the OpenAI `text` format dict and a TypeAdapter.
+    """
+
+    def __init__(self, schema_json):
+        self.model = build_pydantic_model("ParseSchemaModel", schema_json, allow_null=False, include_fail_reason=True)
+        self.text_format = pydantic_to_jsonschema(self.model, "ParseSchema", allow_null=False)
+        self.adapter = TypeAdapter(self.model)
+
+    def validate(self, ai_text):
+        """Parse and validate the model's JSON output in one pass (raises pydantic.ValidationError)."""
+        return self.adapter.validate_json(ai_text)
+
+
+class SchemaCache:
+    """
+    LRU of CompiledSchema keyed by (schema id, fingerprint of schema_json).
+    The fingerprint keeps other processes correct after an edit; invalidate()
+    just frees the stale entries right away in the process that saved it.
+    """
+
+    def __init__(self, maxsize=SCHEMA_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, schema):
+        key = (schema.pk, schema_fingerprint(schema.schema_json))
+        with self.lock:
+            compiled = self.entries.get(key)
+            if compiled is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        # Compile outside the lock; two threads may race on a miss, the result is identical
+        compiled = CompiledSchema(schema.schema_json)
+        with self.lock:
+            self.entries[key] = compiled
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return compiled
+
+    def invalidate(self, schema_id=None):
+        """Drop the entries of one schema (or all of them)."""
+        with self.lock:
+            for key in [k for k in self.entries if schema_id is None or k[0] == schema_id]:
+                del self.entries[key]
+
+
+schema_cache = SchemaCache()
+
+def get_compiled_schema(schema):
+    return schema_cache.get(schema)
+
+def invalidate_compiled_schema(schema_id=None):
+    schema_cache.invalidate(schema_id)
@@ -0,0 +1,289 @@
+import imaplib
+import logging
+import tracemalloc
+from ..models import Environment
+from .email_monitor import (
+    CriticalRetryError, RetryError, IMAP_HEADER_FETCH_ITEMS, IMAP_TRACE_MEMORY,
+    imap_pool, build_env_config, build_imap_search, fetch_folder_status,
+    get_sync_state, commit_sync_state, iter_fetch_batches, screen_new_messages,
+    iter_message_contents, prepare_internal_email, process_fetched_emails,
+    decode_subject, format_bytes, attachments_for_environment,
+)
+from .email_writer import EmailBatchWriter
+from .mailbox_actions import apply_post_ingest_action, get_post_ingest_action
+from .imap_pool import CONNECTION_ERRORS
+from .run_metrics import timed
+from .task_lock import renew_environment_lock
+
+logger = logging.getLogger("email_monitor")
+
+# ============================================================
+# HELPERS
+# ============================================================
+
+def build_shared_config(env_configs):
+    """
+    Download settings for a mailbox read by several environments:
+    the union of their allowed file types, attachments never required
+    (each environment's own file types and rules are applied after the download).
+    The post-ingest action only applies when all environments agree on it.
+    """
+    first = env_configs[0]
+    allowed_file_types = sorted({ext for config in env_configs for ext in config["ALLOWED_FILE_TYPES"]})
+
+    actions = {get_post_ingest_action(config) for config in env_configs}
+    if len(actions) > 1:
+        logger.warning(f"Environments sharing {first['IMAP_EMAIL']} use different post-ingest actions, leaving messages unchanged.")
+        first = dict(first, POST_INGEST_ACTION="none")
+
+    return dict(
+        first,
+        ALLOWED_FILE_TYPES=allowed_file_types,
+        REQUIRE_ATTACHMENT=False,
+        MAIL_FILTER=None,
+        FETCH_BATCH_SIZE=max(config["FETCH_BATCH_SIZE"] for config in env_configs),
+    )
+
+
+# ============================================================
+# SHARED MAILBOX FAN-OUT
+# ============================================================
+
+def fetch_shared_folder(env_ids, folder, run_stats=None):
+    """
+    Fetch one folder of one IMAP account for several environments at once.
+
+    The folder is selected once and every message is downloaded (and its
+    attachments uploaded) once, however many environments want it. Each
+    environment keeps its own server-side SEARCH, header screening and
+    UID high-water mark.
+    Returns {env_id: (saved_emails, max_size_emails)}.
+    """
+    environments = list(Environment.objects.filter(id__in=env_ids).order_by("id"))
+    results = {environment.id: ([], []) for environment in environments}
+    if not environments:
+        return results
+
+    env_configs = {environment.id: build_env_config(environment, folders=[folder]) for environment in environments}
+    shared_config = build_shared_config(list(env_configs.values()))
+
+    fetch_stats = run_stats if run_stats is not None else {}
+    for key in ("round_trips", "bytes_fetched", "messages", "failed_batches"):
+        fetch_stats.setdefault(key, 0)
+
+    started_tracing = IMAP_TRACE_MEMORY and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    imap = None
+    broken = False
+    try:
+        imap = imap_pool.acquire(shared_config)
+
+        with timed("select"):
+            uidvalidity, uidnext = fetch_folder_status(imap, folder)
+        fetch_stats["round_trips"] += 1
+
+        with timed("db_write"):
+            sync_states = {environment.id: get_sync_state(environment, folder, uidvalidity) for environment in environments}
+        last_uids = {env_id: state.last_uid if uidvalidity else 0 for env_id, state in sync_states.items()}
+
+        # Environments with nothing new since their last committed UID
+        pending = [
+            environment for environment in environments
+            if not (uidvalidity and uidnext and last_uids[environment.id] and uidnext <= last_uids[environment.id] + 1)
+        ]
+        if not pending:
+            logger.info(f"No new mail in '{folder}' (UIDNEXT {uidnext}) for environments {env_ids}, skipping.")
+            return results
+
+        logger.info(f"Selecting shared folder: {folder} for environments {[e.id for e in pending]}")
+        with timed("select"):
+            status, _ = imap.select(folder)
+        if status != "OK":
+            logger.warning(f"Failed to select folder '{folder}', skipping.")
+            return results
+
+        # One SEARCH per environment (UIDs only) so server-side filters stay exact
+        blocked = set()
+        wanted_by = {}  # uid → [environment, ...]
+        for environment in pending:
+            last_uid = last_uids[environment.id]
+            search_query = build_imap_search(env_configs[environment.id], min_uid=last_uid + 1 if last_uid else None)
+            with timed("search"):
+                status, messages = imap.uid("SEARCH", None, search_query)
+            fetch_stats["round_trips"] += 1
+
+            if status != "OK":
+                logger.warning(f"Search failed in folder '{folder}' for environment {environment.id}.")
+                blocked.add(environment.id)
+                continue
+
+            for uid in messages[0].split():
+                if int(uid) > last_uid:
+                    wanted_by.setdefault(uid, []).append(environment)
+
+        email_ids = sorted(wanted_by, key=int)
+        logger.info(f"Found {len(email_ids)} emails in shared folder '{folder}'.")
+
+        high_water = dict(last_uids)
+        failed_batches = fetch_stats["failed_batches"]
+        writer = EmailBatchWriter()
+        stored_uids = []  # stored for at least one environment → post-ingest action
+        unfinished_uids = set()  # failed for some environment → left untouched
+
+        for uid_chunk, headers in iter_fetch_batches(imap, email_ids, shared_config["FETCH_BATCH_SIZE"], IMAP_HEADER_FETCH_ITEMS, fetch_stats):
+            # Phase one per environment — its own rules, its own known-email links
+            download_for = {}  # uid → [environment, ...]
+            for environment in pending:
+                env_uids = [uid for uid in uid_chunk if environment in wanted_by[uid]]
+                if not env_uids:
+                    continue
+                saved_emails, max_size_emails = results[environment.id]
+                for uid in screen_new_messages(env_uids, headers, environment, env_configs[environment.id], saved_emails, max_size_emails, stored_uids):
+                    download_for.setdefault(uid, []).append(environment)
+
+            download_ids = [uid for uid in uid_chunk if uid in download_for]
+
+            # Phase two once for all environments
+            for email_id, msg, content in iter_message_contents(imap, download_ids, headers, shared_config, fetch_stats):
+                if fetch_stats["failed_batches"] != failed_batches:
+                    blocked.update(environment.id for environment in pending)
+
+                targets = [
+                    environment for environment in download_for[email_id]
+                    if content["has_attachment"] or not env_configs[environment.id]["REQUIRE_ATTACHMENT"]
+                ]
+
+                try:
+                    if not targets:
+                        logger.info(f"Skipped — attachment required: {decode_subject(msg.get('Subject', ''))}")
+                        continue
+
+                    fields, max_size = prepare_internal_email(msg, content, shared_config)
+
+                    # Each environment only gets the attachment types it allows
+                    attachments_for = {}
+                    for environment in list(targets):
+                        env_config = env_configs[environment.id]
+                        attachments = attachments_for_environment(fields["attachments"], env_config)
+                        if attachments is None:
+                            continue
+                        if env_config["REQUIRE_ATTACHMENT"] and not attachments:
+                            targets.remove(environment)
+                            continue
+                        attachments_for[environment.id] = attachments
+
+                    if not targets:
+                        logger.info(f"Skipped — no allowed attachment: {decode_subject(msg.get('Subject', ''))}")
+                        continue
+
+                    # One InternalEmail, one EnvironmentEmail per target — written in bulk per batch
+                    writer.add(email_id, fields, [environment.id for environment in targets], max_size=max_size, attachments_for=attachments_for)
+
+                except CriticalRetryError as e:
+                    logger.error(f"CRITICAL FAILURE — Skipping email {email_id}: {e}")
+                    blocked.update(environment.id for environment in targets)
+                    unfinished_uids.add(email_id)
+                    continue
+
+                except RetryError as e:
+                    logger.error(f"NON-CRITICAL FAILURE — Email saved anyway: {e}")
+                    continue
+
+                except Exception as e:
+                    logger.error(f"Unexpected error processing {email_id}: {e}", exc_info=True)
+                    blocked.update(environment.id for environment in targets)
+                    unfinished_uids.add(email_id)
+                    continue
+
+                finally:
+                    for environment in pending:
+                        if environment.id not in blocked and environment in wanted_by[email_id]:
+                            high_water[environment.id] = int(email_id)
+
+                    # Release spooled attachment files
+                    for _, file_data in content["files"]:
+                        if hasattr(file_data, "close"):
+                            file_data.close()
+
+                    if IMAP_TRACE_MEMORY:
+                        peak = tracemalloc.get_traced_memory()[1]
+                        fetch_stats["peak_message_memory"] = max(fetch_stats.get("peak_message_memory", 0), peak)
+                        tracemalloc.reset_peak()
+
+            # Persist the whole batch before checkpointing past it
+            linked, failed = writer.flush()
+            for record, env_email in linked:
+                saved_emails, max_size_emails = results[env_email.environment_id]
+                (max_size_emails if record["max_size"] else saved_emails).append(env_email)
+                stored_uids.append(record["uid"])
+                logger.info(f"Saved email — {env_email.internal_email.subject} → environment {env_email.environment_id}")
+            for record in failed:
+                unfinished_uids.add(record["uid"])
+                for env_id in record["environment_ids"]:
+                    blocked.add(env_id)
+                    high_water[env_id] = min(high_water[env_id], int(record["uid"]) - 1)
+
+            if fetch_stats["failed_batches"] != failed_batches:
+                blocked.update(environment.id for environment in pending)
+
+            # Checkpoint once per fetch batch
+            for environment in pending:
+                renew_environment_lock(environment.id)
+                if environment.id not in blocked:
+                    high_water[environment.id] = max(high_water[environment.id], int(uid_chunk[-1]))
+                    commit_sync_state(sync_states[environment.id], high_water[environment.id])
+
+        if uidvalidity:
+            for environment in pending:
+                if environment.id not in blocked:
+                    # Every UID below UIDNEXT was either ingested or excluded by the search
+                    high_water[environment.id] = max(high_water[environment.id], (uidnext or 1) - 1)
+                commit_sync_state(sync_states[environment.id], high_water[environment.id])
+
+        # Everything above is committed — mark / tag / move it on the server in one go
+        with timed("fetch"):
+            apply_post_ingest_action(
+                imap, folder, [uid for uid in stored_uids if uid not in unfinished_uids], shared_config, fetch_stats
+            )
+
+        logger.info(
+            f"Shared fetch of '{folder}' for {len(pending)} environments — round trips: {fetch_stats['round_trips']}, "
+            f"messages: {fetch_stats['messages']}, bytes fetched: {format_bytes(fetch_stats['bytes_fetched'])}"
+        )
+
+    except CONNECTION_ERRORS:
+        broken = True
+        raise
+
+    finally:
+        if imap:
+            try:
+                imap.close()
+            except (imaplib.IMAP4.abort, OSError):
+                broken = True
+            except:
+                pass
+            imap_pool.release(shared_config, imap, broken=broken)
+        if started_tracing:
+            tracemalloc.stop()
+
+    return results
+
+
+def fetch_and_process_shared(env_ids, folder, run_stats=None):
+    """
+    Shared-mailbox counterpart of fetch_and_process_emails().
+    Returns {env_id: EnvironmentEmail queryset}. IMAP traffic counts go
+    into run_stats, saved/processed/failed counts into
+    run_stats["per_environment"][env_id].
+    """
+    results = fetch_shared_folder(env_ids, folder, run_stats=run_stats)
+    per_environment = run_stats.setdefault("per_environment", {}) if run_stats is not None else None
+
+    processed = {}
+    for env_id, (saved_emails, max_size_emails) in results.items():
+        env_stats = per_environment.setdefault(env_id, {}) if per_environment is not None else None
+        processed[env_id] = process_fetched_emails(saved_emails, max_size_emails, run_stats=env_stats)
+    return processed
@@ -1,3 +1,5 @@
+import time
+from django.conf import settings
 from django.utils import timezone
 from django.db import transaction
 from ..models import TaskLock
@@ -34,3 +36,68 @@ def release_lock(name: str):
         lock.is_locked = False
         lock.locked_at = None
         lock.save()
+
+
+def lock_is_held(name: str, timeout_minutes=10):
+    """True if the lock is taken and not stale (does not acquire it)."""
+    lock = TaskLock.objects.filter(name=name, is_locked=True).first()
+    return bool(lock and lock.locked_at and (timezone.now() - lock.locked_at).total_seconds() < timeout_minutes * 60)
+
+
+def renew_lock(name: str):
+    """Push a held lock's staleness deadline forward (long-running holders)."""
+    TaskLock.objects.filter(name=name, is_locked=True).update(locked_at=timezone.now())
+
+
+# ------------------------------------------------------------
+# Per-environment ingestion lock
+# ------------------------------------------------------------
+# Taken by every path that ingests an environment (fetch_emails, scheduler,
+# scan jobs, IDLE watcher) so two of them never scan the same inbox at once.
+
+# A holder that has not renewed the lock for this long is assumed dead
+ENVIRONMENT_LOCK_TIMEOUT = getattr(settings, "ENVIRONMENT_LOCK_TIMEOUT", 60 * 30) # 30 min
+
+FETCH_EMAILS_LOCK = "fetch_emails_lock"
+
+
+def environment_lock_name(env_id):
+    return f"ingest_environment_{env_id}"
+
+
+def acquire_environment_lock(env_id):
+    """Take the environment's ingestion lock or raise TaskAlreadyRunning."""
+    acquire_lock(environment_lock_name(env_id), timeout_minutes=ENVIRONMENT_LOCK_TIMEOUT / 60)
+
+
+def release_environment_lock(env_id):
+    release_lock(environment_lock_name(env_id))
+
+
+def renew_environment_lock(env_id):
+    """Called once per fetch batch, so long runs keep the environment past ENVIRONMENT_LOCK_TIMEOUT."""
+    renew_lock(environment_lock_name(env_id))
+
+
+def wait_for_environment_lock(env_id, timeout, poll_interval=2, stop_event=None, on_wait=None):
+    """
+    Take the environment's ingestion lock, waiting up to `timeout` seconds
+    for the current holder to finish. on_wait() is called while waiting.
+    Returns False if it could not be taken in time (or stop_event was set).
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            acquire_environment_lock(env_id)
+            return True
+        except TaskAlreadyRunning:
+            pass
+
+        if time.monotonic() >= deadline or (stop_event and stop_event.is_set()):
+            return False
+        if on_wait:
+            on_wait()
+        if stop_event:
+            stop_event.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
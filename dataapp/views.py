@@ -1,4 +1,4 @@
-from django.http import JsonResponse, HttpResponseNotAllowed, HttpResponse
+from django.http import JsonResponse, HttpResponseNotAllowed, HttpResponse, FileResponse, Http404
 from django.views.decorators.http import require_http_methods
 from django.db.models import Count
 from django.shortcuts import render, redirect, get_object_or_404
@@ -7,9 +7,18 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, logout, update_session_auth_hash
 from .utils.email_monitor import fetch_and_process_emails, save_attachment, format_bytes, MAX_OPENAI_FILE_SIZE
 from .utils.ai_process import process_email, process_upload
+from .utils.scan_budget import (
+    ScanBudget, InvalidScanCursor, SCAN_DEADLINE_SECONDS, SCAN_MAX_MESSAGES, SCAN_MAX_BYTES,
+    SCAN_DEADLINE_LIMIT, SCAN_MAX_MESSAGES_LIMIT, SCAN_MAX_BYTES_LIMIT,
+)
 from .forms import SchemaForm, EnvironmentForm
 from django.forms import ValidationError
-from .models import Environment, EnvironmentEmail, EnvironmentUpload, ExtractionResult, Schema, AuditLog
+from .models import Environment, EnvironmentEmail, EnvironmentUpload, ExtractionResult, Schema, AuditLog, ScanJob
+from .utils.scan_jobs import submit_scan_job as queue_scan_job
+from .utils.attachment_storage import get_attachment_storage
+from .utils.extraction_pool import run_extractions
+from .utils.batch_extraction import submit_extraction_batch
+from .utils.task_lock import acquire_environment_lock, release_environment_lock, TaskAlreadyRunning
 import json
 import csv
 from .utils.table import *
@@ -149,7 +158,7 @@ def review_email_result(request, email_id):
     environment_email = get_object_or_404(EnvironmentEmail, id=email_id)
     result = environment_email.result
     file_urls = ""
-    for file in environment_email.internal_email.attachments:
+    for file in environment_email.get_attachments():
         file_path = file['file_path']
         file_urls += file_path + "\n"
     print('FILE URLS:', file_urls)
@@ -603,6 +612,7 @@ def serialize_emails(qs):
             "internal_email__subject",
             "internal_email__sender",
             "internal_email__attachments",
+            "attachments",
             "internal_email__date_recieved",
             "status",
             "internal_email__total_file_size",
@@ -633,7 +643,7 @@ def serialize_emails(qs):
             "from": it.get("internal_email__sender") or "",
             "date": date_str,
             "status": it.get("status"),
-            "attachments": it.get("internal_email__attachments"),
+            "attachments": it.get("internal_email__attachments") if it.get("attachments") is None else it.get("attachments"),
             "total_file_size": it.get("internal_email__total_file_size"),
             "is_approved": it.get("result__is_approved")
         })
@@ -672,27 +682,116 @@ def compute_email_metrics_and_summary(environment):
     return metrics, summary
 
 # --- Views -----------------------------------------------------------------------
+def parse_scan_budget(request, env_id):
+    """
+    ScanBudget from the request (JSON body or query string):
+    deadline (seconds), max_messages, max_bytes, cursor — each clamped to the server limits.
+    """
+    params = request.GET.dict()
+    if request.body and request.content_type == "application/json":
+        params.update(json.loads(request.body))
+
+    def bounded(name, default, limit):
+        try:
+            value = int(params.get(name) or default)
+        except (TypeError, ValueError):
+            raise ValidationError(f"'{name}' must be a number.")
+        return max(1, min(value, limit))
+
+    return ScanBudget(
+        deadline=bounded("deadline", SCAN_DEADLINE_SECONDS, SCAN_DEADLINE_LIMIT),
+        max_messages=bounded("max_messages", SCAN_MAX_MESSAGES, SCAN_MAX_MESSAGES_LIMIT),
+        max_bytes=bounded("max_bytes", SCAN_MAX_BYTES, SCAN_MAX_BYTES_LIMIT),
+        cursor=params.get("cursor") or None,
+        env_id=env_id,
+    )
+
 @login_required
 @require_http_methods(["GET", "POST"])
 def scan_inbox(request, env_id):
     """
-    Endpoint: /api/scan-inbox/
-    Purpose: return a list of newly-scanned (most recent) emails + metrics + summary.
-    Note: no 'scanning' logic is performed here (per your instruction). We simply return
-    the most recent N emails from the Email model to act as the 'scanned' results.
+    Endpoint: /api/scan-inbox/<env_id>/
+    Purpose: scan one slice of the inbox within a time / message / byte budget
+    and return the emails it saved + metrics + summary.
+    Optional params (JSON body or query string): deadline, max_messages, max_bytes, cursor.
+    When "has_more" is true, post the returned "cursor" to scan the next slice.
     """
     environment = get_object_or_404(Environment, pk=env_id)
-        
-    # choose how many "new" emails to return; adjust as you like
-    fetched_emails = fetch_and_process_emails(env_id)
+
+    try:
+        budget = parse_scan_budget(request, env_id)
+    except (ValidationError, InvalidScanCursor, json.JSONDecodeError) as e:
+        message = e.messages[0] if isinstance(e, ValidationError) else str(e)
+        return JsonResponse({"error": message}, status=400)
+
+    # Same per-environment lock as the scheduler, scan jobs, IDLE and fetch_emails
+    try:
+        acquire_environment_lock(env_id)
+    except TaskAlreadyRunning:
+        return JsonResponse({"error": "A scan of this inbox is already running. Try again when it has finished."}, status=409)
+    try:
+        fetched_emails = fetch_and_process_emails(env_id, budget=budget)
+    finally:
+        release_environment_lock(env_id)
     emails = serialize_emails(fetched_emails)
 
     metrics, summary = compute_email_metrics_and_summary(environment)
+    cursor = budget.next_cursor()
     payload = {
         "emails": emails,
         "metrics": metrics,
         "summary": summary,
+        "scan": budget.summary(),
+        "cursor": cursor,
+        "has_more": cursor is not None,
+    }
+    return JsonResponse(payload, status=200)
+
+def serialize_scan_job(job):
+    return {
+        "id": job.id,
+        "environment": job.environment_id,
+        "status": job.status,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "progress": {
+            "found": job.messages_found,
+            "fetched": job.messages_fetched,
+            "extracted": job.extracted,
+            "failed": job.failed,
+        },
+        "error": job.error or None,
     }
+
+@login_required
+@require_POST
+def submit_scan_job(request, env_id):
+    """
+    Endpoint: /api/scan-jobs/<env_id>/
+    Queue a background scan (run by `manage.py run_scan_worker`) and return its id right away.
+    If the environment already has a queued or running scan, that job is returned instead.
+    """
+    environment = get_object_or_404(Environment, pk=env_id)
+    job, created = queue_scan_job(environment, user=request.user)
+    return JsonResponse({"job": serialize_scan_job(job), "created": created}, status=202 if created else 200)
+
+@login_required
+@require_http_methods(["GET"])
+def scan_job_status(request, job_id):
+    """
+    Endpoint: /api/scan-jobs/status/<job_id>/
+    Progress of a scan job; once it has finished, also the emails it saved + metrics + summary.
+    """
+    job = get_object_or_404(ScanJob.objects.select_related("environment"), pk=job_id)
+    payload = {"job": serialize_scan_job(job)}
+
+    if job.is_finished:
+        payload["emails"] = serialize_emails(
+            EnvironmentEmail.objects.filter(id__in=job.email_ids).order_by("-created_at")
+        )
+        payload["metrics"], payload["summary"] = compute_email_metrics_and_summary(job.environment)
+
     return JsonResponse(payload, status=200)
 
 @login_required
@@ -786,8 +885,12 @@ def reprocess_all_failed(request, env_id):
     failed_qs = environment.environment_emails.filter(status="failed")
     print('FAILED QS:', failed_qs)
     
-    for email in failed_qs:
-        process_email(email)
+    # ?batch=1: send them through the Batch API instead (cheaper, results arrive within 24h)
+    batch_mode = request.GET.get("batch") == "1"
+    if batch_mode:
+        batches = submit_extraction_batch(failed_qs, environment=environment)
+    else:
+        run_extractions(failed_qs, process_email)
 
     # failed_emails = serialize_emails(failed_qs)
     failed_emails_ids = [obj.id for obj in failed_qs]
@@ -795,14 +898,15 @@ def reprocess_all_failed(request, env_id):
 
 
     # Build results list; since there's no processing logic, mark processed as False by default.
-    results = [{"processed": True, "email": e} for e in failed_emails]
+    results = [{"processed": not batch_mode, "email": e} for e in failed_emails]
     print('RESULTS:', results)
 
     metrics, summary = compute_email_metrics_and_summary(environment)
     return JsonResponse({
         "results": results,
         "metrics": metrics,
-        "summary": summary
+        "summary": summary,
+        "batches": [b.batch_id for b in batches] if batch_mode else []
     }, status=200)
 
 
@@ -930,12 +1034,15 @@ def upload_files(request, env_id):
     
     total_file_size = 0
     for f in files:
-        saved, size = save_attachment(f.name, f.read(), env_config)
+        # The UploadedFile itself: large files are streamed from disk, never read into memory
+        saved, size, sha256, ai_url = save_attachment(f.name, f, env_config)
         if saved and size:
             attachments.append({
                 "filename": f.name,
                 "file_path": saved,
-                "file_size": size
+                "file_size": size,
+                "sha256": sha256,
+                "ai_file_path": ai_url
             })
             print(f'SIZE OF {f.name}:', format_bytes(size))
             total_file_size += size
@@ -1046,8 +1153,12 @@ def reprocess_all_failed_uploads(request, env_id):
     failed_qs = environment.environment_uploads.filter(status="failed")
     print('FAILED QS:', failed_qs)
     
-    for upload in failed_qs:
-        process_upload(upload)
+    # ?batch=1: send them through the Batch API instead (cheaper, results arrive within 24h)
+    batch_mode = request.GET.get("batch") == "1"
+    if batch_mode:
+        batches = submit_extraction_batch(failed_qs, environment=environment)
+    else:
+        run_extractions(failed_qs, process_upload)
 
     # failed_emails = serialize_emails(failed_qs)
     failed_uploads_ids = [obj.id for obj in failed_qs]
@@ -1055,14 +1166,15 @@ def reprocess_all_failed_uploads(request, env_id):
 
 
     # Build results list; since there's no processing logic, mark processed as False by default.
-    results = [{"processed": True, "upload": u} for u in failed_uploads]
+    results = [{"processed": not batch_mode, "upload": u} for u in failed_uploads]
     print('RESULTS:', results)
 
     metrics, summary = compute_file_metrics_and_summary(environment)
     return JsonResponse({
         "results": results,
         "metrics": metrics,
-        "summary": summary
+        "summary": summary,
+        "batches": [b.batch_id for b in batches] if batch_mode else []
     }, status=200)
 
 @login_required
@@ -1083,6 +1195,22 @@ def delete_upload(request, upload_id):
         return JsonResponse({"deleted": True,"id": upload_id, "metrics": metrics}, status=200)
     return JsonResponse({"deleted": False, "id": upload_id}, status=404)
 
+@require_http_methods(["GET"])
+def attachment_file(request, signature, name):
+    """
+    Endpoint: /attachments/<signature>/<name>
+    Serves a file from the local attachment storage. The signed URL is the
+    access check: it is stored on the email and fetched without a session.
+    """
+    storage = get_attachment_storage("local")
+    if storage.verified_name(signature, name) is None:
+        raise Http404("Attachment not found.")
+    try:
+        f = open(storage.path(name), "rb")
+    except (FileNotFoundError, ValueError):
+        raise Http404("Attachment not found.")
+    return FileResponse(f, filename=name.rsplit("/", 1)[-1])
+
 @login_required
 @require_http_methods(["POST"])
 def rename_upload(request, upload_id):
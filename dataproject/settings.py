@@ -98,6 +98,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Concurrent ingestion workers write at the same time: take the write
+        # lock up front and wait for it instead of failing with "database is locked"
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -177,6 +183,17 @@ IMAP_ENCRYPTION_KEY = str(os.getenv('IMAP_ENCRYPTION_KEY'))
 
 DEFAULT_DOCUMENT_TYPES = ["invoice", "purchase order", "BOL"]
 
+
+# Ingestion scheduler (django_crontab) — each tick only runs the environments that are due
+
+CRONJOBS = [
+    ('* * * * *', 'django.core.management.call_command', ['run_scheduler', '--once']),
+    # Fallback for queued scan jobs when no `run_scan_worker` process is running
+    ('* * * * *', 'django.core.management.call_command', ['run_scan_worker', '--once']),
+    # Ingest finished Batch API extractions
+    ('*/10 * * * *', 'django.core.management.call_command', ['run_extraction_batch']),
+]
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
@@ -280,27 +280,56 @@ async function loadEmails() {
     }
 }
 
-// Scan inbox -> POST /api/scan-inbox/ (returns emails, metrics, summary)
+// Scan inbox -> POST /api/scan-jobs/:env_id/ queues a background scan (run_scan_worker),
+// then GET /api/scan-jobs/status/:job_id/ until it finishes (returns emails, metrics, summary).
+const SCAN_POLL_MS = 1500;
+
+function mergeScannedEmails(emails) {
+    if (!Array.isArray(emails) || !emails.length) return 0;
+    // Prepend new emails into localEmails, avoiding duplicates by id
+    const ids = new Set(localEmails.map(e => e.id));
+    let added = 0;
+    emails.forEach(e => { if (!ids.has(e.id)) { localEmails.unshift(e); added++; } });
+    return added;
+}
+
+function describeScanProgress(job) {
+    if (job.status === 'queued') return 'Scan queued, waiting for a worker...';
+    const p = job.progress || {};
+    return `Scanning: ${p.found || 0} found, ${p.fetched || 0} fetched, ${p.extracted || 0} extracted, ${p.failed || 0} failed`;
+}
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
 scanBtn.addEventListener('click', async () => {
     scanBtn.setAttribute('disabled', 'disabled');
     renderFullListSkeleton(4);
     try {
-        const res = await fetch(`/api/scan-inbox/${env_id}/`, {
+        const res = await fetch(`/api/scan-jobs/${env_id}/`, {
             method: 'POST',
             headers: { 'X-CSRFToken': csrftoken }
         });
         if (!res.ok) throw new Error('Scan failed');
-        const json = await res.json();
-        // expected shape: { emails: [...], metrics: {...}, summary: {...} }
-        if (Array.isArray(json.emails) && json.emails.length) {
-            // Prepend new emails into localEmails (assuming server sent the new items)
-            // Avoid duplicates by id
-            const ids = new Set(localEmails.map(e => e.id));
-            json.emails.forEach(e => { if (!ids.has(e.id)) localEmails.unshift(e); });
+        let json = await res.json();
+
+        // expected shape: { job: { id, status, progress: {...} } } → poll until finished
+        while (json.job.status === 'queued' || json.job.status === 'running') {
+            showToast(describeScanProgress(json.job));
+            await sleep(SCAN_POLL_MS);
+            const poll = await fetch(`/api/scan-jobs/status/${json.job.id}/`);
+            if (!poll.ok) throw new Error('Scan status failed');
+            json = await poll.json();
         }
+
+        // finished: { job: {...}, emails: [...], metrics: {...}, summary: {...} }
+        mergeScannedEmails(json.emails);
         if (json.metrics) renderMetrics(json.metrics);
         renderList(activeFilter, searchInput.value.trim());
-        showToast((json.emails?.length || 0) + ' new email(s) scanned and processed');
+        if (json.job.status === 'failed') {
+            showToast('Scan failed' + (json.job.error ? ': ' + json.job.error : ''));
+        } else {
+            showToast((json.emails?.length || 0) + ' new email(s) scanned and processed');
+        }
     } catch (e) {
         console.log(e)
         showToast('Scan failed');